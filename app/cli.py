@@ -0,0 +1,100 @@
+import json
+from typing import List
+
+import typer
+
+app = typer.Typer(help="Headless entry point for the QA models.")
+
+
+@app.command()
+def serve(host: str = "0.0.0.0", port: int = 8000):
+    """
+    Start the HTTP service (/ask, /ingest and /crawl).
+
+    The service runs in a single process: the models, the crawled site chains and
+    the metrics live in its memory, and concurrent requests are served by its
+    thread pool and the mDeBERTa micro-batcher.
+    """
+    import uvicorn
+
+    uvicorn.run("app.service:app", host=host, port=port, workers=1)
+
+
+@app.command()
+def ask(
+    question: str,
+    model: str = typer.Option("mdeberta", help="mdeberta, chatgpt or site."),
+    site: str = typer.Option("", help="Site to crawl before asking (model site)."),
+    entire_site: bool = False,
+):
+    """Answer a question from the command line."""
+    from app.models.qa_service import QAService
+
+    service = QAService()
+    site_id = ""
+    if site:
+        site_id = service.crawl(site, entire_site)["site_id"]
+    typer.echo(json.dumps(service.ask(question, model, site_id), ensure_ascii=False))
+
+
+@app.command()
+def ingest(
+    paths: List[str],
+    embedding: List[str] = typer.Option(["huggingf"], help="huggingf and/or openai."),
+):
+    """Index .txt and .pdf files into the knowledge base."""
+    from app.models.qa_service import QAService, read_files
+
+    result = QAService().ingest(read_files(paths), embedding)
+    typer.echo(json.dumps(result, ensure_ascii=False))
+
+
+@app.command()
+def crawl(site: str, entire_site: bool = False):
+    """Scrape a site and print the urls that would be embedded."""
+    from app.models import ask_site
+
+    urls = ask_site.get_urls(site) if entire_site else [site]
+    typer.echo(json.dumps(urls, ensure_ascii=False))
+
+
+@app.command("shard-index")
+def shard_index(
+    embedding: str = typer.Option("huggingf", help="huggingf or openai."),
+    max_vectors: int = typer.Option(0, help="Vectors per shard, 0 for the default."),
+):
+    """Convert an index to the sharded format, without embedding it again."""
+    from app.models import sharded_index, utils
+
+    index_path, embeddings = utils.setup_for_embeddings(
+        embedding, return_embeddings=True
+    )
+    manifest = sharded_index.migrate(index_path, embeddings, max_vectors or None)
+    typer.echo(json.dumps(manifest, ensure_ascii=False))
+
+
+@app.command("compact-index")
+def compact_index(
+    embedding: str = typer.Option("huggingf", help="huggingf or openai.")
+):
+    """Merge the small sealed shards of a sharded index."""
+    from app.models import sharded_index, utils
+
+    index_path, embeddings = utils.setup_for_embeddings(
+        embedding, return_embeddings=True
+    )
+    removed = sharded_index.compact(index_path, embeddings)
+    typer.echo(json.dumps({"removed_shards": removed}))
+
+
+@app.command("reembed-index")
+def reembed_index():
+    """Embed the local index again with the e5 query/passage prefixes."""
+    from app.models import create_knowledge_base
+
+    chunks = create_knowledge_base.reembed_index()
+    typer.echo(json.dumps({"chunks": chunks}))
+
+
+if __name__ == "__main__":
+    app()
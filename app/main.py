@@ -3,6 +3,8 @@ import os
 import openai
 import streamlit as st
 
+from app.models import conversation
+
 
 def sidebar():
     with st.sidebar:
@@ -20,13 +22,8 @@ def sidebar():
 def main():
     sidebar()
     st.title("💬 Chatbot")
-    if "messages" not in st.session_state:
-        st.session_state["messages"] = [
-            {"role": "assistant", "content": "How can I help you?"}
-        ]
-
-    for msg in st.session_state.messages:
-        st.chat_message(msg["role"]).write(msg["content"])
+    memory = conversation.session_memory("chat_memory", "How can I help you?")
+    conversation.render_history(memory)
 
     if query := st.chat_input():
         if not st.session_state["chatbot_api_key"]:
@@ -34,14 +31,15 @@ def main():
             st.stop()
         os.environ["OPENAI_API_KEY"] = st.session_state["chatbot_api_key"]
         openai.api_key = st.session_state["chatbot_api_key"]
-        st.session_state.messages.append({"role": "user", "content": query})
+        memory.add("user", query)
         st.chat_message("user").write(query)
+        messages = memory.prompt_messages(summarize=conversation.summarize_with_openai)
         response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo", messages=st.session_state.messages
+            model="gpt-3.5-turbo", messages=messages
         )
-        msg = response.choices[0].message
-        st.session_state.messages.append(msg)
-        st.chat_message("assistant").write(msg.content)
+        answer = response.choices[0].message.content
+        memory.add("assistant", answer)
+        st.chat_message("assistant").write(answer)
 
 
 if __name__ == "__main__":
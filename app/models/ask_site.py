@@ -1,20 +1,31 @@
 from urllib.parse import urljoin, urlparse
+import hashlib
+import os
+import threading
+import uuid
 import requests
 import streamlit as st
 from bs4 import BeautifulSoup as bs
 
+from app.models import metrics, utils
+from app.models.chunking import get_chunker
+from app.models.context_budget import MAX_CONTEXT_TOKENS, BudgetRetriever
+from app.models.dedup import canonicalize_url, deduplicate_documents
+from app.models.embedding_client import BatchedOpenAIEmbeddings
 
 from langchain.chains import RetrievalQA
 from langchain.chat_models import ChatOpenAI
 from langchain.document_loaders import UnstructuredURLLoader
-from langchain.embeddings.openai import OpenAIEmbeddings
 from langchain.prompts import PromptTemplate
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.vectorstores import FAISS
 
 
-CHUNK_SIZE = 1000
-CHUNK_OVERLAP = 150
+# in tiktoken tokens
+CHUNK_SIZE = 256
+CHUNK_OVERLAP = 32
+SITES_PATH = os.path.join(utils.DATA_PATH, "sites")
+# site chains kept loaded by the Website QA page
+MAX_CACHED_SITES = 8
 
 PROMPT_TEMPLATE = """
 Use the following pieces of context to answer the question at the end. If you don't know
@@ -31,6 +42,8 @@ PROMPT = PromptTemplate(
 )
 
 urls = list()
+# `urls` is shared by the crawls of the process
+crawl_lock = threading.Lock()
 
 
 def _format_link(site):
@@ -39,30 +52,52 @@ def _format_link(site):
     return "https://" + site
 
 
-def full_scrape_urls(site):
+def _record_canonical(site, soup, canonical_links):
+    # the <link rel="canonical"> of a crawled page, when the crawl keeps them
+    link = soup.find("link", rel="canonical")
+    if canonical_links is not None and link and link.get("href"):
+        canonical = canonicalize_url(urljoin(site, link["href"]))
+        if urlparse(canonical).netloc == urlparse(site).netloc:
+            canonical_links[canonicalize_url(site)] = canonical
+
+
+def _add_url(site, domain, seen):
+    # the urls are fetched as found, their canonical form only detects repeats
+    key = canonicalize_url(site)
+    if key in seen or domain not in site:
+        return False
+    seen.add(key)
+    urls.append(site)
+    return True
+
+
+def full_scrape_urls(site, canonical_links=None):
     site = _format_link(site)
     domain = urlparse(site).netloc
     response = requests.get(site)
     soup = bs(response.content, "html.parser")
+    _record_canonical(site, soup, canonical_links)
+    seen = {canonicalize_url(url) for url in urls}
     for link in soup.find_all("a"):
         href = link.get("href")
         if href and not href.startswith("#"):  # and (site := site + href) not in url:
             site = urljoin(site, href)
-            if site not in urls and domain in site:
-                urls.append(site)
-                scrape_urls(site)
+            if _add_url(site, domain, seen):
+                scrape_urls(site, canonical_links, seen)
 
 
-def scrape_urls(site):
+def scrape_urls(site, canonical_links=None, seen=None):
     domain = urlparse(site).netloc
     response = requests.get(site)
     soup = bs(response.content, "html.parser")
+    _record_canonical(site, soup, canonical_links)
+    if seen is None:
+        seen = {canonicalize_url(url) for url in urls}
     for link in soup.find_all("a"):
         href = link.get("href")
         if href and not href.startswith("#"):  # and (site := site + href) not in url:
             site = urljoin(site, href)
-            if site not in urls and domain in site:
-                urls.append(site)
+            _add_url(site, domain, seen)
 
 
 def _clean_llm_response(llm_response):
@@ -71,49 +106,140 @@ def _clean_llm_response(llm_response):
     return answer, sources
 
 
-def _split_text():
-    documents = _get_site_data()
-    text_splitter = RecursiveCharacterTextSplitter(
-        separators=["\n\n", "\n", ","],
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP,
-        length_function=len,
+def _unique_urls(site_urls, canonical_links):
+    # the first url found of each page, as it was found
+    unique = dict()
+    for url in map(_format_link, site_urls):
+        canonical = canonicalize_url(url)
+        unique.setdefault(canonical_links.get(canonical, canonical), url)
+    return list(unique.values())
+
+
+def _split_text(site_urls, canonical_links=None):
+    canonical_links = canonical_links or dict()
+    unique_urls = _unique_urls(site_urls, canonical_links)
+    with metrics.span("ask_site.load"):
+        documents = _get_site_data(unique_urls)
+    with metrics.span("ask_site.deduplicate"):
+        documents, stats = deduplicate_documents(documents, canonical_links)
+    stats["duplicate_urls"] = len(site_urls) - len(unique_urls)
+    metrics.count("ask_site_duplicate_urls", stats["duplicate_urls"])
+    metrics.count("ask_site_duplicate_pages", stats["pages"] - stats["kept"])
+    metrics.count("ask_site_pages", len(documents))
+    metrics.count(
+        "ask_site_bytes", lambda: sum(len(doc.page_content) for doc in documents)
     )
-    chunks = text_splitter.split_documents(documents)
-    return chunks
+    chunker = get_chunker("tiktoken", CHUNK_SIZE, CHUNK_OVERLAP)
+    with metrics.span("ask_site.split"):
+        chunks = chunker.split_documents(documents)
+    metrics.count("ask_site_chunks", len(chunks))
+    return chunks, stats
 
 
-def _get_site_data():
-    loaders = UnstructuredURLLoader(urls=urls)
+def _get_site_data(site_urls):
+    loaders = UnstructuredURLLoader(urls=site_urls)
     data = loaders.load()
     return data
 
 
-def get_urls(site):
-    full_scrape_urls(site)
+def get_urls(site, canonical_links=None):
+    """
+    Crawl a site from `site` and return the urls found, `urls` included.
+
+    Pass a dict as `canonical_links` to collect the canonical url declared by the
+    crawled pages, then give it to `build_site_index` or `create_site_chain`.
+    """
+    with metrics.span("ask_site.crawl"):
+        full_scrape_urls(site, canonical_links)
     return urls
 
 
-@st.cache_resource
-def load_site_chain(site):
-    if not urls:
-        urls.extend(site)
+def site_id(site_urls):
+    return hashlib.sha1(" ".join(sorted(site_urls)).encode()).hexdigest()[:12]
 
-    chunks = _split_text()
-    embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")
-    knowledge_base = FAISS.from_documents(chunks, embeddings)
 
+def _embeddings(progress_path=None, progress_callback=None):
+    return BatchedOpenAIEmbeddings(
+        model="text-embedding-ada-002",
+        progress_path=progress_path or utils.EMBEDDING_PROGRESS_PATH,
+        progress_callback=progress_callback,
+    )
+
+
+def _create_chain(knowledge_base):
     qa_chain = RetrievalQA.from_chain_type(
         llm=ChatOpenAI(temperature=0, model="gpt-3.5-turbo"),
         chain_type="stuff",
-        retriever=knowledge_base.as_retriever(),
+        retriever=BudgetRetriever(
+            vectorstore=knowledge_base,
+            max_tokens=MAX_CONTEXT_TOKENS,
+            prompt_template=PROMPT_TEMPLATE,
+        ),
         return_source_documents=True,
         chain_type_kwargs={"prompt": PROMPT},
     )
     return qa_chain
 
 
+def create_site_chain(site_urls, canonical_links=None):
+    chunks, _ = _split_text(site_urls, canonical_links)
+    with metrics.span("ask_site.embed"):
+        knowledge_base = FAISS.from_documents(chunks, _embeddings())
+    return _create_chain(knowledge_base)
+
+
+def build_site_index(
+    site_urls, progress_path=None, progress_callback=None, canonical_links=None
+):
+    """
+    Scrape, split and embed the pages of a site and save their index.
+
+    Urls that lead to the same page and pages with the same or nearly the same text
+    are embedded once. The index is written next to its final folder and swapped in
+    once complete. It is saved under `SITES_PATH`, named by `site_id`, to be used
+    with `load_site_index_chain`.
+
+    Args:
+        site_urls (List[str]): The pages to index.
+        progress_path (str, optional): Checkpoint of the embedding batches, to
+            resume an interrupted run.
+        progress_callback (Callable[[int, int], None], optional): Called with the
+            number of embedded batches and the total.
+        canonical_links (Dict[str, str], optional): Canonical urls collected by
+            `get_urls`.
+
+    Returns:
+        Tuple[str, dict]: The site id, and how many duplicate urls and pages were
+        skipped (see `dedup.deduplicate_documents`).
+    """
+    identifier = site_id(site_urls)
+    chunks, stats = _split_text(site_urls, canonical_links)
+    embeddings = _embeddings(progress_path, progress_callback)
+    with metrics.span("ask_site.embed"):
+        knowledge_base = FAISS.from_documents(chunks, embeddings)
+    index_path = os.path.join(SITES_PATH, identifier)
+    staging_path = f"{index_path}.{uuid.uuid4().hex[:8]}"
+    knowledge_base.save_local(staging_path)
+    utils.replace_directory(staging_path, index_path)
+    return identifier, stats
+
+
+def load_site_index_chain(identifier):
+    """Load the chain of a site indexed by `build_site_index`, again once re-crawled."""
+    index_path = os.path.join(SITES_PATH, identifier)
+    return _load_site_index_chain(identifier, utils.index_version(index_path))
+
+
+@st.cache_resource(max_entries=MAX_CACHED_SITES)
+def _load_site_index_chain(identifier, version):
+    knowledge_base = FAISS.load_local(
+        folder_path=os.path.join(SITES_PATH, identifier), embeddings=_embeddings()
+    )
+    return _create_chain(knowledge_base)
+
+
 def run(qa_chain, question):
-    llm_response = qa_chain(question)
+    with metrics.span("ask_site.llm"):
+        llm_response = qa_chain(question)
     answer, sources = _clean_llm_response(llm_response)
     return answer, set(sources)
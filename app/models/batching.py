@@ -0,0 +1,118 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+
+MAX_BATCH_SIZE = 16
+MAX_WAIT_MS = 5.0
+
+
+class MicroBatcher:
+    """
+    Group items submitted by concurrent callers into batches.
+
+    A single worker thread waits for the first pending item, keeps collecting items
+    until `max_batch_size` is reached or `max_wait_ms` milliseconds have passed,
+    then calls `process_fn` once with the whole batch. `process_fn` must return one
+    result per item, in the same order, and every caller gets back only the results
+    of the items it submitted. The items still queued when the batcher is closed
+    fail with a `RuntimeError`.
+    """
+
+    def __init__(
+        self,
+        process_fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_wait_ms: float = MAX_WAIT_MS,
+    ):
+        self.process_fn = process_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: "queue.Queue" = queue.Queue()
+        self._histogram: Counter = Counter()
+        self._stats_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._worker = threading.Thread(target=self._loop, daemon=True)
+        self._worker.start()
+
+    def submit(self, items: List[Any]) -> List[Any]:
+        """Queue the items, block until their batch is processed and return results."""
+        if self._closed.is_set():
+            raise RuntimeError("The batcher is closed")
+        futures = list()
+        for item in items:
+            future = Future()
+            self._queue.put((item, future))
+            futures.append(future)
+        if self._closed.is_set():
+            # closed while queueing, the worker may already be gone
+            self._fail_pending()
+        return [future.result() for future in futures]
+
+    def _collect(self) -> list:
+        try:
+            batch = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self) -> None:
+        while not self._closed.is_set():
+            batch = self._collect()
+            if not batch:
+                continue
+            items = [item for item, _ in batch]
+            with self._stats_lock:
+                self._histogram[len(batch)] += 1
+            try:
+                results = list(self.process_fn(items))
+                if len(results) != len(batch):
+                    raise RuntimeError(
+                        f"process_fn returned {len(results)} results "
+                        f"for {len(batch)} items"
+                    )
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def _fail_pending(self) -> None:
+        while True:
+            try:
+                _, future = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            future.set_exception(RuntimeError("The batcher is closed"))
+
+    def stats(self) -> Dict[str, Any]:
+        """Return the queue depth and the histogram of processed batch sizes."""
+        with self._stats_lock:
+            histogram = dict(sorted(self._histogram.items()))
+        batches = sum(histogram.values())
+        items = sum(size * count for size, count in histogram.items())
+        return {
+            "queue_depth": self._queue.qsize(),
+            "batches": batches,
+            "items": items,
+            "mean_batch_size": items / batches if batches else 0.0,
+            "batch_size_histogram": histogram,
+        }
+
+    def close(self) -> None:
+        self._closed.set()
+        self._worker.join()
+        self._fail_pending()
@@ -0,0 +1,222 @@
+import bisect
+import hashlib
+import itertools
+import re
+from typing import Any, List, Optional, Sequence, Tuple
+
+from langchain.docstore.document import Document
+
+
+TARGET_TOKENS = 384
+OVERLAP_TOKENS = 32
+# boundaries are searched in the last quarter of the chunk, in this order
+BOUNDARY_PATTERNS = (
+    re.compile(r"\n\s*\n"),
+    re.compile(r"\n"),
+    re.compile(r"[.!?](?=\s)"),
+    re.compile(r"[,;:](?=\s)"),
+)
+
+
+def chunk_id(text: str) -> str:
+    """Content hash used to identify a chunk, for instance in the encoding cache."""
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class HFTokenizerAdapter:
+    """Token ids and character offsets from a Hugging Face fast tokenizer."""
+
+    def __init__(self, tokenizer: Any):
+        self.tokenizer = tokenizer
+
+    def encode(self, text: str) -> Tuple[List[int], List[Tuple[int, int]]]:
+        return self.encode_batch([text])[0]
+
+    def encode_batch(
+        self, texts: List[str]
+    ) -> List[Tuple[List[int], List[Tuple[int, int]]]]:
+        encoding = self.tokenizer(
+            texts,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False,
+            verbose=False,
+        )
+        return list(zip(encoding["input_ids"], encoding["offset_mapping"]))
+
+
+class TiktokenAdapter:
+    """Token ids and character offsets from a tiktoken encoding."""
+
+    def __init__(self, encoding: Any):
+        self.encoding = encoding
+
+    def encode(self, text: str) -> Tuple[List[int], List[Tuple[int, int]]]:
+        ids = self.encoding.encode(text, disallowed_special=())
+        # tokens are byte sequences, map the byte positions back to characters
+        char_of_byte = list()
+        for position, char in enumerate(text):
+            char_of_byte.extend([position] * len(char.encode("utf-8")))
+        char_of_byte.append(len(text))
+
+        offsets, byte_position = list(), 0
+        for token in ids:
+            size = len(self.encoding.decode_single_token_bytes(token))
+            start = char_of_byte[byte_position]
+            byte_position += size
+            offsets.append((start, char_of_byte[byte_position]))
+        return ids, offsets
+
+    def encode_batch(
+        self, texts: List[str]
+    ) -> List[Tuple[List[int], List[Tuple[int, int]]]]:
+        return [self.encode(text) for text in texts]
+
+
+class TokenChunker:
+    """
+    Split texts in chunks of about `target_tokens` tokens in a single pass.
+
+    The text is tokenized once; chunk borders are then chosen on the token offsets,
+    preferring a paragraph, line, sentence or clause boundary near the end of each
+    window, so no chunk is re-tokenized to measure it. Each chunk keeps its
+    character offsets (`start_index`, `end_index`), its token count and a content
+    hash (`chunk_id`). `split_documents` can also return the encoding of each
+    chunk, to be cached instead of being tokenized at query time; it is computed
+    on the chunk text alone, like the query-time fallback, because SentencePiece
+    tokenizes the start of a chunk differently inside its document.
+
+    Args:
+        tokenizer: A `HFTokenizerAdapter` or `TiktokenAdapter`.
+        target_tokens (int, optional): Maximum number of tokens of a chunk.
+        overlap_tokens (int, optional): Tokens repeated between two chunks.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Any,
+        target_tokens: int = TARGET_TOKENS,
+        overlap_tokens: int = OVERLAP_TOKENS,
+    ):
+        if overlap_tokens >= target_tokens:
+            raise ValueError("overlap_tokens must be smaller than target_tokens")
+        self.tokenizer = tokenizer
+        self.target_tokens = target_tokens
+        self.overlap_tokens = overlap_tokens
+
+    def _boundary(
+        self, text: str, offsets: Sequence, ends: Sequence, start: int, stop: int
+    ) -> int:
+        """Return the token index that ends the chunk started at token `start`."""
+        if stop >= len(offsets):
+            return len(offsets)
+        window_start = start + (stop - start) * 3 // 4
+        char_start, char_stop = offsets[window_start][0], offsets[stop][0]
+        if char_stop <= char_start:
+            return stop
+        for pattern in BOUNDARY_PATTERNS:
+            matches = list(pattern.finditer(text, char_start, char_stop))
+            if matches:
+                # the chunk takes the tokens that end before the boundary
+                position = matches[-1].end()
+                return min(max(bisect.bisect_right(ends, position), start + 1), stop)
+        return stop
+
+    def split_text(
+        self, text: str
+    ) -> List[Tuple[str, int, int, List[int], List[Tuple[int, int]]]]:
+        """
+        Split a text.
+
+        Returns:
+            List: For each chunk, its text, its start and end character offsets,
+            and its token ids and offsets (relative to the chunk text).
+        """
+        ids, offsets = self.tokenizer.encode(text)
+        # special and merged tokens can end before the previous token, keep the
+        # ends sorted for the bisection in `_boundary`
+        ends = list(itertools.accumulate((end for _, end in offsets), max))
+        chunks, start = list(), 0
+        while start < len(ids):
+            stop = self._boundary(
+                text, offsets, ends, start, start + self.target_tokens
+            )
+            char_start, char_end = offsets[start][0], offsets[stop - 1][1]
+            chunk_offsets = [
+                (begin - char_start, end - char_start)
+                for begin, end in offsets[start:stop]
+            ]
+            chunks.append(
+                (
+                    text[char_start:char_end],
+                    char_start,
+                    char_end,
+                    list(ids[start:stop]),
+                    chunk_offsets,
+                )
+            )
+            if stop >= len(ids):
+                break
+            start = max(stop - self.overlap_tokens, start + 1)
+        return chunks
+
+    def split_documents(
+        self, documents: List[Document], encodings: Optional[dict] = None
+    ) -> List[Document]:
+        """
+        Split documents into chunks with their offsets in the metadata.
+
+        Args:
+            documents (List[Document]): The documents to split.
+            encodings (dict, optional): If given, it is filled with the token ids
+                and offsets of every chunk, keyed by `chunk_id`, tokenized on the
+                chunk text alone.
+
+        Returns:
+            List[Document]: The chunks.
+        """
+        chunks = list()
+        for document in documents:
+            for text, start, end, ids, _ in self.split_text(document.page_content):
+                identifier = chunk_id(text)
+                metadata = {
+                    **document.metadata,
+                    "start_index": start,
+                    "end_index": end,
+                    "n_tokens": len(ids),
+                    "chunk_id": identifier,
+                }
+                chunks.append(Document(page_content=text, metadata=metadata))
+        if encodings is not None:
+            texts = [chunk.page_content for chunk in chunks]
+            for chunk, encoding in zip(chunks, self.tokenizer.encode_batch(texts)):
+                encodings[chunk.metadata["chunk_id"]] = encoding
+        return chunks
+
+
+_chunkers = dict()
+
+
+def get_chunker(
+    tokenizer_name: str,
+    target_tokens: int = TARGET_TOKENS,
+    overlap_tokens: int = OVERLAP_TOKENS,
+) -> TokenChunker:
+    """
+    Return a chunker for a Hugging Face tokenizer name or for "tiktoken".
+
+    The tokenizers are loaded once per name.
+    """
+    if tokenizer_name not in _chunkers:
+        if tokenizer_name == "tiktoken":
+            import tiktoken
+
+            tokenizer = TiktokenAdapter(tiktoken.get_encoding("cl100k_base"))
+        else:
+            from transformers import AutoTokenizer
+
+            tokenizer = HFTokenizerAdapter(
+                AutoTokenizer.from_pretrained(tokenizer_name, use_fast=True)
+            )
+        _chunkers[tokenizer_name] = tokenizer
+    return TokenChunker(_chunkers[tokenizer_name], target_tokens, overlap_tokens)
@@ -0,0 +1,200 @@
+import logging
+import re
+from typing import Iterable, List, Set, Tuple
+
+import tiktoken
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+from langchain.docstore.document import Document
+from langchain.schema import BaseRetriever
+
+from app.models import metrics
+
+
+MODEL_NAME = "gpt-3.5-turbo"
+MAX_CONTEXT_TOKENS = 2500
+FETCH_K = 12
+DUPLICATE_THRESHOLD = 0.8
+MIN_OVERLAP = 40
+SHINGLE_SIZE = 3
+
+WORD_PATTERN = re.compile(r"\w+")
+
+logger = logging.getLogger(__name__)
+
+
+class _Encoder:
+    _encodings = dict()
+
+    @classmethod
+    def get(cls, model_name: str) -> tiktoken.Encoding:
+        if model_name not in cls._encodings:
+            try:
+                encoding = tiktoken.encoding_for_model(model_name)
+            except KeyError:
+                encoding = tiktoken.get_encoding("cl100k_base")
+            cls._encodings[model_name] = encoding
+        return cls._encodings[model_name]
+
+
+def count_tokens(text: str, model_name: str = MODEL_NAME) -> int:
+    return len(_Encoder.get(model_name).encode(text))
+
+
+def truncate_tokens(text: str, max_tokens: int, model_name: str = MODEL_NAME) -> str:
+    """Keep the last `max_tokens` tokens of a text."""
+    encoding = _Encoder.get(model_name)
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[-max_tokens:])
+
+
+def _shingles(text: str) -> Set[Tuple[str, ...]]:
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) < SHINGLE_SIZE:
+        return {tuple(words)}
+    return {
+        tuple(words[i : i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)
+    }
+
+
+def _jaccard(first: Set[Tuple[str, ...]], second: Set[Tuple[str, ...]]) -> float:
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+
+def _overlap(first: str, second: str) -> int:
+    """Length of the longest prefix of `second` that `first` ends with, in O(n)."""
+    size = min(len(first), len(second)) - 1
+    if size < MIN_OVERLAP:
+        return 0
+    # prefix function of `second[:size]`, a separator and `first[-size:]`
+    text = list(second[:size]) + [None] + list(first[-size:])
+    prefix = [0] * len(text)
+    for i in range(1, len(text)):
+        j = prefix[i - 1]
+        while j and text[i] != text[j]:
+            j = prefix[j - 1]
+        if text[i] == text[j]:
+            j += 1
+        prefix[i] = j
+    return prefix[-1]
+
+
+def _strip_overlap(content: str, kept_contents: Iterable[str]) -> str:
+    """Remove a prefix/suffix that repeats the border of an already kept chunk."""
+    for kept in kept_contents:
+        head, tail = _overlap(kept, content), _overlap(content, kept)
+        if head >= MIN_OVERLAP and head >= tail:
+            content = content[head:]
+        elif tail >= MIN_OVERLAP:
+            content = content[:-tail]
+    return content.strip()
+
+
+def pack_documents(
+    docs_and_scores: List[Tuple[Document, float]],
+    max_tokens: int = MAX_CONTEXT_TOKENS,
+    model_name: str = MODEL_NAME,
+    duplicate_threshold: float = DUPLICATE_THRESHOLD,
+) -> Tuple[List[Document], int]:
+    """
+    Select the retrieved chunks that fit in the prompt token budget.
+
+    The chunks are sorted by their FAISS distance (lower is more similar), chunks
+    that are near-duplicates of an already selected chunk are dropped, the text
+    shared with a neighbour chunk (the splitter overlap) is removed, and chunks are
+    added until `max_tokens` is reached. The last chunk that does not fit is
+    truncated to the remaining budget.
+
+    Args:
+        docs_and_scores (List[Tuple[Document, float]]): Output of
+            `similarity_search_with_score`.
+        max_tokens (int, optional): Token budget for the whole context.
+        model_name (str, optional): Model used to pick the tiktoken encoding.
+        duplicate_threshold (float, optional): Jaccard similarity of word shingles
+            above which a chunk is considered a duplicate.
+
+    Returns:
+        Tuple[List[Document], int]: The packed documents, in score order, and the
+        number of tokens they use.
+    """
+    encoding = _Encoder.get(model_name)
+    ranked = sorted(docs_and_scores, key=lambda doc_score: doc_score[1])
+
+    packed, kept_shingles, kept_contents = [], [], []
+    used_tokens = 0
+    for doc, score in ranked:
+        if used_tokens >= max_tokens:
+            break
+        shingles = _shingles(doc.page_content)
+        if any(
+            _jaccard(shingles, kept) >= duplicate_threshold for kept in kept_shingles
+        ):
+            continue
+
+        content = _strip_overlap(doc.page_content, kept_contents)
+        if not content:
+            continue
+        tokens = encoding.encode(content)
+        if used_tokens + len(tokens) > max_tokens:
+            tokens = tokens[: max(max_tokens - used_tokens, 0)]
+            content = encoding.decode(tokens)
+
+        kept_shingles.append(shingles)
+        kept_contents.append(doc.page_content)
+        used_tokens += len(tokens)
+        packed.append(
+            Document(
+                page_content=content,
+                metadata={**doc.metadata, "score": float(score)},
+            )
+        )
+    return packed, used_tokens
+
+
+class BudgetRetriever(BaseRetriever):
+    """
+    Retriever that packs the chunks of a vector store into a token budget.
+
+    It is meant to be used with the "stuff" chains, which put every retrieved
+    document into the prompt. `max_tokens` covers the whole prompt: the tokens of
+    the query and of `prompt_template` are taken from the budget before packing.
+    """
+
+    vectorstore: object
+    k: int = FETCH_K
+    max_tokens: int = MAX_CONTEXT_TOKENS
+    model_name: str = MODEL_NAME
+    prompt_template: str = ""
+
+    class Config:
+        arbitrary_types_allowed = True
+
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        with metrics.span("retriever.similarity_search"):
+            docs_and_scores = self.vectorstore.similarity_search_with_score(
+                query, k=self.k
+            )
+        with metrics.span("retriever.pack"):
+            fixed_tokens = count_tokens(query, self.model_name) + count_tokens(
+                self.prompt_template, self.model_name
+            )
+            docs, used_tokens = pack_documents(
+                docs_and_scores,
+                max_tokens=max(self.max_tokens - fixed_tokens, 0),
+                model_name=self.model_name,
+            )
+        prompt_tokens = used_tokens + fixed_tokens
+        metrics.count("prompt_context_tokens", prompt_tokens)
+        logger.info(
+            "Packed %d of %d chunks, %d prompt tokens (budget %d)",
+            len(docs),
+            len(docs_and_scores),
+            prompt_tokens,
+            self.max_tokens,
+        )
+        return docs
@@ -0,0 +1,240 @@
+import logging
+import os
+from typing import Callable, Dict, List, Optional
+
+from app.models import metrics
+
+
+# the model of the main page, its tokenizer counts the history tokens
+MODEL_NAME = "gpt-3.5-turbo"
+# number of messages shown on each rerun, older ones stay stored but hidden
+RENDER_WINDOW = int(os.environ.get("CHAT_RENDER_WINDOW", 20))
+# messages kept per session, the oldest are dropped past it
+MAX_STORED_MESSAGES = int(os.environ.get("CHAT_MAX_STORED_MESSAGES", 200))
+# history sent with each ChatCompletion call, summary included
+MAX_HISTORY_TOKENS = int(os.environ.get("CHAT_MAX_HISTORY_TOKENS", 2000))
+# role, separators and priming tokens added by the chat format to every message
+MESSAGE_OVERHEAD_TOKENS = 4
+SUMMARY_MAX_TOKENS = 300
+# older messages sent to the summarizer in one call
+SUMMARY_INPUT_TOKENS = 3000
+PROMPT_ROLES = {"system", "user", "assistant"}
+SUMMARY_PROMPT = (
+    "You keep a running summary of a conversation between a user and an assistant. "
+    "Update the summary with the new messages. Keep the facts, names, numbers and "
+    "open questions, drop the small talk, and answer with the summary only, in at "
+    f"most {SUMMARY_MAX_TOKENS // 2} words."
+)
+
+logger = logging.getLogger(__name__)
+
+Summarizer = Callable[[str, List[Dict[str, str]]], str]
+
+
+class Message:
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role: str, content: str) -> None:
+        self.role = role
+        self.content = content
+        self.tokens: Optional[int] = None
+
+
+class ConversationMemory:
+    """
+    The chat history of a session, bounded in memory and in the prompt.
+
+    Only the role and text of each message are stored, at most `max_stored` of
+    them. `window` gives the messages to render and `prompt_messages` the history
+    to send to the LLM: the latest messages that fit the token budget, with the
+    older ones folded into a running summary. Messages dropped from storage before
+    they were summarized are kept aside, at most `max_stored` of them, and folded
+    into the summary by the next `prompt_messages` call.
+    """
+
+    def __init__(self, max_stored: int = MAX_STORED_MESSAGES) -> None:
+        self.messages: List[Message] = list()
+        self.max_stored = max_stored
+        self.summary = ""
+        self.dropped = 0
+        # messages at the start of `messages` already folded into `summary`
+        self._summarized = 0
+        # messages dropped from `messages` before they were folded
+        self._evicted: List[Message] = list()
+
+    def add(self, role: str, content: str) -> None:
+        self.messages.append(Message(role, str(content)))
+        extra = len(self.messages) - self.max_stored
+        if extra > 0:
+            self._evicted.extend(self.messages[self._summarized : extra])
+            del self._evicted[: -self.max_stored or None]
+            del self.messages[:extra]
+            self.dropped += extra
+            self._summarized = max(self._summarized - extra, 0)
+
+    def window(self, size: int = RENDER_WINDOW) -> List[Message]:
+        return self.messages[-size:] if size > 0 else []
+
+    def hidden(self, size: int = RENDER_WINDOW) -> int:
+        """Number of messages of the session not shown by `window`."""
+        return self.dropped + len(self.messages) - len(self.window(size))
+
+    def _tokens(self, message: Message, model_name: str) -> int:
+        # tiktoken and langchain are imported on the first LLM call, not by the
+        # pages that only render the history
+        from app.models.context_budget import count_tokens
+
+        if message.tokens is None:
+            message.tokens = (
+                count_tokens(message.content, model_name) + MESSAGE_OVERHEAD_TOKENS
+            )
+        return message.tokens
+
+    def _summary_message(self) -> List[Dict[str, str]]:
+        if not self.summary:
+            return []
+        content = f"Summary of the earlier conversation: {self.summary}"
+        return [{"role": "system", "content": content}]
+
+    def _first_fitting(self, budget: int, model_name: str) -> int:
+        # index of the oldest message of the longest recent run within `budget`,
+        # the last message is always kept
+        start = len(self.messages) - 1
+        used = self._tokens(self.messages[start], model_name) if self.messages else 0
+        while start > self._summarized:
+            tokens = self._tokens(self.messages[start - 1], model_name)
+            if used + tokens > budget:
+                break
+            used += tokens
+            start -= 1
+        return max(start, self._summarized)
+
+    def _fold(self, end: int, summarize: Summarizer, model_name: str) -> None:
+        from app.models.context_budget import truncate_tokens
+
+        messages = [
+            {
+                "role": message.role,
+                "content": truncate_tokens(
+                    message.content, SUMMARY_INPUT_TOKENS, model_name
+                ),
+            }
+            for message in self._evicted + self.messages[self._summarized : end]
+        ]
+        with metrics.span("conversation.summarize"):
+            try:
+                summary = summarize(self.summary, messages)
+            except Exception:
+                logger.warning("Summarizing the history failed", exc_info=True)
+                return
+        self.summary = truncate_tokens(summary, SUMMARY_MAX_TOKENS, model_name)
+        self._summarized = end
+        self._evicted.clear()
+        metrics.count("conversation_summarized_messages", len(messages))
+
+    def prompt_messages(
+        self,
+        system: Optional[str] = None,
+        max_tokens: int = MAX_HISTORY_TOKENS,
+        model_name: str = MODEL_NAME,
+        summarize: Optional[Summarizer] = None,
+    ) -> List[Dict[str, str]]:
+        """
+        Build the history to send to a chat model within a token budget.
+
+        The latest messages are sent whole. When older messages no longer fit they
+        are folded into the running summary by `summarize`, together with enough
+        recent ones to bring the history down to half of `max_tokens`, so the next
+        turns can be sent without another summary call. The messages dropped from
+        storage since the last summary are folded too. Without `summarize`, or if
+        it fails, the older messages are left out. Roles the chat API does not
+        know, like the model names of the QA pages, are sent as "assistant".
+
+        Args:
+            system (str, optional): System prompt placed before the history.
+            max_tokens (int, optional): Budget of the summary and the messages.
+            model_name (str, optional): Model whose tokenizer counts the tokens.
+            summarize (Summarizer, optional): Called with the current summary and
+                the messages to fold, returns the new summary.
+
+        Returns:
+            List[Dict[str, str]]: The messages for `openai.ChatCompletion.create`.
+        """
+
+        from app.models.context_budget import count_tokens
+
+        def budget() -> int:
+            return max_tokens - sum(
+                count_tokens(message["content"], model_name) + MESSAGE_OVERHEAD_TOKENS
+                for message in self._summary_message()
+            )
+
+        start = self._first_fitting(budget(), model_name)
+        if summarize and (start > self._summarized or self._evicted):
+            end = self._first_fitting(budget() // 2, model_name)
+            self._fold(end, summarize, model_name)
+            start = self._first_fitting(budget(), model_name)
+        metrics.count(
+            "conversation_omitted_messages",
+            start - self._summarized + len(self._evicted),
+        )
+
+        messages = [{"role": "system", "content": system}] if system else []
+        messages.extend(self._summary_message())
+        messages.extend(
+            {
+                "role": message.role if message.role in PROMPT_ROLES else "assistant",
+                "content": message.content,
+            }
+            for message in self.messages[start:]
+        )
+        return messages
+
+
+def summarize_with_openai(
+    summary: str, messages: List[Dict[str, str]], model_name: str = MODEL_NAME
+) -> str:
+    """Update a conversation summary with new messages using a ChatCompletion call."""
+    import openai
+
+    transcript = "\n".join(
+        f"{message['role']}: {message['content']}" for message in messages
+    )
+    response = openai.ChatCompletion.create(
+        model=model_name,
+        messages=[
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {
+                "role": "user",
+                "content": f"Summary so far:\n{summary or '(empty)'}\n\n"
+                f"New messages:\n{transcript}",
+            },
+        ],
+        max_tokens=SUMMARY_MAX_TOKENS,
+        temperature=0,
+    )
+    return response.choices[0].message.content.strip()
+
+
+def session_memory(
+    key: str, greeting: str, role: str = "assistant"
+) -> ConversationMemory:
+    """Get the `ConversationMemory` stored under `key` in the Streamlit session."""
+    import streamlit as st
+
+    if key not in st.session_state:
+        memory = ConversationMemory()
+        memory.add(role, greeting)
+        st.session_state[key] = memory
+    return st.session_state[key]
+
+
+def render_history(memory: ConversationMemory, size: int = RENDER_WINDOW) -> None:
+    """Render the latest `size` messages of a conversation in Streamlit."""
+    import streamlit as st
+
+    hidden = memory.hidden(size)
+    if hidden:
+        st.caption(f"{hidden} earlier messages are not shown.")
+    for message in memory.window(size):
+        st.chat_message(message.role).write(message.content)
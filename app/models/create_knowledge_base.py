@@ -1,13 +1,17 @@
-from app.models import utils
+from app.models import metrics, sharded_index, utils
+from app.models.chunking import get_chunker
+from app.models.encoding_cache import passage_cache
 import os
+import uuid
 
-from langchain.document_loaders import DirectoryLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.document_loaders import DirectoryLoader, TextLoader
 from langchain.vectorstores import FAISS
 
 
-CHUNK_SIZE = 1000
-CHUNK_OVERLAP = 150
+# in tokens of the tokenizer of the model that reads the chunks
+CHUNK_SIZE = 400
+CHUNK_OVERLAP = 32
+OPENAI_CHUNK_SIZE = 256
 DATA_PATH = utils.DATA_PATH
 
 
@@ -24,42 +28,121 @@ def _check_index_existence(index_path):
     return existent_index
 
 
-def _split_text():
-    loader = DirectoryLoader(DATA_PATH, glob="*.txt")
-    documents = loader.load()
+def _add_page_numbers(chunks):
+    page_starts = dict()
+    for chunk in chunks:
+        source = chunk.metadata["source"]
+        if source not in page_starts:
+            page_starts[source] = utils.load_page_offsets(source)
+        if page_starts[source]:
+            chunk.metadata["page"] = utils.page_for_offset(
+                page_starts[source], chunk.metadata["start_index"]
+            )
+    return chunks
+
+
+def _get_chunker(embedding_name):
+    if embedding_name.lower() == "openai":
+        return get_chunker("tiktoken", OPENAI_CHUNK_SIZE, CHUNK_OVERLAP)
+    return get_chunker(utils.READER_MODEL, CHUNK_SIZE, CHUNK_OVERLAP)
+
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        separators=["\n\n", "\n", ","],
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP,
-        length_function=len,
+def _split_text(embedding_name="huggingf", data_path=None):
+    loader = DirectoryLoader(
+        data_path or DATA_PATH,
+        glob="*.txt",
+        loader_cls=TextLoader,
+        loader_kwargs={"encoding": "utf-8"},
     )
-    chunks = text_splitter.split_documents(documents)
-    return chunks
+    with metrics.span("knowledge_base.load"):
+        documents = loader.load()
+    metrics.count(
+        "knowledge_base_bytes",
+        lambda: sum(len(doc.page_content) for doc in documents),
+    )
+
+    chunker = _get_chunker(embedding_name)
+    encodings = dict()
+    with metrics.span("knowledge_base.split"):
+        chunks = chunker.split_documents(documents, encodings=encodings)
+    if embedding_name.lower() != "openai":
+        # the chunks were tokenized with the reader tokenizer, keep them for mDeBERTa
+        passage_cache.update(encodings)
+    metrics.count("knowledge_base_chunks", len(chunks))
+    return _add_page_numbers(chunks)
 
 
-def create_index(embedding_name="huggingf"):
-    index_path, embeddings = utils.setup_for_embeddings(
+def create_index(embedding_name="huggingf", data_path=None, index_path=None):
+    default_index_path, embeddings = utils.setup_for_embeddings(
         embedding_name,
         return_embeddings=True,
     )
+    index_path = index_path or default_index_path
+
+    if sharded_index.is_sharded(index_path):
+        chunks = _split_text(embedding_name, data_path)
+        sharded_index.add_documents(index_path, chunks, embeddings)
+        utils.write_embedding_scheme(index_path, embeddings)
+        sharded_index.start_compaction(index_path, embeddings)
+        return None
 
     old_index_name = _check_index_existence(index_path)
-    chunks = _split_text()
-    new_index = FAISS.from_documents(chunks, embeddings)
+    chunks = _split_text(embedding_name, data_path)
+    with metrics.span(f"knowledge_base.embed.{embedding_name}"):
+        new_index = FAISS.from_documents(chunks, embeddings)
     if old_index_name:
-        old_index = FAISS.load_local(
-            folder_path=index_path,
-            embeddings=embeddings,
-        )
-        old_index.merge_from(new_index)
-        old_index.save_local(
-            folder_path=index_path,
-        )
+        with metrics.span("knowledge_base.merge"):
+            old_index = FAISS.load_local(
+                folder_path=index_path,
+                embeddings=embeddings,
+            )
+            old_index.merge_from(new_index)
+            old_index.save_local(
+                folder_path=index_path,
+            )
+        utils.write_embedding_scheme(index_path, embeddings)
         return
     new_index.save_local(index_path)
+    utils.write_embedding_scheme(index_path, embeddings)
     return None
 
 
+def reembed_index(index_path=None):
+    """
+    Embed the chunks of a local embeddings index again with the current scheme.
+
+    Indexes built with plain `HuggingFaceEmbeddings` are still searched without the
+    e5 prefixes (see `utils.setup_for_embeddings`); this rebuilds the index from the
+    chunks stored in it, with the prefixes, and swaps it in once complete. Stop the
+    writers of the index (uploads, jobs) while it runs.
+    """
+    index_path = index_path or utils.HF_INDEX_PATH
+    embeddings = utils.load_local_embeddings()
+    old_embeddings = embeddings
+    if utils.index_embedding_scheme(index_path) == utils.PLAIN_EMBEDDING_SCHEME:
+        old_embeddings = embeddings.with_prefixes("", "")
+    if sharded_index.is_sharded(index_path):
+        old_index = sharded_index.load_sharded_index(index_path, old_embeddings)
+        stores = old_index.shards
+        max_vectors = sharded_index.load_manifest(index_path)["max_vectors"]
+    else:
+        stores = [FAISS.load_local(folder_path=index_path, embeddings=old_embeddings)]
+        max_vectors = None
+    chunks = [
+        store.docstore.search(doc_id)
+        for store in stores
+        for doc_id in store.index_to_docstore_id.values()
+    ]
+
+    staging_path = f"{index_path}.{uuid.uuid4().hex[:8]}"
+    with metrics.span("knowledge_base.reembed"):
+        FAISS.from_documents(chunks, embeddings).save_local(staging_path)
+    if max_vectors:
+        sharded_index.migrate(staging_path, embeddings, max_vectors)
+    utils.write_embedding_scheme(staging_path, embeddings)
+    utils.replace_directory(staging_path, index_path)
+    return len(chunks)
+
+
 if __name__ == "__main__":
     create_index()
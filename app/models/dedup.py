@@ -0,0 +1,156 @@
+import hashlib
+import re
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import numpy as np
+from langchain.docstore.document import Document
+
+
+SHINGLE_SIZE = 3
+MINHASH_PERMUTATIONS = 128
+# pages sharing this fraction of their word shingles (Jaccard similarity) are
+# near-duplicates; the same page with another date, menu or footer stays above it
+MIN_SIMILARITY = 0.8
+# 32 bands of 4 rows make pages above about 0.6 similarity candidates of each other,
+# the candidates are then compared on the whole signature
+BANDS = 32
+MERSENNE_PRIME = (1 << 61) - 1
+_rng = np.random.default_rng(42)
+_PERMUTATIONS = (
+    _rng.integers(1, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64),
+    _rng.integers(0, 1 << 32, MINHASH_PERMUTATIONS, dtype=np.uint64),
+)
+IGNORED_PARAMS = {"fbclid", "gclid", "msclkid", "ref", "print", "sessionid", "sid"}
+IGNORED_PREFIXES = ("utm_",)
+DEFAULT_PORTS = {"http": 80, "https": 443}
+INDEX_PAGE_PATTERN = re.compile(r"/(index|default)\.(html?|php|aspx?)$")
+WORD_PATTERN = re.compile(r"\w+")
+
+
+def canonicalize_url(url: str) -> str:
+    """
+    Normalize the parts of a url that do not change the page it points to.
+
+    The scheme and host are lower-cased, default ports, fragments, tracking and
+    print parameters, index file names and trailing slashes are removed, and the
+    remaining query parameters are sorted.
+    """
+    parts = urlsplit(url.strip())
+    scheme, host = parts.scheme.lower(), (parts.hostname or "").lower()
+    netloc = host
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{host}:{parts.port}"
+    path = INDEX_PAGE_PATTERN.sub("/", parts.path)
+    path = path.rstrip("/") or "/"
+    query = urlencode(
+        sorted(
+            (key, value)
+            for key, value in parse_qsl(parts.query, keep_blank_values=True)
+            if key.lower() not in IGNORED_PARAMS
+            and not key.lower().startswith(IGNORED_PREFIXES)
+        )
+    )
+    return urlunsplit((scheme, netloc, path, query, ""))
+
+
+def minhash(text: str) -> np.ndarray:
+    """MinHash signature of the word shingles of a normalized text."""
+    words = text.split()
+    shingles = {
+        " ".join(words[i : i + SHINGLE_SIZE])
+        for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))
+    }
+    hashes = np.array(
+        [
+            int.from_bytes(hashlib.blake2b(s.encode(), digest_size=4).digest(), "big")
+            for s in shingles
+        ],
+        dtype=np.uint64,
+    )
+    # the products stay below 2**64, the hashes and multipliers have 32 bits
+    a, b = _PERMUTATIONS
+    permuted = (hashes[:, None] * a + b) % MERSENNE_PRIME
+    return permuted.min(axis=0)
+
+
+def _bands(signature: np.ndarray) -> List[Tuple[int, bytes]]:
+    return [
+        (band, rows.tobytes()) for band, rows in enumerate(np.split(signature, BANDS))
+    ]
+
+
+def _normalize_text(text: str) -> str:
+    return " ".join(WORD_PATTERN.findall(text.lower()))
+
+
+def deduplicate_documents(
+    documents: List[Document],
+    canonical_urls: Optional[Dict[str, str]] = None,
+    min_similarity: float = MIN_SIMILARITY,
+) -> Tuple[List[Document], Dict[str, int]]:
+    """
+    Drop the pages that repeat a page already kept.
+
+    A page is dropped when its canonical url (from `canonical_urls`, the
+    `<link rel=canonical>` found by the crawler, or `canonicalize_url`) was already
+    seen, when its text is identical to a kept page once case and punctuation are
+    ignored, or when the MinHash signatures estimate that it shares at least
+    `min_similarity` of its word shingles with a kept page.
+
+    Args:
+        documents (List[Document]): The pages, with their url as "source".
+        canonical_urls (Dict[str, str], optional): Canonical url of the crawled
+            urls.
+        min_similarity (float, optional): Jaccard similarity of near-duplicates.
+
+    Returns:
+        Tuple[List[Document], Dict[str, int]]: The kept pages and how many pages and
+        characters were removed by each check.
+    """
+    canonical_urls = canonical_urls or dict()
+    seen_urls, seen_texts = set(), set()
+    buckets: Dict[Tuple[int, bytes], List[int]] = dict()
+    signatures: List[np.ndarray] = list()
+    kept = list()
+    stats = {
+        "pages": len(documents),
+        "canonical_duplicates": 0,
+        "exact_duplicates": 0,
+        "near_duplicates": 0,
+        "removed_chars": 0,
+    }
+    for document in documents:
+        source = canonicalize_url(document.metadata.get("source", ""))
+        url = canonical_urls.get(source, source)
+        if url in seen_urls:
+            stats["canonical_duplicates"] += 1
+            stats["removed_chars"] += len(document.page_content)
+            continue
+
+        text = _normalize_text(document.page_content)
+        digest = hashlib.sha1(text.encode("utf-8")).digest()
+        if digest in seen_texts:
+            stats["exact_duplicates"] += 1
+            stats["removed_chars"] += len(document.page_content)
+            continue
+
+        signature = minhash(text)
+        bands = _bands(signature)
+        candidates = {other for band in bands for other in buckets.get(band, ())}
+        if any(
+            np.mean(signature == signatures[other]) >= min_similarity
+            for other in candidates
+        ):
+            stats["near_duplicates"] += 1
+            stats["removed_chars"] += len(document.page_content)
+            continue
+
+        seen_urls.add(url)
+        seen_texts.add(digest)
+        for band in bands:
+            buckets.setdefault(band, []).append(len(signatures))
+        signatures.append(signature)
+        kept.append(document)
+    stats["kept"] = len(kept)
+    return kept, stats
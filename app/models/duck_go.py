@@ -1,4 +1,4 @@
-from app.models import utils
+from app.models import metrics, utils
 
 from langchain.prompts import PromptTemplate
 from langchain.chat_models import ChatOpenAI
@@ -66,7 +66,9 @@ def _split_results(results):
 
 def _create_site_chunks(url, query=""):
     search = DuckDuckGoSearchResults()
-    results = search.run(f"site:{url} {query}")
+    with metrics.span("duck_go.search"):
+        results = search.run(f"site:{url} {query}")
+    metrics.count("duck_go_result_bytes", len(results))
     chunks = _split_results(results)
     return chunks
 
@@ -76,7 +78,8 @@ def _create_retriever(url, query):
     _, hf_embeddings = utils.setup_for_embeddings(
         embedding_model="huggingface", return_embeddings=True
     )
-    vector_store = FAISS.from_documents(chunks, embedding=hf_embeddings)
+    with metrics.span("duck_go.embed"):
+        vector_store = FAISS.from_documents(chunks, embedding=hf_embeddings)
     retriever = vector_store.as_retriever()
     return retriever
 
@@ -90,7 +93,8 @@ def _get_site_language(url):
     for chunk in chunks:
         chunk.page_content = " ".join(chunk.page_content.split())
         chunk_content += chunk.page_content
-    return langdetect.detect(chunk_content)
+    with metrics.span("duck_go.langdetect"):
+        return langdetect.detect(chunk_content)
 
 
 def get_languages(url="", query=""):
@@ -132,12 +136,14 @@ def check_chain_language(chain, language):
 
 
 def translate_query(query, chain):
-    return chain.invoke({"query": query})
+    with metrics.span("duck_go.translate"):
+        return chain.invoke({"query": query})
 
 
 def run(url, query, chat_model, user_lang):
     retriever = _create_retriever(url, query)
     ask_site_chain = create_chain(chat_model, retriever)
 
-    answer = ask_site_chain.invoke({"question": query, "user_language": user_lang})
+    with metrics.span("duck_go.llm"):
+        answer = ask_site_chain.invoke({"question": query, "user_language": user_lang})
     return answer
@@ -0,0 +1,221 @@
+import hashlib
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+import requests
+from langchain.embeddings.base import Embeddings
+
+from app.models import metrics
+from app.models.context_budget import count_tokens
+
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+EMBEDDING_MODEL = "text-embedding-ada-002"
+MAX_BATCH_TOKENS = 8000
+MAX_BATCH_SIZE = 512
+MAX_CONCURRENCY = 4
+MAX_RETRIES = 6
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 60.0
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingRequestError(RuntimeError):
+    pass
+
+
+def _batch_key(batch: List[str]) -> str:
+    digest = hashlib.sha1()
+    for text in batch:
+        digest.update(text.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class BatchedOpenAIEmbeddings(Embeddings):
+    """
+    OpenAI embeddings client with token-sized batches and bounded concurrency.
+
+    Batches are filled up to `max_batch_tokens`, sent by up to `max_concurrency`
+    threads, and retried with exponential backoff and jitter on rate limits and
+    server errors. When `progress_path` is given, every finished batch is saved as
+    a float32 `.npy` file in a folder of `progress_path` named after the texts of
+    the run, so an interrupted run only embeds the missing batches when it is
+    started again, and runs over other texts never share a checkpoint. The folder
+    is removed once all the batches are done.
+
+    The endpoint is read from `api_base` or the `OPENAI_API_BASE` environment
+    variable, which makes it possible to point the client at a local stub server.
+    """
+
+    def __init__(
+        self,
+        model: str = EMBEDDING_MODEL,
+        api_key: Optional[str] = None,
+        api_base: Optional[str] = None,
+        max_batch_tokens: int = MAX_BATCH_TOKENS,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_concurrency: int = MAX_CONCURRENCY,
+        max_retries: int = MAX_RETRIES,
+        timeout: float = 60.0,
+        progress_path: Optional[str] = None,
+        progress_callback: Optional[Callable[[int, int], None]] = None,
+    ):
+        self.model = model
+        self.api_key = api_key
+        self.api_base = api_base
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.progress_path = progress_path
+        self.progress_callback = progress_callback
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _url(self) -> str:
+        api_base = self.api_base or os.environ.get("OPENAI_API_BASE", OPENAI_API_BASE)
+        return api_base.rstrip("/") + "/embeddings"
+
+    def _headers(self) -> Dict[str, str]:
+        api_key = self.api_key or os.environ.get("OPENAI_API_KEY", "")
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        }
+
+    def _backoff(self, attempt: int, response: Optional[requests.Response]) -> float:
+        if response is not None and response.headers.get("Retry-After"):
+            try:
+                return float(response.headers["Retry-After"])
+            except ValueError:
+                pass
+        delay = min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt)
+        return random.uniform(delay / 2, delay)
+
+    def _request(self, batch: List[str]) -> List[List[float]]:
+        for attempt in range(self.max_retries + 1):
+            response = None
+            metrics.count("openai_embedding_requests")
+            try:
+                response = self._session().post(
+                    self._url(),
+                    headers=self._headers(),
+                    json={"model": self.model, "input": batch},
+                    timeout=self.timeout,
+                )
+            except (requests.ConnectionError, requests.Timeout) as error:
+                logger.warning("Embedding request failed: %s", error)
+            else:
+                if response.status_code == 200:
+                    data = sorted(response.json()["data"], key=lambda d: d["index"])
+                    return [item["embedding"] for item in data]
+                if response.status_code not in RETRY_STATUS:
+                    raise EmbeddingRequestError(
+                        f"Embedding request failed with status "
+                        f"{response.status_code}: {response.text}"
+                    )
+            if attempt < self.max_retries:
+                metrics.count("openai_embedding_retries")
+                time.sleep(self._backoff(attempt, response))
+        raise EmbeddingRequestError(
+            f"Embedding request failed after {self.max_retries} retries"
+        )
+
+    def _make_batches(self, texts: List[str]) -> List[List[str]]:
+        batches, batch, batch_tokens = [], [], 0
+        for text in texts:
+            tokens = count_tokens(text, self.model)
+            metrics.count("openai_embedding_tokens", tokens)
+            if batch and (
+                batch_tokens + tokens > self.max_batch_tokens
+                or len(batch) >= self.max_batch_size
+            ):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(text)
+            batch_tokens += tokens
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _run_path(self, keys: List[str]) -> Optional[str]:
+        if not self.progress_path:
+            return None
+        return os.path.join(self.progress_path, _batch_key(keys)[:16])
+
+    def _load_progress(self, run_path: Optional[str]) -> Dict[str, List[List[float]]]:
+        done = dict()
+        if not run_path or not os.path.isdir(run_path):
+            return done
+        for name in os.listdir(run_path):
+            key, extension = os.path.splitext(name)
+            if extension == ".npy":
+                done[key] = np.load(os.path.join(run_path, name)).tolist()
+        return done
+
+    def _save_progress(
+        self, run_path: Optional[str], key: str, embeddings: List[List[float]]
+    ) -> None:
+        if not run_path:
+            return
+        os.makedirs(run_path, exist_ok=True)
+        # written aside and renamed, a crash never leaves a partial batch
+        temporary_path = os.path.join(run_path, f"{key}.tmp")
+        with open(temporary_path, "wb") as file:
+            np.save(file, np.asarray(embeddings, dtype=np.float32))
+        os.replace(temporary_path, os.path.join(run_path, f"{key}.npy"))
+
+    def _report(self, done: int, total: int) -> None:
+        logger.info("Embedded %d of %d batches", done, total)
+        if self.progress_callback:
+            self.progress_callback(done, total)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        batches = self._make_batches(texts)
+        keys = [_batch_key(batch) for batch in batches]
+        run_path = self._run_path(keys)
+        done = self._load_progress(run_path)
+        results = {key: done[key] for key in keys if key in done}
+        self._report(len(results), len(batches))
+
+        pending = [
+            (key, batch) for key, batch in zip(keys, batches) if key not in results
+        ]
+        executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            futures = {
+                executor.submit(self._request, batch): key for key, batch in pending
+            }
+            for future in as_completed(futures):
+                key = futures[future]
+                results[key] = future.result()
+                self._save_progress(run_path, key, results[key])
+                self._report(len(results), len(batches))
+        except BaseException:
+            # a failed or cancelled run (the progress callback raises when the job
+            # is cancelled) does not send the batches that have not started yet
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+
+        if run_path:
+            shutil.rmtree(run_path, ignore_errors=True)
+        return [embedding for key in keys for embedding in results[key]]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._request([text])[0]
@@ -0,0 +1,91 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Optional, Sequence, Tuple
+
+import numpy as np
+
+
+# memory taken by the cached passages, about 1 KB per passage of 100 tokens
+MAX_BYTES = int(os.environ.get("PASSAGE_CACHE_MB", 256)) * 2**20
+# size of the arrays objects and of the LRU entry, on top of their buffers
+ENTRY_OVERHEAD = 300
+
+Encoding = Tuple[np.ndarray, np.ndarray]
+
+
+def compact(ids: Sequence[int], offsets: Sequence[Tuple[int, int]]) -> Encoding:
+    """Store a passage encoding as int32 arrays of ids and (start, end) offsets."""
+    return (
+        np.asarray(ids, dtype=np.int32),
+        np.asarray(offsets, dtype=np.int32).reshape(-1, 2),
+    )
+
+
+class EncodingCache:
+    """
+    Thread-safe LRU cache of tokenized passages.
+
+    The values are the token ids and character offsets of a chunk, keyed by its
+    `chunk_id` and stored as int32 arrays. When the arrays take more than
+    `max_bytes` the least recently used chunks are evicted.
+    """
+
+    def __init__(self, max_bytes: int = MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[Hashable, Encoding]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _size(value: Encoding) -> int:
+        ids, offsets = value
+        return ids.nbytes + offsets.nbytes + ENTRY_OVERHEAD
+
+    def get(self, key: Hashable) -> Optional[Encoding]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: Tuple[Sequence, Sequence]) -> Encoding:
+        value = compact(*value)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= self._size(previous)
+            self._entries[key] = value
+            self.bytes += self._size(value)
+            while self.bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.bytes -= self._size(evicted)
+        return value
+
+    def update(self, values: Dict[Hashable, Tuple[Sequence, Sequence]]) -> None:
+        for key, value in values.items():
+            self.put(key, value)
+
+    def get_or_compute(
+        self, key: Hashable, compute: Callable[[], Tuple[Sequence, Sequence]]
+    ) -> Encoding:
+        value = self.get(key)
+        if value is None:
+            # computed outside the lock, two threads may tokenize the same chunk
+            value = self.put(key, compute())
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+passage_cache = EncodingCache()
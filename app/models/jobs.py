@@ -0,0 +1,427 @@
+import contextlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.models import metrics, utils
+
+
+JOBS_PATH = os.path.join(utils.DATA_PATH, "jobs")
+JOBS_DB = os.path.join(JOBS_PATH, "jobs.sqlite3")
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", 2))
+POLL_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 5.0
+# a running job without heartbeat for this long belongs to a dead process
+STALE_AFTER = 60.0
+MAX_ATTEMPTS = 3
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = (
+    "queued",
+    "running",
+    "done",
+    "failed",
+    "cancelled",
+)
+ACTIVE = (QUEUED, RUNNING)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    owner TEXT NOT NULL DEFAULT '',
+    params TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT NOT NULL DEFAULT '',
+    result TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    heartbeat_at REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_owner ON jobs (owner, kind, created_at);
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job:
+    """
+    Handle given to a job handler.
+
+    It holds the job parameters, the folder of its files and a `state` dict that is
+    kept across attempts, so a handler resumed after a crash can skip the steps it
+    already finished. `progress` also checks for cancellation.
+    """
+
+    def __init__(self, queue: "JobQueue", row: sqlite3.Row):
+        self.queue = queue
+        self.id = row["id"]
+        self.params = json.loads(row["params"])
+        self.state = json.loads(row["state"])
+        self.path = os.path.join(queue.jobs_path, self.id)
+        self.files_path = os.path.join(self.path, "files")
+
+    def progress(self, fraction: float, message: str = "") -> None:
+        """Report the progress, between 0 and 1, and stop if the job was cancelled."""
+        self.queue._update(
+            self.id, progress=min(max(fraction, 0.0), 1.0), message=message
+        )
+        self.check_cancelled()
+
+    def save_state(self) -> None:
+        self.queue._update(self.id, state=json.dumps(self.state))
+
+    def check_cancelled(self) -> None:
+        if self.queue._cancel_requested(self.id):
+            raise JobCancelled(self.id)
+
+
+class JobQueue:
+    """
+    Run long tasks (ingestion, crawling) in a pool of background worker threads.
+
+    The jobs are kept in a SQLite table, so their status survives page reloads and
+    restarts, and several processes can share the same queue. A job whose worker
+    stopped sending heartbeats (the process died) is queued again, up to
+    `MAX_ATTEMPTS` times. Handlers are registered per kind with `register`.
+
+    Args:
+        db_path (str, optional): The SQLite database.
+        jobs_path (str, optional): Folder of the files of each job.
+        workers (int, optional): Number of worker threads.
+    """
+
+    def __init__(
+        self,
+        db_path: str = JOBS_DB,
+        jobs_path: str = JOBS_PATH,
+        workers: int = JOB_WORKERS,
+    ):
+        self.db_path = db_path
+        self.jobs_path = jobs_path
+        self.workers = workers
+        self._handlers: Dict[str, Callable[[Job], dict]] = dict()
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = list()
+        os.makedirs(jobs_path, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+
+    @contextlib.contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        try:
+            yield connection
+        finally:
+            connection.close()
+
+    def _update(self, job_id: str, **fields) -> None:
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._connect() as connection:
+            connection.execute(
+                f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id)
+            )
+
+    def _cancel_requested(self, job_id: str) -> bool:
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return bool(row and row["cancel_requested"])
+
+    def register(self, kind: str, handler: Callable[[Job], dict]) -> None:
+        self._handlers[kind] = handler
+
+    def start(self) -> None:
+        if self._threads:
+            return
+        for number in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name=f"job-worker-{number}", daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+        heartbeat = threading.Thread(
+            target=self._heartbeat, name="job-heartbeat", daemon=True
+        )
+        heartbeat.start()
+        self._threads.append(heartbeat)
+
+    def close(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def submit(
+        self,
+        kind: str,
+        params: dict,
+        owner: str = "",
+        files: Iterable[Tuple[str, bytes]] = (),
+    ) -> str:
+        """
+        Queue a job.
+
+        Args:
+            kind (str): A registered job kind, "ingest" or "crawl".
+            params (dict): JSON serializable parameters of the handler.
+            owner (str, optional): Session or namespace that can list the job.
+            files (Iterable[Tuple[str, bytes]], optional): Files saved with the job
+                before it is queued, read by the handler from `Job.files_path`.
+
+        Returns:
+            str: The job id.
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind {kind!r}")
+        job_id = uuid.uuid4().hex
+        files_path = os.path.join(self.jobs_path, job_id, "files")
+        os.makedirs(files_path)
+        for name, content in files:
+            with open(os.path.join(files_path, os.path.basename(name)), "wb") as file:
+                file.write(content)
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT INTO jobs (id, kind, owner, params, status, created_at, "
+                "updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, owner, json.dumps(params), QUEUED, now, now),
+            )
+        metrics.count(f"jobs_submitted_{kind}")
+        self._wake.set()
+        return job_id
+
+    def cancel(self, job_id: str) -> None:
+        """Cancel a queued job, or ask a running job to stop at its next check."""
+        with self._connect() as connection:
+            cancelled = connection.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? "
+                "WHERE id = ? AND status = ?",
+                (CANCELLED, time.time(), job_id, QUEUED),
+            ).rowcount
+            connection.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = ?",
+                (job_id, RUNNING),
+            )
+        if cancelled:
+            self._remove_files(job_id)
+
+    def _remove_files(self, job_id: str) -> None:
+        shutil.rmtree(os.path.join(self.jobs_path, job_id), ignore_errors=True)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT * FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return _as_dict(row) if row else None
+
+    def list_jobs(
+        self, owner: str, kind: Optional[str] = None, limit: int = 10
+    ) -> List[dict]:
+        """Return the latest jobs of an owner, the newest first."""
+        query, args = "SELECT * FROM jobs WHERE owner = ?", [owner]
+        if kind:
+            query += " AND kind = ?"
+            args.append(kind)
+        query += " ORDER BY created_at DESC LIMIT ?"
+        with self._connect() as connection:
+            rows = connection.execute(query, (*args, limit)).fetchall()
+        return [_as_dict(row) for row in rows]
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        now = time.time()
+        with self._connect() as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                # jobs left running by a dead process are resumed or given up, the
+                # files of the ones given up are removed
+                given_up = connection.execute(
+                    "SELECT id FROM jobs WHERE status = ? AND heartbeat_at < ? "
+                    "AND attempts >= ?",
+                    (RUNNING, now - STALE_AFTER, MAX_ATTEMPTS),
+                ).fetchall()
+                connection.execute(
+                    "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? "
+                    "END, error = 'The worker stopped', updated_at = ? "
+                    "WHERE status = ? AND heartbeat_at < ?",
+                    (MAX_ATTEMPTS, FAILED, QUEUED, now, RUNNING, now - STALE_AFTER),
+                )
+                row = connection.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY created_at LIMIT 1",
+                    (QUEUED,),
+                ).fetchone()
+                if row and row["kind"] in self._handlers:
+                    connection.execute(
+                        "UPDATE jobs SET status = ?, attempts = attempts + 1, "
+                        "error = NULL, heartbeat_at = ?, updated_at = ? WHERE id = ?",
+                        (RUNNING, now, now, row["id"]),
+                    )
+                else:
+                    row = None
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+        for job in given_up:
+            self._remove_files(job["id"])
+        return row
+
+    def _run(self, row: sqlite3.Row) -> None:
+        job = Job(self, row)
+        with self._running_lock:
+            self._running.add(job.id)
+        try:
+            with metrics.span(f"jobs.{row['kind']}"):
+                result = self._handlers[row["kind"]](job)
+        except JobCancelled:
+            self._update(job.id, status=CANCELLED, message="Cancelled")
+        except Exception as error:
+            logger.exception("Job %s failed", job.id)
+            self._update(job.id, status=FAILED, error=str(error))
+        else:
+            self._update(
+                job.id,
+                status=DONE,
+                progress=1.0,
+                message="Done",
+                result=json.dumps(result),
+            )
+        finally:
+            with self._running_lock:
+                self._running.discard(job.id)
+        self._remove_files(job.id)
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            try:
+                row = self._claim()
+            except sqlite3.Error:
+                logger.exception("Could not claim a job")
+                row = None
+            if row is None:
+                self._wake.wait(POLL_INTERVAL)
+                self._wake.clear()
+                continue
+            self._run(row)
+
+    def _heartbeat(self) -> None:
+        while not self._stop.wait(HEARTBEAT_INTERVAL):
+            with self._running_lock:
+                running = list(self._running)
+            for job_id in running:
+                self._update(job_id, heartbeat_at=time.time())
+
+
+def _as_dict(row: sqlite3.Row) -> dict:
+    job = dict(row)
+    job["params"] = json.loads(job["params"])
+    job["state"] = json.loads(job["state"])
+    job["result"] = json.loads(job["result"]) if job["result"] else None
+    return job
+
+
+def ingest_job(job: Job) -> dict:
+    """
+    Index the files of the job in the overlay index of a namespace.
+
+    Params: `namespace` and `embeddings`. Each embedding is swapped in as soon as it
+    is indexed and recorded in the job state, so a resumed job does not index the
+    same files twice.
+    """
+    from app.models import namespaces
+
+    namespace, embeddings = job.params["namespace"], job.params["embeddings"]
+    text_path = os.path.join(job.path, "text")
+    os.makedirs(text_path, exist_ok=True)
+    files = sorted(os.listdir(job.files_path))
+    for position, name in enumerate(files):
+        job.progress(0.2 * position / len(files), f"Reading {name}")
+        source = os.path.join(job.files_path, name)
+        if name.endswith(".pdf"):
+            utils.pdf_to_txt(source, os.path.join(text_path, name))
+        else:
+            shutil.copyfile(source, os.path.join(text_path, name))
+
+    indexed = job.state.setdefault("indexed", [])
+    for position, embedding_name in enumerate(embeddings):
+        if embedding_name in indexed:
+            continue
+        job.progress(
+            0.2 + 0.8 * position / len(embeddings),
+            f"Generating indexes for the {embedding_name} embeddings",
+        )
+        namespaces.create_overlay_index(namespace, embedding_name, data_path=text_path)
+        indexed.append(embedding_name)
+        job.save_state()
+    return {"namespace": namespace, "embeddings": embeddings, "files": files}
+
+
+def crawl_job(job: Job) -> dict:
+    """
+    Scrape a site and save its index, see `ask_site.build_site_index`.
+
+    Params: `site` and `entire_site`.
+    """
+    from app.models import ask_site
+
+    site = job.params["site"]
+    job.progress(0.0, "Crawling the site")
+    canonical_links = dict()
+    if job.params.get("entire_site"):
+        with ask_site.crawl_lock:
+            ask_site.urls.clear()
+            site_urls = list(ask_site.get_urls(site, canonical_links))
+    else:
+        site_urls = [site]
+    job.progress(0.2, f"Reading {len(site_urls)} pages")
+
+    def report(done, total):
+        job.progress(0.3 + 0.7 * done / max(total, 1), f"Embedded {done} of {total}")
+
+    identifier, stats = ask_site.build_site_index(
+        site_urls,
+        progress_path=os.path.join(job.path, "embedding_progress"),
+        progress_callback=report,
+        canonical_links=canonical_links,
+    )
+    return {"site_id": identifier, "urls": site_urls, "deduplication": stats}
+
+
+_queue: Optional[JobQueue] = None
+_queue_lock = threading.Lock()
+
+
+def get_queue() -> JobQueue:
+    """Return the job queue of the process, with the ingest and crawl handlers."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+            _queue.register("ingest", ingest_job)
+            _queue.register("crawl", crawl_job)
+            _queue.start()
+    return _queue
@@ -0,0 +1,132 @@
+import copy
+from typing import List
+
+import torch
+from langchain.embeddings.base import Embeddings
+from transformers import AutoModel, AutoTokenizer
+
+from app.models.utils import PLAIN_EMBEDDING_SCHEME, PREFIXED_EMBEDDING_SCHEME
+
+
+BACKENDS = ("torch", "int8", "onnx")
+BATCH_SIZE = 32
+MAX_LENGTH = 512
+QUERY_PREFIX = "query: "
+PASSAGE_PREFIX = "passage: "
+
+
+class LocalEmbeddings(Embeddings):
+    """
+    Sentence embeddings computed locally with a Hugging Face encoder.
+
+    Texts are sorted by length before being split into batches, so each batch is
+    padded only up to its longest text, and the vectors are returned in the input
+    order. The encoder can run as a regular torch model ("torch"), as a torch model
+    with dynamically quantized int8 linear layers ("int8"), or through ONNX Runtime
+    ("onnx", requires `optimum[onnxruntime]`).
+
+    The e5 family expects a "query: " prefix for questions and a "passage: " prefix
+    for the indexed texts, so `embed_query` and `embed_documents` add them. Mean
+    pooling and normalization match the sentence-transformers configuration of e5,
+    so without prefixes the vectors are the ones of `HuggingFaceEmbeddings`;
+    `scheme` names the variant, to be stored with the indexes it builds.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        backend: str = "torch",
+        batch_size: int = BATCH_SIZE,
+        normalize: bool = True,
+        max_length: int = MAX_LENGTH,
+        query_prefix: str = QUERY_PREFIX,
+        passage_prefix: str = PASSAGE_PREFIX,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"backend must be one of {BACKENDS}, got {backend!r}")
+
+        self.model_name = model_name
+        self.backend = backend
+        self.batch_size = batch_size
+        self.normalize = normalize
+        self.max_length = max_length
+        self.query_prefix = query_prefix
+        self.passage_prefix = passage_prefix
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = self._load_model()
+
+    @property
+    def scheme(self) -> str:
+        if self.query_prefix or self.passage_prefix:
+            return PREFIXED_EMBEDDING_SCHEME
+        return PLAIN_EMBEDDING_SCHEME
+
+    def with_prefixes(
+        self, query_prefix: str, passage_prefix: str
+    ) -> "LocalEmbeddings":
+        """A copy using other prefixes, sharing the loaded model and tokenizer."""
+        embeddings = copy.copy(self)
+        embeddings.query_prefix = query_prefix
+        embeddings.passage_prefix = passage_prefix
+        return embeddings
+
+    def _load_model(self):
+        if self.backend == "onnx":
+            try:
+                from optimum.onnxruntime import ORTModelForFeatureExtraction
+            except ImportError as error:
+                raise ImportError(
+                    "The onnx backend requires optimum, install it with "
+                    "`pip install optimum[onnxruntime]`."
+                ) from error
+            return ORTModelForFeatureExtraction.from_pretrained(
+                self.model_name, export=True
+            )
+
+        model = AutoModel.from_pretrained(self.model_name)
+        model.eval()
+        if self.backend == "int8":
+            model = torch.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return model
+
+    def _mean_pooling(
+        self, hidden_state: torch.Tensor, attention_mask: torch.Tensor
+    ) -> torch.Tensor:
+        mask = attention_mask.unsqueeze(-1).to(hidden_state.dtype)
+        summed = (hidden_state * mask).sum(dim=1)
+        return summed / mask.sum(dim=1).clamp(min=1e-9)
+
+    def _encode_batch(self, texts: List[str]) -> torch.Tensor:
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="pt",
+        )
+        with torch.inference_mode():
+            outputs = self.model(**inputs)
+        embeddings = self._mean_pooling(
+            outputs.last_hidden_state, inputs["attention_mask"]
+        )
+        if self.normalize:
+            embeddings = torch.nn.functional.normalize(embeddings, p=2, dim=1)
+        return embeddings
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]), reverse=True)
+        embeddings = [None] * len(texts)
+        for start in range(0, len(order), self.batch_size):
+            indices = order[start : start + self.batch_size]
+            batch = self._encode_batch([texts[i] for i in indices])
+            for i, embedding in zip(indices, batch.tolist()):
+                embeddings[i] = embedding
+        return embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode([self.passage_prefix + text for text in texts])
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([self.query_prefix + text])[0]
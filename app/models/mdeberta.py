@@ -1,13 +1,18 @@
-from app.models import utils
+from app.models import metrics, utils
+from app.models.batching import MicroBatcher
+from app.models.chunking import HFTokenizerAdapter, chunk_id
+from app.models.encoding_cache import EncodingCache, passage_cache
 
+import functools
 import os
 import re
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
+import numpy as np
 import langdetect
 
-import streamlit as st
 import torch
 from transformers import AutoModelForQuestionAnswering, AutoTokenizer
+from langchain.docstore.document import Document
 from langchain.vectorstores import FAISS
 
 
@@ -19,53 +24,55 @@ DEVICE = (
     if torch.backends.mps.is_available()
     else "cpu"
 )
+NO_ANSWER = "No answer found."
+# adaptive reading, see `DeBerta.read`
+ADAPTIVE = os.environ.get("MDEBERTA_ADAPTIVE", "0").lower() in ("1", "true", "yes")
+RELATIVE_GAP = 1.5
+READ_BATCH_SIZE = 2
+CONFIDENCE_MARGIN = 2.0
 
 
 class DeBerta:
     def __init__(self):
         self.k = 8
         self.min_score = 2.9
-        self.model_name = "timpal0l/mdeberta-v3-base-squad2"
+        self.model_name = utils.READER_MODEL
         self.max_seq_len = 512
         self.tokenizer, self.model = self._load_model()
+        self.batcher: Optional[MicroBatcher] = None
+        self.passage_cache: EncodingCache = passage_cache
+        self.adaptive = ADAPTIVE
+        self.max_distance: Optional[float] = None
+        self.relative_gap = RELATIVE_GAP
+        self.read_batch_size = READ_BATCH_SIZE
+        self.confidence_margin = CONFIDENCE_MARGIN
 
-    def _clean_answer(self, answer: str, question: str) -> str:
-        return answer.replace(question, "")
-
-    def _get_top_answers(
-        self,
-        answer_list: List[str],
-        score_list: List[float],
-    ) -> List[str]:
+    def enable_batching(
+        self, max_batch_size: int = 16, max_wait_ms: float = 5.0
+    ) -> MicroBatcher:
         """
-        Get the top answers from a list based on their corresponding scores.
-
-        This function takes two lists, `answer_list` and `score_list`, where each answer
-        in `answer_list` corresponds to a score in `score_list`. It returns a list of
-        answers sorted by their scores in descending order.
-
-        Args:
-            answer_list (List[str]): A list of answers.
-            score_list (List[float]): A list of scores corresponding to the answers.
+        Route the reader forward passes of concurrent calls through one scheduler.
 
-        Returns:
-            List[str]: A list of answers sorted by score in descending order.
-
-        If answer list or the score list is empty, the function returns
-        a list with a single element: ["No answer found."].
+        The (question, doc) pairs of every `run` are queued and read together as a
+        padded batch once `max_batch_size` pairs are waiting or `max_wait_ms`
+        milliseconds have passed.
         """
-        tuple_score = list(enumerate(score_list))
-        tuple_score = sorted(tuple_score, key=lambda x: x[1], reverse=True)
-        indices_answer = [tuple[0] for tuple in tuple_score]
-        score_list = [score_list[i] for i in indices_answer]
-        answer_list = [answer_list[i] for i in indices_answer]
+        if self.batcher is None:
+            self.batcher = MicroBatcher(
+                self._read_batch,
+                max_batch_size=max_batch_size,
+                max_wait_ms=max_wait_ms,
+            )
+        return self.batcher
 
-        if not score_list:
-            return ["No answer found."]
-        return answer_list
+    def _clean_answer(self, answer: str, question: str) -> str:
+        return answer.replace(question, "")
 
     def _answers_from_docs(
-        self, docs: List[str], question: str
+        self,
+        docs: List[Document],
+        question: str,
+        min_score: Optional[float] = None,
     ) -> Tuple[List[str], List[float], List[str]]:
         """
         Extract answers from a list of documents using a question.
@@ -75,8 +82,10 @@ class DeBerta:
         answers, their corresponding scores, and the sources files of the answers.
 
         Args:
-            docs (List[str]): A list of documents to search for answers.
+            docs (List[Document]): The documents to search for answers.
             question (str): The question for which answers are being sought.
+            min_score (float, optional): Minimum start score of an answer,
+                `self.min_score` by default.
 
         Returns:
             Tuple[List[str], List[float], List[str]]: A tuple containing:
@@ -92,45 +101,212 @@ class DeBerta:
         - The function may return empty lists for answers, scores, and sources if no
         satisfactory answers are found by the model.
         """
-        answers, scores, sources = [], [], []
-        for doc in docs:
-            content = doc.page_content
-            source = os.path.basename(doc.metadata["source"])
-
-            inputs = self.tokenizer.encode_plus(
+        min_score = self.min_score if min_score is None else min_score
+        pairs = [
+            (
                 question,
-                content,
-                add_special_tokens=True,
-                max_length=self.max_seq_len,
-                truncation=True,
-                return_tensors="pt",
-            ).to(DEVICE)
-            input_ids = inputs["input_ids"].tolist()[0]
-
-            answer_start_scores, answer_end_scores = self.model(
-                **inputs, return_dict=False
+                doc.page_content,
+                doc.metadata.get("chunk_id") or chunk_id(doc.page_content),
             )
-            answer_start_score = torch.max(answer_start_scores).item()
-
-            answer_start = torch.argmax(answer_start_scores)
-            answer_end = torch.argmax(answer_end_scores) + 1
-            answer = self.tokenizer.decode(input_ids[answer_start:answer_end])
-            no_special_token_answer = re.sub(PATTERN, "", answer).strip()
-
-            if (
-                no_special_token_answer
-                and (answer_start_score > self.min_score)
-                and (
-                    langdetect.detect(no_special_token_answer)
-                    == langdetect.detect(question)
-                )
-            ):
-                answers.append(no_special_token_answer)
-                scores.append(answer_start_score)
-                sources.append(source)
+            for doc in docs
+        ]
+        if self.batcher is not None:
+            spans = self.batcher.submit(pairs)
+        else:
+            spans = self._read_batch(pairs)
+
+        answers, scores, sources = [], [], []
+        with metrics.span("mdeberta.postprocess"):
+            for doc, (answer, answer_start_score) in zip(docs, spans):
+                source = os.path.basename(utils.format_source(doc.metadata))
+                no_special_token_answer = re.sub(PATTERN, "", answer).strip()
+
+                if (
+                    no_special_token_answer
+                    and (answer_start_score > min_score)
+                    and (
+                        langdetect.detect(no_special_token_answer)
+                        == langdetect.detect(question)
+                    )
+                ):
+                    answers.append(no_special_token_answer)
+                    scores.append(answer_start_score)
+                    sources.append(source)
         return answers, scores, sources
 
+    def _select_docs(
+        self, docs_and_scores: List[Tuple[Document, float]]
+    ) -> List[Document]:
+        """Keep the docs within `max_distance` and `relative_gap` of the closest one."""
+        ranked = sorted(docs_and_scores, key=lambda doc_score: doc_score[1])
+        if not ranked:
+            return []
+        # a closest doc at distance 0 (an exact match) gives no scale for the gap
+        cutoff = ranked[0][1] * self.relative_gap if ranked[0][1] > 0 else float("inf")
+        if self.max_distance is not None:
+            cutoff = min(cutoff, self.max_distance)
+        return [doc for doc, distance in ranked if distance <= cutoff]
+
+    def _answers_adaptive(
+        self, docs: List[Document], question: str, min_score: float
+    ) -> Tuple[List[str], List[float], List[str], int]:
+        answers, scores, sources = [], [], []
+        read = 0
+        for start in range(0, len(docs), self.read_batch_size):
+            batch = docs[start : start + self.read_batch_size]
+            batch_answers, batch_scores, batch_sources = self._answers_from_docs(
+                batch, question, min_score
+            )
+            read += len(batch)
+            answers += batch_answers
+            scores += batch_scores
+            sources += batch_sources
+            if scores and max(scores) >= min_score + self.confidence_margin:
+                metrics.count("mdeberta_early_exits")
+                break
+        return answers, scores, sources, read
+
+    def read(
+        self,
+        question: str,
+        docs_and_scores: List[Tuple[Document, float]],
+        min_score: Optional[float] = None,
+        adaptive: Optional[bool] = None,
+    ) -> Tuple[List[str], List[str], int]:
+        """
+        Read the retrieved docs and return the answers, best first.
+
+        In adaptive mode the docs farther than `max_distance`, or more than
+        `relative_gap` times the distance of the closest doc, are not read; the
+        others are read in distance order, `read_batch_size` at a time, and reading
+        stops as soon as an answer scores `confidence_margin` above `min_score`.
+        Otherwise every doc is read in one batch.
+
+        Args:
+            question (str): The user question.
+            docs_and_scores (List[Tuple[Document, float]]): Output of
+                `similarity_search_with_score`.
+            min_score (float, optional): `self.min_score` by default.
+            adaptive (bool, optional): `self.adaptive` by default.
+
+        Returns:
+            Tuple[List[str], List[str], int]: The answers, their sources and the
+            number of docs read.
+        """
+        min_score = self.min_score if min_score is None else min_score
+        adaptive = self.adaptive if adaptive is None else adaptive
+        if adaptive:
+            docs = self._select_docs(docs_and_scores)
+            metrics.count("mdeberta_skipped_docs", len(docs_and_scores) - len(docs))
+            answers, scores, sources, read = self._answers_adaptive(
+                docs, question, min_score
+            )
+        else:
+            docs = [doc for doc, _ in docs_and_scores]
+            answers, scores, sources = self._answers_from_docs(
+                docs, question, min_score
+            )
+            read = len(docs)
+        ranked = sorted(zip(scores, answers, sources), key=lambda x: x[0], reverse=True)
+        return (
+            [self._clean_answer(answer, question) for _, answer, _ in ranked],
+            [source for _, _, source in ranked],
+            read,
+        )
+
+    def _encode_passage(self, content: str) -> Tuple[List[int], List[tuple]]:
+        # the same encoding as the one cached by the chunker at ingestion time
+        return HFTokenizerAdapter(self.tokenizer).encode(content)
+
+    def _build_inputs(
+        self, pairs: List[Tuple[str, str, str]]
+    ) -> Tuple[Dict[str, torch.Tensor], List[int], List[np.ndarray]]:
+        """
+        Build the padded reader inputs from cached passage encodings.
+
+        Only the questions are tokenized; the passages come from `passage_cache`
+        (filled at ingestion time or on first use) and are truncated to the room
+        left by the question and the special tokens. Questions longer than half of
+        `max_seq_len` are truncated so that some of the passage is always read.
+        """
+        question_ids = dict()
+        features, passage_starts, passage_offsets = [], [], []
+        for question, content, key in pairs:
+            if question not in question_ids:
+                question_ids[question] = self.tokenizer(
+                    question, add_special_tokens=False, verbose=False
+                )["input_ids"][: self.max_seq_len // 2]
+            q_ids = question_ids[question]
+            p_ids, offsets = self.passage_cache.get_or_compute(
+                key, functools.partial(self._encode_passage, content)
+            )
+            room = self.max_seq_len - len(q_ids)
+            room -= self.tokenizer.num_special_tokens_to_add(pair=True)
+            p_ids, offsets = p_ids[: max(room, 0)].tolist(), offsets[: max(room, 0)]
+
+            features.append(
+                {
+                    "input_ids": self.tokenizer.build_inputs_with_special_tokens(
+                        q_ids, p_ids
+                    ),
+                    "token_type_ids": (
+                        self.tokenizer.create_token_type_ids_from_sequences(
+                            q_ids, p_ids
+                        )
+                    ),
+                }
+            )
+            passage_starts.append(
+                len(self.tokenizer.build_inputs_with_special_tokens(q_ids))
+            )
+            passage_offsets.append(offsets)
+        inputs = self.tokenizer.pad(features, padding=True, return_tensors="pt")
+        return inputs, passage_starts, passage_offsets
+
+    def _read_batch(self, pairs: List[Tuple[str, str, str]]) -> List[Tuple[str, float]]:
+        """
+        Run the reader once over a padded batch of (question, content, chunk id).
+
+        Args:
+            pairs (List[Tuple[str, str, str]]): The questions, document contents and
+                the chunk ids used to look up the tokenized contents.
+
+        Returns:
+            List[Tuple[str, float]]: For each pair, the answer span (it may still
+            contain special tokens) and its start score.
+        """
+        if not pairs:
+            return []
+        with metrics.span("mdeberta.tokenize"):
+            inputs, passage_starts, passage_offsets = self._build_inputs(pairs)
+            inputs = inputs.to(DEVICE)
+        metrics.count("mdeberta_tokens", lambda: int(inputs["attention_mask"].sum()))
+        metrics.count("mdeberta_passages", len(pairs))
+
+        with metrics.span("mdeberta.forward"), torch.inference_mode():
+            start_scores, end_scores = self.model(**inputs, return_dict=False)
+        padding = inputs["attention_mask"] == 0
+        start_scores = start_scores.masked_fill(padding, float("-inf"))
+        end_scores = end_scores.masked_fill(padding, float("-inf"))
+
+        spans = list()
+        for row, input_ids in enumerate(inputs["input_ids"].tolist()):
+            answer_start = torch.argmax(start_scores[row]).item()
+            answer_end = torch.argmax(end_scores[row]).item() + 1
+            first = answer_start - passage_starts[row]
+            last = answer_end - 1 - passage_starts[row]
+            offsets = passage_offsets[row]
+            if 0 <= first <= last < len(offsets):
+                # the span is inside the passage, take it from the original text
+                content = pairs[row][1]
+                answer = content[offsets[first][0] : offsets[last][1]]
+            else:
+                answer = self.tokenizer.decode(input_ids[answer_start:answer_end])
+            spans.append((answer, start_scores[row, answer_start].item()))
+        return spans
+
     def _load_model(self) -> Tuple[AutoTokenizer, AutoModelForQuestionAnswering]:
+        utils.set_torch_threads()
         tokenizer = AutoTokenizer.from_pretrained(self.model_name)
         model = AutoModelForQuestionAnswering.from_pretrained(self.model_name)
         model.to(DEVICE)
@@ -151,14 +327,9 @@ class DeBerta:
             - List[str]: A list of source files related to the question.
 
         """
-        docs = index.similarity_search(question, k=self.k)
-        answers, scores, sources = self._answers_from_docs(docs=docs, question=question)
-        answer_list = self._get_top_answers(answers, scores)
-        clean_answers = [self._clean_answer(answer, question) for answer in answer_list]
-        return ", ".join(clean_answers), utils.clean_source(set(sources))
-
-
-@st.cache_resource
-def load_model() -> DeBerta:
-    model = DeBerta()
-    return model
+        with metrics.span("mdeberta.similarity_search"):
+            docs_and_scores = index.similarity_search_with_score(question, k=self.k)
+        answers, sources, _ = self.read(question, docs_and_scores)
+        if not answers:
+            answers = [NO_ANSWER]
+        return ", ".join(answers), utils.clean_source(set(sources))
@@ -0,0 +1,165 @@
+import bisect
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Union
+
+
+ENV_VARIABLE = "APP_METRICS"
+PREFIX = "qa"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_enabled = os.environ.get(ENV_VARIABLE, "").lower() in ("1", "true", "yes")
+_lock = threading.Lock()
+_counters: Dict[str, float] = defaultdict(float)
+
+
+class _Histogram:
+    __slots__ = ("buckets", "count", "total")
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+
+_histograms: Dict[str, _Histogram] = defaultdict(_Histogram)
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        with _lock:
+            _histograms[self.name].observe(seconds)
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+def enable(value: bool = True) -> None:
+    global _enabled
+    _enabled = value
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def span(name: str):
+    """
+    Time a stage of a request.
+
+    Use it as a context manager, `with metrics.span("mdeberta.forward"): ...`. When
+    the metrics are disabled (the default, enable them with `APP_METRICS=1`) a
+    shared no-op object is returned, so the cost is a function call.
+    """
+    if not _enabled:
+        return _NOOP_SPAN
+    return _Span(name)
+
+
+def count(name: str, value: Union[float, Callable[[], float]] = 1) -> None:
+    """
+    Add `value` to a counter, for instance tokens or bytes processed.
+
+    Pass a function when the value takes work to compute, it is only called when
+    the metrics are enabled.
+    """
+    if not _enabled:
+        return
+    if callable(value):
+        value = value()
+    with _lock:
+        _counters[name] += value
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def snapshot() -> Dict[str, dict]:
+    """Return the counters and, for each stage, its call count and mean time."""
+    with _lock:
+        stages = {
+            name: {
+                "count": histogram.count,
+                "total_s": histogram.total,
+                "mean_ms": 1000 * histogram.total / histogram.count,
+            }
+            for name, histogram in sorted(_histograms.items())
+            if histogram.count
+        }
+        counters = dict(sorted(_counters.items()))
+    return {"stages": stages, "counters": counters}
+
+
+def _metric_name(name: str) -> str:
+    return "".join(char if char.isalnum() else "_" for char in name)
+
+
+def to_prometheus() -> str:
+    """Export the metrics in the Prometheus text exposition format."""
+    lines = list()
+    with _lock:
+        histograms = {name: h for name, h in _histograms.items() if h.count}
+        counters = dict(_counters)
+
+    metric = f"{PREFIX}_stage_duration_seconds"
+    lines.append(f"# HELP {metric} Duration of each stage of the QA requests.")
+    lines.append(f"# TYPE {metric} histogram")
+    for name, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS + (float("inf"),), histogram.buckets):
+            cumulative += bucket
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append(f'{metric}_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{stage="{name}"}} {histogram.total}')
+        lines.append(f'{metric}_count{{stage="{name}"}} {histogram.count}')
+
+    for name, value in sorted(counters.items()):
+        counter = f"{PREFIX}_{_metric_name(name)}_total"
+        lines.append(f"# TYPE {counter} counter")
+        lines.append(f"{counter} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def render_debug_panel() -> None:
+    """Show the collected metrics in a Streamlit sidebar expander, when enabled."""
+    if not _enabled:
+        return
+    import streamlit as st
+
+    metrics = snapshot()
+    with st.sidebar.expander("Performance metrics"):
+        st.write("Stages")
+        st.table(metrics["stages"])
+        st.write("Counters")
+        st.json(metrics["counters"])
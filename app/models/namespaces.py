@@ -0,0 +1,243 @@
+import contextlib
+import fcntl
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+from app.models import utils
+
+if TYPE_CHECKING:
+    # imported where used, the File QA page imports this module at start-up
+    from langchain.docstore.document import Document
+    from langchain.embeddings.base import Embeddings
+    from langchain.vectorstores import FAISS
+
+
+TENANTS_PATH = os.path.join(utils.DATA_PATH, "tenants")
+OVERLAY_TTL = 24 * 60 * 60
+LAST_USED_FILE = ".last_used"
+LOCK_FILE = ".lock"
+NAMESPACE_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+logger = logging.getLogger(__name__)
+
+_locks: Dict[str, threading.Lock] = dict()
+_locks_guard = threading.Lock()
+_cleaning = threading.Lock()
+# namespaces whose lock is held by the current thread
+_held = threading.local()
+
+
+def _check_namespace(namespace: str) -> str:
+    if not NAMESPACE_PATTERN.match(namespace):
+        raise ValueError(f"Invalid namespace {namespace!r}")
+    return namespace
+
+
+def namespace_path(namespace: str) -> str:
+    return os.path.join(TENANTS_PATH, _check_namespace(namespace))
+
+
+@contextlib.contextmanager
+def upload_folder(namespace: str) -> Iterator[str]:
+    """A new folder for the files of one upload to a namespace, removed on exit."""
+    path = os.path.join(namespace_path(namespace), "uploads", uuid.uuid4().hex)
+    os.makedirs(path)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def overlay_index_path(namespace: str, embedding_name: str) -> str:
+    folder = os.path.basename(utils.setup_for_embeddings(embedding_name))
+    return os.path.join(namespace_path(namespace), folder)
+
+
+@contextlib.contextmanager
+def namespace_lock(namespace: str) -> Iterator[None]:
+    """
+    Hold the lock of a namespace, across the threads and processes of the app.
+
+    Only the writers of the same namespace wait for each other; the shared base
+    index is never locked. A thread that already holds the lock can take it again.
+    """
+    held = _held.__dict__.setdefault("namespaces", set())
+    if namespace in held:
+        yield
+        return
+    with _locks_guard:
+        lock = _locks.setdefault(namespace, threading.Lock())
+    root = namespace_path(namespace)
+    os.makedirs(root, exist_ok=True)
+    with lock, open(os.path.join(root, LOCK_FILE), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        held.add(namespace)
+        try:
+            yield
+        finally:
+            held.discard(namespace)
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def touch(namespace: str) -> None:
+    root = namespace_path(namespace)
+    os.makedirs(root, exist_ok=True)
+    with open(os.path.join(root, LAST_USED_FILE), "w") as file:
+        file.write(str(time.time()))
+
+
+def create_overlay_index(namespace: str, embedding_name: str, data_path: str) -> None:
+    """
+    Index the files uploaded to a namespace into its overlay index.
+
+    The files are read from `data_path` (see `upload_folder`) and merged into a copy
+    of the overlay index of `embedding_name`, which then replaces the overlay in one
+    step, so queries never see a half written index.
+    """
+    from app.models import create_knowledge_base
+
+    with namespace_lock(namespace):
+        index_path = overlay_index_path(namespace, embedding_name)
+        staging_path = f"{index_path}.{uuid.uuid4().hex[:8]}"
+        if os.path.exists(index_path):
+            shutil.copytree(index_path, staging_path)
+        try:
+            create_knowledge_base.create_index(
+                embedding_name,
+                data_path=data_path,
+                index_path=staging_path,
+            )
+        except BaseException:
+            shutil.rmtree(staging_path, ignore_errors=True)
+            raise
+        utils.replace_directory(staging_path, index_path)
+        touch(namespace)
+
+
+def load_overlay(namespace: str, embedding_name: str) -> Optional["FAISS"]:
+    from langchain.vectorstores import FAISS
+
+    index_path = overlay_index_path(namespace, embedding_name)
+    if not os.path.exists(os.path.join(index_path, "index.faiss")):
+        return None
+    _, embeddings = utils.setup_for_embeddings(embedding_name, return_embeddings=True)
+    scheme = getattr(embeddings, "scheme", None)
+    if scheme and utils.index_embedding_scheme(index_path) != scheme:
+        # built before the base index was embedded again, its vectors do not match
+        return None
+    # the overlays are replaced atomically, reading them does not need the lock
+    return FAISS.load_local(folder_path=index_path, embeddings=embeddings)
+
+
+def _expired(namespace: str, ttl: float) -> bool:
+    root = namespace_path(namespace)
+    last_used = os.path.join(root, LAST_USED_FILE)
+    try:
+        used_at = os.path.getmtime(last_used if os.path.exists(last_used) else root)
+    except FileNotFoundError:
+        return False
+    return time.time() - used_at >= ttl
+
+
+def cleanup_expired(ttl: float = OVERLAY_TTL) -> List[str]:
+    """
+    Remove the namespaces that were not used for `ttl` seconds.
+
+    The age is checked again under the lock of the namespace, it may have been used
+    while waiting for it. Entries of the tenants folder that are not namespaces are
+    left alone.
+
+    Returns:
+        List[str]: The removed namespaces.
+    """
+    if not os.path.exists(TENANTS_PATH):
+        return []
+    removed = list()
+    for namespace in os.listdir(TENANTS_PATH):
+        if not NAMESPACE_PATTERN.match(namespace) or not _expired(namespace, ttl):
+            continue
+        with namespace_lock(namespace):
+            if not _expired(namespace, ttl):
+                continue
+            shutil.rmtree(namespace_path(namespace), ignore_errors=True)
+        with _locks_guard:
+            _locks.pop(namespace, None)
+        removed.append(namespace)
+    return removed
+
+
+def start_cleanup(ttl: float = OVERLAY_TTL) -> Optional[threading.Thread]:
+    """
+    Run `cleanup_expired` in a background thread, unless one is running.
+
+    The cleanup waits for the lock of each expired namespace, so it is kept off the
+    request paths, which would otherwise wait for the ingests of other sessions.
+    """
+    if not _cleaning.acquire(blocking=False):
+        return None
+
+    def run():
+        try:
+            removed = cleanup_expired(ttl)
+            if removed:
+                logger.info("Removed %d expired namespaces", len(removed))
+        except Exception:
+            logger.exception("Cleanup of the expired namespaces failed")
+        finally:
+            _cleaning.release()
+
+    thread = threading.Thread(target=run, name="namespace-cleanup", daemon=True)
+    thread.start()
+    return thread
+
+
+class NamespacedIndex:
+    """
+    Search a shared base index and the overlay indexes of a namespace together.
+
+    The query is embedded once, every index is searched for `k` results and the
+    results are merged by distance, so the base index is shared by all namespaces
+    without being copied or rebuilt. Each search marks the namespace as used, so
+    `cleanup_expired` keeps the overlays that are still queried. It exposes the
+    search methods used by the mDeBERTa reader and by `BudgetRetriever`.
+    """
+
+    def __init__(
+        self,
+        base: "FAISS",
+        overlays: List["FAISS"],
+        embeddings: "Embeddings",
+        namespace: str = "",
+    ) -> None:
+        self.indexes = [base] + [overlay for overlay in overlays if overlay]
+        self.embeddings = embeddings
+        self.namespace = namespace
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4
+    ) -> List[Tuple["Document", float]]:
+        if self.namespace and len(self.indexes) > 1:
+            touch(self.namespace)
+        vector = self.embeddings.embed_query(query)
+        results = list()
+        for index in self.indexes:
+            results.extend(index.similarity_search_with_score_by_vector(vector, k=k))
+        return sorted(results, key=lambda doc_score: doc_score[1])[:k]
+
+    def similarity_search(self, query: str, k: int = 4) -> List["Document"]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+
+def namespaced_index(
+    base: "FAISS", namespace: str, embedding_name: str
+) -> NamespacedIndex:
+    _, embeddings = utils.setup_for_embeddings(embedding_name, return_embeddings=True)
+    return NamespacedIndex(
+        base, [load_overlay(namespace, embedding_name)], embeddings, namespace
+    )
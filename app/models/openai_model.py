@@ -1,6 +1,6 @@
-from app.models import utils
+from app.models import metrics, utils
+from app.models.context_budget import MAX_CONTEXT_TOKENS, BudgetRetriever
 
-import streamlit as st
 from langchain.chains import RetrievalQA
 from langchain.chat_models import ChatOpenAI
 from langchain.prompts import PromptTemplate
@@ -24,15 +24,20 @@ PROMPT = PromptTemplate(
 
 def _clean_llm_response(llm_response):
     answer = llm_response["result"]
-    sources = [source.metadata["source"] for source in llm_response["source_documents"]]
+    sources = [
+        utils.format_source(source.metadata)
+        for source in llm_response["source_documents"]
+    ]
     return answer, sources
 
 
-@st.cache_resource
-def load_chain(index_change=0):
-    if index_change:
-        index = utils.get_index("openai")
-    retriever = index.as_retriever(search_kwargs={"k": K})
+def create_chain(index, k=K):
+    retriever = BudgetRetriever(
+        vectorstore=index,
+        k=2 * k,
+        max_tokens=MAX_CONTEXT_TOKENS,
+        prompt_template=PROMPT_TEMPLATE,
+    )
 
     qa_chain = RetrievalQA.from_chain_type(
         llm=ChatOpenAI(temperature=0, model="gpt-3.5-turbo"),
@@ -45,7 +50,8 @@ def load_chain(index_change=0):
 
 
 def run(qa_chain, question):
-    llm_response = qa_chain(question)
+    with metrics.span("openai.chain"):
+        llm_response = qa_chain(question)
     answer, sources = _clean_llm_response(llm_response)
 
     return answer, utils.clean_source(set(sources))
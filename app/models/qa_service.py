@@ -0,0 +1,244 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from app.models import (
+    ask_site,
+    create_knowledge_base,
+    mdeberta,
+    namespaces,
+    openai_model,
+    utils,
+)
+
+
+MODELS = ("mdeberta", "chatgpt", "site")
+MAX_SITE_CHAINS = 8
+# namespaces whose overlays (and chatgpt chain) are kept loaded
+MAX_NAMESPACES = 32
+
+
+class NotFoundError(LookupError):
+    """An id given to `QAService` does not exist, for instance an unknown site."""
+
+
+class QAService:
+    """
+    Keep the QA models and indexes warm for the headless entry points.
+
+    The models are loaded once and shared between requests. Reads are lock free,
+    the locks only serialize the operations that write to the shared data folder
+    (ingestion, across processes with `utils.data_lock`) or to the crawler state
+    (crawl), and the swap of a reloaded index. An index is loaded again when its
+    files change, also when another process (the command line) wrote it. The
+    chains of the last `MAX_SITE_CHAINS` crawled sites are kept, and the overlays
+    of the last `MAX_NAMESPACES` namespaces queried.
+    """
+
+    def __init__(self):
+        self._load_lock = threading.Lock()
+        self._deberta: Optional[mdeberta.DeBerta] = None
+        # embedding name -> (index version, index)
+        self._indexes: Dict[str, Tuple[float, object]] = dict()
+        self._openai_chain: Optional[Tuple[object, object]] = None
+        self._site_chains: "OrderedDict[str, object]" = OrderedDict()
+        # (namespace, embedding name) -> (base index, overlay version, index, chain)
+        self._overlays: "OrderedDict[Tuple[str, str], tuple]" = OrderedDict()
+
+    def _index(self, embedding_name: str):
+        version = utils.index_version(utils.setup_for_embeddings(embedding_name))
+        loaded = self._indexes.get(embedding_name)
+        if loaded is None or loaded[0] != version:
+            with self._load_lock:
+                loaded = self._indexes.get(embedding_name)
+                if loaded is None or loaded[0] != version:
+                    loaded = (version, utils.get_index(embedding_name))
+                    self._indexes[embedding_name] = loaded
+        return loaded[1]
+
+    def _site_chain(self, site_id: str):
+        with self._load_lock:
+            if site_id not in self._site_chains:
+                raise NotFoundError(
+                    f"Unknown site id {site_id!r}, crawl the site first"
+                )
+            self._site_chains.move_to_end(site_id)
+            return self._site_chains[site_id]
+
+    def _mdeberta(self) -> mdeberta.DeBerta:
+        if self._deberta is None:
+            with self._load_lock:
+                if self._deberta is None:
+                    deberta = mdeberta.DeBerta()
+                    deberta.enable_batching()
+                    self._deberta = deberta
+        return self._deberta
+
+    def _namespaced_index(self, namespace: str, embedding_name: str) -> tuple:
+        base = self._index(embedding_name)
+        version = utils.index_version(
+            namespaces.overlay_index_path(namespace, embedding_name)
+        )
+        key = (namespace, embedding_name)
+        with self._load_lock:
+            cached = self._overlays.get(key)
+            if cached is None or cached[0] is not base or cached[1] != version:
+                index = namespaces.namespaced_index(base, namespace, embedding_name)
+                cached = (base, version, index, None)
+            if embedding_name == "openai" and cached[3] is None:
+                cached = cached[:3] + (openai_model.create_chain(cached[2]),)
+            self._overlays[key] = cached
+            self._overlays.move_to_end(key)
+            while len(self._overlays) > MAX_NAMESPACES:
+                self._overlays.popitem(last=False)
+        return cached
+
+    def _chatgpt(self, namespace: str = ""):
+        if namespace:
+            return self._namespaced_index(namespace, "openai")[3]
+        index = self._index("openai")
+        if self._openai_chain is None or self._openai_chain[0] is not index:
+            self._openai_chain = (index, openai_model.create_chain(index))
+        return self._openai_chain[1]
+
+    def warm_up(self, models: Tuple[str, ...] = ("mdeberta",)) -> None:
+        if "mdeberta" in models:
+            self._mdeberta()
+            self._index("huggingf")
+        if "chatgpt" in models:
+            self._chatgpt()
+
+    def stats(self) -> dict:
+        if self._deberta is None or self._deberta.batcher is None:
+            return {"mdeberta": None}
+        return {
+            "mdeberta": self._deberta.batcher.stats(),
+            "passage_cache": self._deberta.passage_cache.stats(),
+        }
+
+    def ask(
+        self,
+        question: str,
+        model: str = "mdeberta",
+        site_id: str = "",
+        namespace: str = "",
+    ) -> dict:
+        """
+        Answer a question with one of the QA models.
+
+        Args:
+            question (str): The user question.
+            model (str, optional): "mdeberta", "chatgpt" or "site".
+            site_id (str, optional): Id returned by `crawl`, required by "site".
+            namespace (str, optional): Also search the files ingested in this
+                namespace, on top of the shared knowledge base.
+
+        Returns:
+            dict: The answer and its sources.
+        """
+        if model not in MODELS:
+            raise ValueError(f"model must be one of {MODELS}, got {model!r}")
+        if model == "mdeberta":
+            if namespace:
+                index = self._namespaced_index(namespace, "huggingf")[2]
+            else:
+                index = self._index("huggingf")
+            answer, sources = self._mdeberta().run(question, index)
+        elif model == "chatgpt":
+            answer, sources = openai_model.run(self._chatgpt(namespace), question)
+        else:
+            answer, sources = ask_site.run(self._site_chain(site_id), question)
+            sources = ", ".join(sorted(sources))
+        return {"model": model, "answer": answer, "sources": sources}
+
+    def ingest(
+        self,
+        files: List[Tuple[str, bytes]],
+        embeddings: List[str],
+        namespace: str = "",
+    ) -> dict:
+        """
+        Index uploaded files and reload the affected indexes.
+
+        Args:
+            files (List[Tuple[str, bytes]]): File names and contents (.txt or .pdf).
+            embeddings (List[str]): Embedding models to index with ("huggingf",
+                "openai").
+            namespace (str, optional): Index the files in the overlay of this
+                namespace instead of the shared knowledge base.
+
+        Returns:
+            dict: The indexed file names and embeddings.
+        """
+        result = {"files": [name for name, _ in files], "embeddings": embeddings}
+        if namespace:
+            with namespaces.namespace_lock(namespace), namespaces.upload_folder(
+                namespace
+            ) as upload_path:
+                _write_files(files, upload_path)
+                for embedding_name in embeddings:
+                    namespaces.create_overlay_index(
+                        namespace, embedding_name, upload_path
+                    )
+            namespaces.start_cleanup()
+            return {**result, "namespace": namespace}
+
+        with utils.data_lock():
+            _write_files(files, utils.DATA_PATH)
+            try:
+                for embedding_name in embeddings:
+                    create_knowledge_base.create_index(embedding_name)
+            finally:
+                utils.remove_files()
+        for embedding_name in embeddings:
+            self._index(embedding_name)
+        return result
+
+    def crawl(self, site: str, entire_site: bool = False) -> dict:
+        """
+        Scrape a site and build its QA chain.
+
+        Args:
+            site (str): The site url.
+            entire_site (bool, optional): Whether to follow every link of the domain.
+
+        Returns:
+            dict: The site id to be used with `ask` and the scraped urls.
+        """
+        canonical_links = dict()
+        with ask_site.crawl_lock:
+            ask_site.urls.clear()
+            if entire_site:
+                site_urls = list(ask_site.get_urls(site, canonical_links))
+            else:
+                site_urls = [site]
+        site_id = ask_site.site_id(site_urls)
+        chain = ask_site.create_site_chain(site_urls, canonical_links)
+        with self._load_lock:
+            self._site_chains[site_id] = chain
+            self._site_chains.move_to_end(site_id)
+            while len(self._site_chains) > MAX_SITE_CHAINS:
+                self._site_chains.popitem(last=False)
+        return {"site_id": site_id, "urls": site_urls}
+
+
+def _write_files(files: List[Tuple[str, bytes]], folder: str) -> None:
+    for name, content in files:
+        path = os.path.join(folder, os.path.basename(name))
+        if path.endswith(".pdf"):
+            with open(path, "wb") as file:
+                file.write(content)
+            utils.pdf_to_txt(path, path)
+            os.remove(path)
+        else:
+            with open(path, "w", encoding="utf-8") as file:
+                file.write(content.decode("utf-8"))
+
+
+def read_files(paths: List[str]) -> List[Tuple[str, bytes]]:
+    files = list()
+    for path in paths:
+        with open(path, "rb") as file:
+            files.append((os.path.basename(path), file.read()))
+    return files
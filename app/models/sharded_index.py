@@ -0,0 +1,390 @@
+import contextlib
+import fcntl
+import heapq
+import itertools
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores import FAISS
+
+from app.models import metrics
+
+
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = ".lock"
+SHARD_MAX_VECTORS = int(os.environ.get("SHARD_MAX_VECTORS", 50000))
+SEARCH_WORKERS = min(8, os.cpu_count() or 1)
+
+logger = logging.getLogger(__name__)
+
+_locks: Dict[str, threading.Lock] = dict()
+_locks_guard = threading.Lock()
+_compacting = set()
+
+
+def is_sharded(index_path: str) -> bool:
+    return os.path.exists(os.path.join(index_path, MANIFEST_FILE))
+
+
+def load_manifest(index_path: str) -> dict:
+    with open(os.path.join(index_path, MANIFEST_FILE), encoding="utf-8") as file:
+        return json.load(file)
+
+
+def _save_manifest(index_path: str, manifest: dict) -> None:
+    # readers only ever see the old or the new manifest
+    path = os.path.join(index_path, MANIFEST_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=2)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+
+
+def _new_shard_name(manifest: dict) -> str:
+    name = f"shard-{manifest['next_id']:04d}"
+    manifest["next_id"] += 1
+    return name
+
+
+@contextlib.contextmanager
+def index_lock(index_path: str) -> Iterator[None]:
+    """Serialize the writers of a sharded index, across threads and processes."""
+    index_path = os.path.abspath(index_path)
+    with _locks_guard:
+        lock = _locks.setdefault(index_path, threading.Lock())
+    os.makedirs(index_path, exist_ok=True)
+    with lock, open(os.path.join(index_path, LOCK_FILE), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _build_shard(
+    texts: List[str],
+    vectors: List[List[float]],
+    metadatas: List[dict],
+    embeddings: Embeddings,
+) -> FAISS:
+    return FAISS.from_embeddings(
+        list(zip(texts, vectors)), embeddings, metadatas=metadatas
+    )
+
+
+def _index_contents(index: FAISS) -> Tuple[List[str], List[List[float]], List[dict]]:
+    """Read back the texts, vectors and metadata of an index, without embedding."""
+    total = index.index.ntotal
+    vectors = index.index.reconstruct_n(0, total).tolist() if total else []
+    docs = [index.docstore.search(index.index_to_docstore_id[i]) for i in range(total)]
+    return [doc.page_content for doc in docs], vectors, [doc.metadata for doc in docs]
+
+
+class ShardedIndex:
+    """
+    Search the shards of a sharded index in parallel and merge their results.
+
+    The query is embedded once and every shard is searched for `k` results in a
+    thread pool (FAISS releases the GIL while searching), then the best `k` by
+    distance are kept. It exposes the search methods of `FAISS` used by the readers,
+    the retrievers and `NamespacedIndex`.
+    """
+
+    def __init__(
+        self,
+        shards: List[FAISS],
+        embeddings: Embeddings,
+        max_workers: int = SEARCH_WORKERS,
+    ) -> None:
+        self.shards = shards
+        self.embeddings = embeddings
+        self._executor = None
+        if len(shards) > 1:
+            self._executor = ThreadPoolExecutor(
+                max_workers=max(1, min(max_workers, len(shards)))
+            )
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: List[float], k: int = 4
+    ) -> List[Tuple[Document, float]]:
+        if self._executor is None:
+            if not self.shards:
+                return []
+            return self.shards[0].similarity_search_with_score_by_vector(embedding, k=k)
+        with metrics.span("sharded_index.search"):
+            results = self._executor.map(
+                lambda shard: shard.similarity_search_with_score_by_vector(
+                    embedding, k=k
+                ),
+                self.shards,
+            )
+            return heapq.nsmallest(
+                k,
+                itertools.chain.from_iterable(results),
+                key=lambda doc_score: doc_score[1],
+            )
+
+    def similarity_search_with_score(
+        self, query: str, k: int = 4
+    ) -> List[Tuple[Document, float]]:
+        vector = self.embeddings.embed_query(query)
+        return self.similarity_search_with_score_by_vector(vector, k=k)
+
+    def similarity_search(self, query: str, k: int = 4) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k)]
+
+
+def load_sharded_index(index_path: str, embeddings: Embeddings) -> ShardedIndex:
+    """
+    Load every shard listed in the manifest of `index_path`.
+
+    Returns:
+        ShardedIndex: The shards, searched together.
+    """
+    for attempt in range(2):
+        manifest = load_manifest(index_path)
+        paths = [
+            os.path.join(index_path, shard["path"]) for shard in manifest["shards"]
+        ]
+        try:
+            with ThreadPoolExecutor(max_workers=SEARCH_WORKERS) as executor:
+                shards = list(
+                    executor.map(
+                        lambda path: FAISS.load_local(
+                            folder_path=path, embeddings=embeddings
+                        ),
+                        paths,
+                    )
+                )
+        except (OSError, RuntimeError):
+            # a compaction replaced a shard between reading the manifest and loading
+            if attempt:
+                raise
+            continue
+        return ShardedIndex(shards, embeddings)
+
+
+def add_documents(
+    index_path: str,
+    documents: List[Document],
+    embeddings: Embeddings,
+    max_vectors: Optional[int] = None,
+) -> dict:
+    """
+    Add documents to a sharded index.
+
+    The documents are embedded once, then they fill the active (last) shard up to
+    `max_vectors` and the rest goes to new shards, so only the active shard is ever
+    rewritten. Shards are written to new folders and the manifest is replaced at the
+    end, so a crash leaves the previous version of the index intact.
+
+    Args:
+        index_path (str): Folder of the sharded index.
+        documents (List[Document]): The chunks to add.
+        embeddings (Embeddings): The embedding model of the index.
+        max_vectors (int, optional): Vectors per shard, the manifest value by
+            default.
+
+    Returns:
+        dict: The new manifest.
+    """
+    texts = [doc.page_content for doc in documents]
+    metadatas = [doc.metadata for doc in documents]
+    with metrics.span("sharded_index.embed"):
+        vectors = embeddings.embed_documents(texts)
+
+    with index_lock(index_path):
+        manifest = load_manifest(index_path)
+        max_vectors = max_vectors or manifest["max_vectors"]
+        shards, stale, position = manifest["shards"], list(), 0
+        with metrics.span("sharded_index.write"):
+            if shards and shards[-1]["vectors"] < max_vectors and texts:
+                active = shards[-1]
+                position = max_vectors - active["vectors"]
+                index = FAISS.load_local(
+                    folder_path=os.path.join(index_path, active["path"]),
+                    embeddings=embeddings,
+                )
+                index.merge_from(
+                    _build_shard(
+                        texts[:position],
+                        vectors[:position],
+                        metadatas[:position],
+                        embeddings,
+                    )
+                )
+                name = _new_shard_name(manifest)
+                index.save_local(os.path.join(index_path, name))
+                stale.append(active["path"])
+                active.update(path=name, vectors=index.index.ntotal)
+            for start in range(position, len(texts), max_vectors):
+                stop = start + max_vectors
+                shard = _build_shard(
+                    texts[start:stop],
+                    vectors[start:stop],
+                    metadatas[start:stop],
+                    embeddings,
+                )
+                name = _new_shard_name(manifest)
+                shard.save_local(os.path.join(index_path, name))
+                shards.append({"path": name, "vectors": shard.index.ntotal})
+            _save_manifest(index_path, manifest)
+        for path in stale:
+            shutil.rmtree(os.path.join(index_path, path), ignore_errors=True)
+    metrics.count("sharded_index_vectors", len(texts))
+    return manifest
+
+
+def _compaction_groups(shards: List[dict], max_vectors: int) -> List[List[dict]]:
+    groups, group, size = list(), list(), 0
+    for shard in shards:
+        if group and size + shard["vectors"] > max_vectors:
+            groups.append(group)
+            group, size = list(), 0
+        group.append(shard)
+        size += shard["vectors"]
+    groups.append(group)
+    return [group for group in groups if len(group) > 1]
+
+
+def compact(
+    index_path: str, embeddings: Embeddings, max_vectors: Optional[int] = None
+) -> int:
+    """
+    Merge the neighbour sealed shards that fit together in `max_vectors`.
+
+    Only the sealed shards (every shard but the active one) are compacted. They are
+    never written by `add_documents`, so the merged shards are built without holding
+    the index lock, which is only taken to reserve the new shard names and to swap
+    the manifest.
+
+    Returns:
+        int: The number of shards removed.
+    """
+    with index_lock(index_path):
+        manifest = load_manifest(index_path)
+        max_vectors = max_vectors or manifest["max_vectors"]
+        groups = _compaction_groups(manifest["shards"][:-1], max_vectors)
+        if not groups:
+            return 0
+        names = [_new_shard_name(manifest) for _ in groups]
+        _save_manifest(index_path, manifest)
+
+    merged = dict()
+    with metrics.span("sharded_index.compact"):
+        for name, group in zip(names, groups):
+            indexes = [
+                FAISS.load_local(
+                    folder_path=os.path.join(index_path, shard["path"]),
+                    embeddings=embeddings,
+                )
+                for shard in group
+            ]
+            for index in indexes[1:]:
+                indexes[0].merge_from(index)
+            indexes[0].save_local(os.path.join(index_path, name))
+            merged[name] = (group, indexes[0].index.ntotal)
+
+    removed, swapped = list(), 0
+    with index_lock(index_path):
+        manifest = load_manifest(index_path)
+        for name, (group, vectors) in merged.items():
+            paths = [shard["path"] for shard in group]
+            current = [shard["path"] for shard in manifest["shards"]]
+            if not all(path in current for path in paths):
+                shutil.rmtree(os.path.join(index_path, name), ignore_errors=True)
+                continue
+            position = current.index(paths[0])
+            manifest["shards"] = [
+                shard for shard in manifest["shards"] if shard["path"] not in paths
+            ]
+            manifest["shards"].insert(position, {"path": name, "vectors": vectors})
+            removed.extend(paths)
+            swapped += 1
+        _save_manifest(index_path, manifest)
+    for path in removed:
+        shutil.rmtree(os.path.join(index_path, path), ignore_errors=True)
+    return len(removed) - swapped
+
+
+def start_compaction(
+    index_path: str, embeddings: Embeddings, max_vectors: Optional[int] = None
+) -> Optional[threading.Thread]:
+    """Run `compact` in a background thread, unless one is running for the index."""
+    index_path = os.path.abspath(index_path)
+    with _locks_guard:
+        if index_path in _compacting:
+            return None
+        _compacting.add(index_path)
+
+    def run():
+        try:
+            removed = compact(index_path, embeddings, max_vectors)
+            if removed:
+                logger.info("Compacted %d shards of %s", removed, index_path)
+        except Exception:
+            logger.exception("Compaction of %s failed", index_path)
+        finally:
+            with _locks_guard:
+                _compacting.discard(index_path)
+
+    thread = threading.Thread(target=run, name="shard-compaction", daemon=True)
+    thread.start()
+    return thread
+
+
+def migrate(
+    index_path: str, embeddings: Embeddings, max_vectors: Optional[int] = None
+) -> dict:
+    """
+    Convert the single FAISS index of `index_path` to the sharded format.
+
+    The vectors are read back from the index, nothing is embedded again. When there
+    is no index yet, an empty sharded index is created.
+
+    Returns:
+        dict: The manifest.
+    """
+    max_vectors = max_vectors or SHARD_MAX_VECTORS
+    with index_lock(index_path):
+        if is_sharded(index_path):
+            return load_manifest(index_path)
+        manifest = {
+            "version": 1,
+            "next_id": 0,
+            "max_vectors": max_vectors,
+            "shards": [],
+        }
+        legacy_files = [
+            os.path.join(index_path, name) for name in ("index.faiss", "index.pkl")
+        ]
+        legacy = os.path.exists(legacy_files[0])
+        if legacy:
+            texts, vectors, metadatas = _index_contents(
+                FAISS.load_local(folder_path=index_path, embeddings=embeddings)
+            )
+            for start in range(0, len(texts), max_vectors):
+                stop = start + max_vectors
+                shard = _build_shard(
+                    texts[start:stop],
+                    vectors[start:stop],
+                    metadatas[start:stop],
+                    embeddings,
+                )
+                name = _new_shard_name(manifest)
+                shard.save_local(os.path.join(index_path, name))
+                manifest["shards"].append({"path": name, "vectors": shard.index.ntotal})
+        _save_manifest(index_path, manifest)
+        if legacy:
+            for path in legacy_files:
+                if os.path.exists(path):
+                    os.remove(path)
+    return manifest
@@ -1,13 +1,25 @@
 import re
 from pypdf import PdfReader
+import bisect
+import contextlib
+import fcntl
+import json
+import multiprocessing
 import os
+import shutil
+import threading
+import time
 import streamlit as st
-from typing import Union, Tuple, Any, List
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING, Union, Tuple, Any, Dict, Iterator, List, Optional
 
-from langchain.embeddings import HuggingFaceEmbeddings
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.embeddings.base import Embeddings
-from langchain.vectorstores import FAISS
+if TYPE_CHECKING:
+    # langchain and the modules built on it are imported by the functions that
+    # use them, so importing utils stays cheap for the pages
+    from langchain.embeddings.base import Embeddings
+    from langchain.vectorstores import FAISS
+
+    from app.models.sharded_index import ShardedIndex
 
 
 APP_PATH = os.path.dirname(os.path.abspath(__file__ + "/../"))
@@ -15,11 +27,141 @@ DATA_PATH = os.path.join(APP_PATH, "data")
 OPENAI_INDEX_PATH = os.path.join(DATA_PATH, "index_openai")
 HF_INDEX_PATH = os.path.join(DATA_PATH, "index_hf")
 EMBEDDING_MODEL = "intfloat/multilingual-e5-base"
+READER_MODEL = "timpal0l/mdeberta-v3-base-squad2"
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch")
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", 32))
+# torch threads of the process, shared by the embedding engine and the mDeBERTa
+# reader, the torch default when not set
+TORCH_THREADS = int(os.environ.get("TORCH_THREADS", 0)) or None
+EMBEDDING_SCHEME_FILE = "embedding_scheme.txt"
+# e5 "query: "/"passage: " prefixes, see `LocalEmbeddings`
+PREFIXED_EMBEDDING_SCHEME = "e5-prefixed"
+# no prefixes, the indexes built with `HuggingFaceEmbeddings` before the schemes
+PLAIN_EMBEDDING_SCHEME = "plain"
+# resume state of interrupted embedding runs, kept out of `DATA_PATH`, which
+# `remove_files` empties
+CHECKPOINTS_PATH = os.environ.get(
+    "CHECKPOINTS_PATH", os.path.join(APP_PATH, ".checkpoints")
+)
+EMBEDDING_PROGRESS_PATH = os.path.join(CHECKPOINTS_PATH, "embeddings")
+# a folder, `remove_files` only removes the files of `DATA_PATH`
+LOCKS_PATH = os.path.join(DATA_PATH, "locks")
+PAGES_SUFFIX = ".pages.json"
+# marks the folders swapped out by `replace_directory`, which keeps them for
+# REPLACED_GRACE seconds so the readers that resolved the old link can finish
+REPLACED_FILE = ".replaced"
+REPLACED_GRACE = int(os.environ.get("REPLACED_GRACE", 10 * 60))
+PAGE_MARKER = "#page="
+PARALLEL_MIN_PAGES = 100
+PDF_WORKERS = min(4, os.cpu_count() or 1)
+
+SPACES_PATTERN = re.compile(r"\s+")
+HYPHEN_PATTERN = re.compile(r"\s*-\s*")
+
+
+_data_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def data_lock() -> Iterator[None]:
+    """
+    Hold the lock of `DATA_PATH` and of the shared indexes.
+
+    The lock is taken across the threads and the processes of the app, so the
+    service and the command line never write the uploads or the indexes at once.
+    """
+    os.makedirs(LOCKS_PATH, exist_ok=True)
+    with _data_lock, open(os.path.join(LOCKS_PATH, "data.lock"), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def index_version(index_path: str) -> float:
+    """
+    Modification time of an index, 0 when there is none.
+
+    It changes whenever the index is written, merged or swapped, so it tells the
+    processes that keep an index in memory when to load it again.
+    """
+    from app.models import sharded_index
+
+    for name in (sharded_index.MANIFEST_FILE, "index.faiss"):
+        path = os.path.join(index_path, name)
+        if os.path.exists(path):
+            return os.stat(path).st_mtime
+    return 0.0
+
+
+@st.cache_resource
+def load_local_embeddings() -> "Embeddings":
+    """
+    Load the local embedding engine once and share it between indexing and queries.
+
+    torch and transformers are imported here, on first use, to keep them out of the
+    start-up of the pages that do not need them.
+
+    The backend ("torch", "int8" or "onnx") and the batch size are read from the
+    `EMBEDDING_BACKEND` and `EMBEDDING_BATCH_SIZE` environment variables.
+    """
+    from app.models.local_embeddings import LocalEmbeddings
+
+    set_torch_threads()
+    return LocalEmbeddings(
+        model_name=EMBEDDING_MODEL,
+        backend=EMBEDDING_BACKEND,
+        batch_size=EMBEDDING_BATCH_SIZE,
+    )
+
+
+_torch_threads_set = False
+
+
+def set_torch_threads() -> None:
+    """Apply `TORCH_THREADS` once per process, before the first torch model runs."""
+    global _torch_threads_set
+    if TORCH_THREADS and not _torch_threads_set:
+        import torch
+
+        torch.set_num_threads(TORCH_THREADS)
+        _torch_threads_set = True
+
+
+def index_embedding_scheme(index_path: str) -> Optional[str]:
+    """
+    The embedding scheme an index was built with, see `LocalEmbeddings.scheme`.
+
+    The indexes without a recorded scheme were built with plain
+    `HuggingFaceEmbeddings`. Returns None when there is no index at `index_path`.
+    """
+    from app.models import sharded_index
+
+    path = os.path.join(index_path, EMBEDDING_SCHEME_FILE)
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as file:
+            return file.read().strip()
+    if any(
+        os.path.exists(os.path.join(index_path, name))
+        for name in ("index.faiss", sharded_index.MANIFEST_FILE)
+    ):
+        return PLAIN_EMBEDDING_SCHEME
+    return None
+
+
+def write_embedding_scheme(index_path: str, embeddings: "Embeddings") -> None:
+    scheme = getattr(embeddings, "scheme", None)
+    if scheme:
+        with open(
+            os.path.join(index_path, EMBEDDING_SCHEME_FILE), "w", encoding="utf-8"
+        ) as file:
+            file.write(scheme)
 
 
 def setup_for_embeddings(
     embedding_model: str, return_embeddings: bool = False
-) -> Union[Tuple[str, Embeddings], str]:
+) -> Union[Tuple[str, "Embeddings"], str]:
     """
     Set up the environment by providing the path for working with text embeddings.
 
@@ -34,11 +176,11 @@ def setup_for_embeddings(
     Returns:
         Union[Tuple[str, Embeddings], str]: Depending on the `return_embeddings` flag:
             - If `return_embeddings` is True and `embedding_model` is "openai", returns
-              a tuple containing the path to the OpenAI index and an OpenAIEmbeddings
-              object.
+              a tuple containing the path to the OpenAI index and a
+              BatchedOpenAIEmbeddings object.
             - If `return_embeddings` is True and `embedding_model` is not "openai",
               returns a tuple containing the path to the Hugging Face index and a
-              HuggingFaceEmbeddings object.
+              LocalEmbeddings object.
             - If `return_embeddings` is False and `embedding_model` is "openai", returns
               the path to the OpenAI index.
             - If `return_embeddings` is False and `embedding_model` is not "openai",
@@ -46,63 +188,125 @@ def setup_for_embeddings(
     """
     if return_embeddings:
         if embedding_model.lower() == "openai":
-            return OPENAI_INDEX_PATH, OpenAIEmbeddings(
+            from app.models.embedding_client import BatchedOpenAIEmbeddings
+
+            return OPENAI_INDEX_PATH, BatchedOpenAIEmbeddings(
                 model="text-embedding-ada-002",
+                progress_path=EMBEDDING_PROGRESS_PATH,
             )
-        return HF_INDEX_PATH, HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+        embeddings = load_local_embeddings()
+        if index_embedding_scheme(HF_INDEX_PATH) == PLAIN_EMBEDDING_SCHEME:
+            # queries and new chunks must match the vectors already in the index,
+            # until it is embedded again with `reembed_index`
+            embeddings = embeddings.with_prefixes("", "")
+        return HF_INDEX_PATH, embeddings
     if embedding_model.lower() == "openai":
         return OPENAI_INDEX_PATH
     return HF_INDEX_PATH
 
 
-def get_index(model_name: str = "huggingf") -> FAISS:
+def get_index(model_name: str = "huggingf") -> Union["FAISS", "ShardedIndex"]:
+    from langchain.vectorstores import FAISS
+
+    from app.models import sharded_index
+
     index_path, embeddings = setup_for_embeddings(model_name, return_embeddings=True)
+    if sharded_index.is_sharded(index_path):
+        return sharded_index.load_sharded_index(index_path, embeddings)
     index = FAISS.load_local(folder_path=index_path, embeddings=embeddings)
     return index
 
 
-@st.cache_resource
-def load_indexes(index_change: int = 0) -> FAISS:
+_worker_reader = None
+
+
+def _init_pdf_worker(path: str) -> None:
+    global _worker_reader
+    # each worker opens the file itself; pypdf copies a file given by path in
+    # memory, a file object is only read as the pages are extracted
+    _worker_reader = PdfReader(open(path, "rb"))
+
+
+def _extract_pages(start: int, stop: int) -> List[str]:
+    return [
+        _clean_text(_worker_reader.pages[number].extract_text())
+        for number in range(start, stop)
+    ]
+
+
+def _iter_pdf_pages(file: Any) -> Iterator[str]:
     """
-    Load a FAISS index for similarity search.
+    Yield the cleaned text of each page of a PDF, in order.
 
-    Args:
-        index_change (int, optional): trick parameter to force streamlit to re-load
-        index each time a new `index_change` is provided.
+    Small PDFs, and PDFs given as file objects, are read page by page in this
+    process. PDFs on disk with at least `PARALLEL_MIN_PAGES` pages are split in page
+    ranges that are extracted by a process pool, each worker opening the file; the
+    ranges are still yielded in order, as soon as they are ready.
+    """
+    path = file if isinstance(file, (str, os.PathLike)) else None
+    with contextlib.ExitStack() as stack:
+        if path:
+            file = stack.enter_context(open(path, "rb"))
+        reader = PdfReader(file)
+        total_pages = len(reader.pages)
+        if total_pages < PARALLEL_MIN_PAGES or PDF_WORKERS < 2 or path is None:
+            for page in reader.pages:
+                yield _clean_text(page.extract_text())
+            return
+
+    step = -(-total_pages // (PDF_WORKERS * 4))
+    starts = list(range(0, total_pages, step))
+    stops = [min(start + step, total_pages) for start in starts]
+    # the pool is started from threads of a process with torch and FAISS loaded,
+    # forking it could copy a lock held by another thread into the workers
+    with ProcessPoolExecutor(
+        max_workers=PDF_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_pdf_worker,
+        initargs=(path,),
+    ) as executor:
+        for pages in executor.map(_extract_pages, starts, stops):
+            yield from pages
 
-    Returns:
-        FAISS: The loaded FAISS index for similarity search.
 
-    Note:
-    - This function may be used with Streamlit's `st.cache_resource` decorator to
-      efficiently cache and retrieve the index.
+def _clean_text(text: str) -> str:
+    no_spaces_text = SPACES_PATTERN.sub(" ", text.replace("\r", "")).strip()
+    return HYPHEN_PATTERN.sub("-", no_spaces_text)
+
+
+def load_page_offsets(txt_path: str) -> List[int]:
     """
-    if index_change:
-        return get_index("huggingf")
-    return get_index("huggingf")
+    Load the page start offsets saved by `pdf_to_txt` for a text file.
 
+    Returns:
+        List[int]: The character offset where each page starts, or an empty list if
+        the text file did not come from a PDF.
+    """
+    pages_path = os.path.splitext(txt_path)[0] + PAGES_SUFFIX
+    if not os.path.exists(pages_path):
+        return []
+    with open(pages_path, encoding="utf-8") as file:
+        return json.load(file)["page_starts"]
 
-def _pdf_reader(file: Any) -> str:
-    reader = PdfReader(file)
-    total_pages = len(reader.pages)
 
-    pdf_content = ""
-    for page_number in range(total_pages):
-        page = reader.pages[page_number]
-        pdf_content += page.extract_text()
-    return pdf_content
+def page_for_offset(page_starts: List[int], offset: int) -> int:
+    """Return the 1-based page number of a character offset."""
+    return max(bisect.bisect_right(page_starts, offset), 1)
 
 
-def _clean_text(text: str) -> str:
-    lines = text.replace("\r", "").split("\n")
-    cleaned_lines = " ".join([line.strip() for line in lines if line.strip()])
-    no_spaces_text = re.sub(r"\s+", " ", cleaned_lines)
-    return re.sub(r"\s*-\s*", "-", no_spaces_text)
+def format_source(metadata: Dict[str, Any]) -> str:
+    """Return the source of a chunk, pointing to its page when it is known."""
+    if metadata.get("page"):
+        return f"{metadata['source']}{PAGE_MARKER}{metadata['page']}"
+    return metadata["source"]
 
 
 def _get_file_name(path: str) -> str:
+    path, _, page = path.partition(PAGE_MARKER)
     normalized_path = os.path.normpath(path.replace("\\", "/"))
     basename = os.path.basename(normalized_path)
+    if page:
+        return f"{os.path.splitext(basename)[0]} (p. {page})"
     return os.path.splitext(basename)[0]
 
 
@@ -133,9 +337,11 @@ def pdf_to_txt(file: str, path: str) -> None:
     Convert a PDF file to plain text and save it.
 
     This function takes the path to a PDF file (`file`) and a destination path (`path`)
-    where the plain text content will be saved. It reads the content of the PDF file,
-    cleans the text, and saves it as a text file with the same name as the PDF file
-    but with a ".txt" extension.
+    where the plain text content will be saved. It reads the PDF page by page, cleans
+    the text of each page, and writes it incrementally to a text file with the same
+    name as the PDF file but with a ".txt" extension, so the whole document is never
+    held in memory. The character offset where each page starts is saved next to it,
+    in a ".pages.json" file, to be used as chunk metadata (see `load_page_offsets`).
 
     Args:
         file (str): The path to the PDF file to be converted.
@@ -145,29 +351,86 @@ def pdf_to_txt(file: str, path: str) -> None:
         None
 
     Note:
-    - The function uses the `_pdf_reader` function to extract text content from the PDF.
+    - Large PDFs are extracted in parallel by `_iter_pdf_pages`.
     - The extracted text is cleaned using the `_clean_text` function before saving it
       as a text file.
     """
     save_path = path.replace(".pdf", ".txt")
-    pdf_content = _pdf_reader(file)
+    page_starts, offset = [], 0
 
-    cleaned_content = _clean_text(pdf_content)
+    with open(save_path, "w", encoding="utf-8") as txt_file:
+        for page_text in _iter_pdf_pages(file):
+            if offset:
+                txt_file.write(" ")
+                offset += 1
+            page_starts.append(offset)
+            txt_file.write(page_text)
+            offset += len(page_text)
 
-    with open(save_path, "w", encoding="utf-8") as file:
-        file.write(cleaned_content)
+    pages_path = os.path.splitext(save_path)[0] + PAGES_SUFFIX
+    with open(pages_path, "w", encoding="utf-8") as pages_file:
+        json.dump({"page_starts": page_starts}, pages_file)
 
 
-def remove_files() -> None:
+def remove_files(path: str = DATA_PATH) -> None:
     """
     Remove all files in a specified directory.
 
-    This function iterates through all items in the directory specified by `DATA_PATH`
-    and removes any files found. It does not remove directories or subdirectories.
+    This function iterates through all items in the directory specified by `path`
+    (`DATA_PATH` by default) and removes any files found. It does not remove
+    directories or subdirectories.
+
+    Args:
+        path (str, optional): The directory to clean.
 
     Returns:
         None
     """
-    for item in os.listdir(DATA_PATH):
-        if os.path.isfile(item_path := os.path.join(DATA_PATH, item)):
+    for item in os.listdir(path):
+        if os.path.isfile(item_path := os.path.join(path, item)):
             os.remove(item_path)
+
+
+def replace_directory(source: str, target: str) -> None:
+    """
+    Make `target` point to the folder `source` in a single atomic step.
+
+    `target` becomes a symbolic link to `source`, replaced with `os.replace`, so a
+    reader opening `target` sees either the previous or the new folder, never a
+    partially written one. The previous folder is not removed right away, a reader
+    may still be loading it: it is marked as replaced and removed by a later swap
+    of the same `target`, once it has been replaced for `REPLACED_GRACE` seconds.
+
+    Args:
+        source (str): The new version of the folder, next to `target`.
+        target (str): The path that readers open.
+
+    Returns:
+        None
+    """
+    source = os.path.abspath(source)
+    previous = os.path.realpath(target) if os.path.islink(target) else None
+    if os.path.isdir(target) and not os.path.islink(target):
+        # a folder written before the swaps were introduced
+        shutil.rmtree(target)
+    link = target + ".swap"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(source, link)
+    os.replace(link, target)
+    if previous and previous != source and os.path.isdir(previous):
+        with open(os.path.join(previous, REPLACED_FILE), "w") as file:
+            file.write(str(time.time()))
+    _remove_replaced(target)
+
+
+def _remove_replaced(target: str) -> None:
+    # the folders of `target` swapped out more than REPLACED_GRACE seconds ago, the
+    # folders still being written have no marker and are left alone
+    parent, name = os.path.split(os.path.abspath(target))
+    for item in os.listdir(parent):
+        marker = os.path.join(parent, item, REPLACED_FILE)
+        if not item.startswith(f"{name}.") or not os.path.exists(marker):
+            continue
+        if time.time() - os.path.getmtime(marker) >= REPLACED_GRACE:
+            shutil.rmtree(os.path.join(parent, item), ignore_errors=True)
@@ -0,0 +1,128 @@
+import importlib
+import logging
+import os
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+PROFILE_ENV = "APP_STARTUP_PROFILE"
+HEAVY_MODULES = (
+    "torch",
+    "transformers",
+    "sentence_transformers",
+    "faiss",
+    "langchain",
+    "langchain.vectorstores",
+    "langchain.chains",
+    "tiktoken",
+    "langdetect",
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Warmup:
+    """
+    Load resources in background threads and report when they are ready.
+
+    Each resource is loaded once per name, by the first `start` call; later calls
+    with the same name are ignored unless the previous load failed. `get` blocks
+    until the resource is loaded and re-raises the error of a failed loader.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events: Dict[str, threading.Event] = dict()
+        self._values: Dict[str, Any] = dict()
+        self._errors: Dict[str, BaseException] = dict()
+        self._durations: Dict[str, float] = dict()
+
+    def start(self, name: str, loader: Callable[[], Any]) -> None:
+        with self._lock:
+            if name in self._events and name not in self._errors:
+                return
+            self._errors.pop(name, None)
+            self._events[name] = threading.Event()
+        thread = threading.Thread(
+            target=self._load, args=(name, loader), name=f"warmup-{name}", daemon=True
+        )
+        thread.start()
+
+    def _load(self, name: str, loader: Callable[[], Any]) -> None:
+        start = time.perf_counter()
+        try:
+            self._values[name] = loader()
+        except BaseException as error:
+            logger.exception("Warm-up of %s failed", name)
+            self._errors[name] = error
+        finally:
+            self._durations[name] = time.perf_counter() - start
+            self._events[name].set()
+
+    def ready(self, name: str) -> bool:
+        event = self._events.get(name)
+        return bool(event and event.is_set() and name not in self._errors)
+
+    def get(self, name: str, timeout: Optional[float] = None) -> Any:
+        if name not in self._events:
+            raise KeyError(f"{name!r} was never started")
+        if not self._events[name].wait(timeout):
+            raise TimeoutError(f"{name!r} is still loading")
+        if name in self._errors:
+            raise self._errors[name]
+        return self._values[name]
+
+    def status(self) -> Dict[str, str]:
+        status = dict()
+        for name, event in list(self._events.items()):
+            if not event.is_set():
+                status[name] = "loading"
+            elif name in self._errors:
+                status[name] = "failed"
+            else:
+                status[name] = f"ready ({self._durations[name]:.1f}s)"
+        return status
+
+
+def import_profile(modules: Iterable[str] = HEAVY_MODULES) -> List[Tuple[str, float]]:
+    """
+    Measure the import time of each module, in seconds.
+
+    Modules are imported in the given order, so a module only accounts for the
+    dependencies that were not imported before it. Modules that are already
+    imported report 0.0 and modules that are not installed are skipped.
+
+    Args:
+        modules (Iterable[str], optional): Module names to import.
+
+    Returns:
+        List[Tuple[str, float]]: Module names and their import times.
+    """
+    profile = list()
+    for module in modules:
+        if module in sys.modules:
+            profile.append((module, 0.0))
+            continue
+        start = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            continue
+        profile.append((module, time.perf_counter() - start))
+    return profile
+
+
+def log_startup_profile(modules: Iterable[str] = HEAVY_MODULES) -> None:
+    """
+    Log the import-time breakdown when the `APP_STARTUP_PROFILE` variable is set.
+
+    For a complete tree of every import, run the app with `python -X importtime`.
+    """
+    if not os.environ.get(PROFILE_ENV):
+        return
+    profile = import_profile(modules)
+    for module, seconds in profile:
+        logger.warning("import %-28s %7.3fs", module, seconds)
+    logger.warning("import total %.3fs", sum(seconds for _, seconds in profile))
@@ -1,22 +1,36 @@
-from models import create_knowledge_base, openai_model, mdeberta, utils
+from app.models import conversation, jobs, metrics, namespaces, utils
+from app.models.warmup import Warmup, log_startup_profile
 
+import importlib
 import os
-from io import StringIO
+import uuid
 import streamlit as st
 from streamlit_toggle import st_toggle_switch
 
 
-if "openai_change" not in st.session_state:
-    st.session_state["openai_change"] = 1
+@st.cache_resource
+def _get_warmup():
+    log_startup_profile()
+    return Warmup()
 
-if "huggingf_change" not in st.session_state:
-    st.session_state["huggingf_change"] = 1
 
-if os.environ.get("OPENAI_API_KEY"):
-    openai_chain = openai_model.load_chain(st.session_state["openai_change"])
+warmup = _get_warmup()
+job_queue = jobs.get_queue()
 
-index_hf = utils.load_indexes(index_change=st.session_state["huggingf_change"])
-mdeberta_model = mdeberta.load_model()
+
+def _session_namespace():
+    # kept in the url, so a reload finds the files and jobs of the session again
+    namespace = st.experimental_get_query_params().get("session", [""])[0]
+    if not namespaces.NAMESPACE_PATTERN.match(namespace):
+        namespace = uuid.uuid4().hex
+        st.experimental_set_query_params(session=namespace)
+    return namespace
+
+
+if "namespace" not in st.session_state:
+    st.session_state["namespace"] = _session_namespace()
+if "applied_jobs" not in st.session_state:
+    st.session_state["applied_jobs"] = set()
 
 avatars = {
     "user": "\U0001F600",
@@ -32,6 +46,53 @@ embedding_models = {
 }
 
 
+def _load_mdeberta():
+    mdeberta = importlib.import_module("app.models.mdeberta")
+    model = mdeberta.DeBerta()
+    model.enable_batching()
+    return model
+
+
+loaders = {
+    "mdeberta": _load_mdeberta,
+    "index_hf": lambda: utils.get_index("huggingf"),
+    "index_openai": lambda: utils.get_index("openai"),
+}
+model_resources = {
+    "mdeberta": ["mdeberta", "index_hf"],
+    "chatgpt": ["index_openai"],
+}
+base_indexes = {"huggingf": "index_hf", "openai": "index_openai"}
+
+
+def _start_warmup(models_selected):
+    for model in models_selected:
+        for name in model_resources[model]:
+            warmup.start(name, loaders[name])
+
+
+def _readiness_indicator():
+    for name, status in warmup.status().items():
+        st.caption(f"{name}: {status}")
+
+
+def _get_resource(name):
+    if not warmup.ready(name):
+        with st.spinner(f"Loading {name}..."):
+            return warmup.get(name)
+    return warmup.get(name)
+
+
+def _session_index(embedding_name):
+    key = f"session_index_{embedding_name}"
+    if key not in st.session_state:
+        base = _get_resource(base_indexes[embedding_name])
+        st.session_state[key] = namespaces.namespaced_index(
+            base, st.session_state["namespace"], embedding_name
+        )
+    return st.session_state[key]
+
+
 def _select_index_names():
     selected_indexes = [
         value
@@ -43,34 +104,62 @@ def _select_index_names():
     return selected_indexes
 
 
-def _save_files(uploaded_files):
-    for uploaded_file in uploaded_files:
-        path = os.path.join(utils.DATA_PATH, f"{uploaded_file.name}")
-        if uploaded_file.type.split(os.sep)[1] == "pdf":
-            utils.pdf_to_txt(uploaded_file, path)
-        else:
-            stringio = StringIO(uploaded_file.getvalue().decode("utf-8"))
-            string_data = stringio.read()
-            with open(path, "w", encoding="utf-8") as f:
-                f.write(string_data)
+def _submit_index_job(uploaded_files, selected_indexes):
+    namespace = st.session_state["namespace"]
+    files = [
+        (uploaded_file.name, uploaded_file.getvalue())
+        for uploaded_file in uploaded_files
+    ]
+    job_queue.submit(
+        "ingest",
+        {"namespace": namespace, "embeddings": selected_indexes},
+        owner=namespace,
+        files=files,
+    )
+    namespaces.start_cleanup()
     return None
 
 
-def _create_index_for_files(selected_indexes):
-    for index_name in selected_indexes:
-        st.session_state[f"{index_name}_change"] += 1
-        with st.spinner(f"Generating indexes for the {index_name} embeddings"):
-            create_knowledge_base.create_index(index_name)
-    utils.remove_files()
+def _apply_index_job(job):
+    # the overlay was swapped on disk, reload it on the next question
+    for index_name in job["params"]["embeddings"]:
+        st.session_state.pop(f"session_index_{index_name}", None)
+        if index_name == "openai":
+            st.session_state.pop("openai_chain", None)
+    st.session_state["applied_jobs"].add(job["id"])
     st.info("Generated Embeddings", icon="🔥")
 
 
+def _index_jobs_panel():
+    index_jobs = job_queue.list_jobs(st.session_state["namespace"], "ingest", limit=5)
+    for job in index_jobs:
+        if job["status"] in jobs.ACTIVE:
+            st.progress(job["progress"], text=job["message"] or "Waiting to start")
+            if st.button("Cancel", key=f"cancel_{job['id']}"):
+                job_queue.cancel(job["id"])
+        elif job["status"] == jobs.DONE:
+            if job["id"] not in st.session_state["applied_jobs"]:
+                _apply_index_job(job)
+        elif job["status"] == jobs.FAILED:
+            st.error(f"Indexing failed: {job['error']}", icon="🚨")
+    if any(job["status"] in jobs.ACTIVE for job in index_jobs):
+        st.button("Refresh", key="refresh_jobs")
+
+
 def _ask_gpt(query):
+    openai_model = importlib.import_module("app.models.openai_model")
+    if "openai_chain" not in st.session_state:
+        st.session_state["openai_chain"] = openai_model.create_chain(
+            _session_index("openai")
+        )
+    openai_chain = st.session_state["openai_chain"]
     answer, sources = openai_model.run(openai_chain, query)
     return {"role": "File_Assistent", "content": answer, "sources": sources}
 
 
 def _ask_mdeberta(query):
+    mdeberta_model = _get_resource("mdeberta")
+    index_hf = _session_index("huggingf")
     answer, sources = mdeberta_model.run(query, index_hf)
     return {"role": "mdeberta", "content": answer, "sources": sources}
 
@@ -88,7 +177,7 @@ def _no_model_selected_handler():
                     Please choose a model from the left-hand menu.",
         "sources": "code",
     }
-    st.session_state.messages.append(no_model_selected_answer)
+    _memory().add("assistant", no_model_selected_answer["content"])
     st.chat_message("assistant").write(no_model_selected_answer["content"])
 
 
@@ -116,6 +205,9 @@ def _sidebar():
         ]
         if "chatgpt" in models_selected:
             _no_api_key_handler()
+        _start_warmup(models_selected)
+        _readiness_indicator()
+        metrics.render_debug_panel()
 
         with st.expander("Upload your files"):
             selected_embeddings = _select_index_names()
@@ -127,32 +219,33 @@ def _sidebar():
             if uploaded_files is not None and submitted:
                 _no_embeddings_selected_handler(selected_embeddings)
 
-                _save_files(uploaded_files)
-                _create_index_for_files(selected_embeddings)
+                _submit_index_job(uploaded_files, selected_embeddings)
                 submitted = False
+            _index_jobs_panel()
     return models_selected
 
 
+def _memory():
+    return conversation.session_memory(
+        "file_qa_memory", "How can I help you?", role="fileQA_assistant"
+    )
+
+
 def main():
     models_selected = _sidebar()
     st.title("💬 Talk to your document")
-    if "messages" not in st.session_state:
-        st.session_state["messages"] = [
-            {"role": "fileQA_assistant", "content": "How can I help you?"}
-        ]
-
-    for msg in st.session_state.messages:
-        st.chat_message(msg["role"]).write(msg["content"])
+    memory = _memory()
+    conversation.render_history(memory)
 
     if query := st.chat_input():
         if not models_selected:
             _no_model_selected_handler()
         else:
-            st.session_state.messages.append({"role": "user", "content": query})
+            memory.add("user", query)
             st.chat_message("user", avatar=avatars["user"]).write(query)
             for model in models_selected:
                 model_response = generate_response(query=query, model_name=model)
-                st.session_state.messages.append(model_response)
+                memory.add(model_response["role"], model_response["content"])
                 msg = st.chat_message("assistant", avatar=avatars[model])
                 msg.write(f"{model.upper()}:")
                 msg.write(f"{model_response['content']}")
@@ -1,25 +1,69 @@
-from models import ask_site
+from app.models import ask_site, conversation, jobs, metrics
 
+import uuid
 import streamlit as st
 
 
+job_queue = jobs.get_queue()
+
+
+def _session_id():
+    # kept in the url, so a reload finds the crawl of the session again
+    session_id = st.experimental_get_query_params().get("session", [""])[0]
+    if not session_id.isalnum():
+        session_id = uuid.uuid4().hex
+        st.experimental_set_query_params(session=session_id)
+    return session_id
+
+
 if "site_chain" not in st.session_state:
     st.session_state["site_chain"] = None
+    st.session_state["site_job"] = None
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = _session_id()
 
 
 def _scrape_handler(site, scrape):
     if scrape:
-        urls = ask_site.get_urls(site)
         st.warning(
             "By selecting the 'Entire site' option, the reading of all pages on the \
             website will be performed.",
             icon="⚠️",
         )
-        st.session_state["site_chain"] = ask_site.load_site_chain(site=urls)
-    else:
-        st.session_state["site_chain"] = ask_site.load_site_chain(
-            site=[site],
-        )
+    job_queue.submit(
+        "crawl",
+        {"site": site, "entire_site": scrape},
+        owner=st.session_state["session_id"],
+    )
+    return None
+
+
+def _crawl_job_panel():
+    crawl_jobs = job_queue.list_jobs(st.session_state["session_id"], "crawl", limit=1)
+    if not crawl_jobs:
+        return None
+    job = crawl_jobs[0]
+    if job["status"] in jobs.ACTIVE:
+        st.progress(job["progress"], text=job["message"] or "Waiting to start")
+        if st.button("Cancel"):
+            job_queue.cancel(job["id"])
+        st.button("Refresh")
+    elif job["status"] == jobs.DONE:
+        # a new crawl of the same site keeps its id, reload on every new job
+        if st.session_state["site_job"] != job["id"]:
+            with st.spinner("Loading model..."):
+                chain = ask_site.load_site_index_chain(job["result"]["site_id"])
+            st.session_state["site_chain"] = chain
+            st.session_state["site_job"] = job["id"]
+        # jobs finished before the deduplication have no stats
+        stats = job["result"].get("deduplication")
+        if stats:
+            st.caption(
+                f"{stats['kept']} pages read, {stats['duplicate_urls']} duplicate "
+                f"urls and {stats['pages'] - stats['kept']} duplicate pages skipped"
+            )
+    elif job["status"] == jobs.FAILED:
+        st.error(f"Reading the site failed: {job['error']}", icon="🚨")
     return None
 
 
@@ -29,8 +73,9 @@ def sidebar():
         scrape = st.checkbox("Entire Website", key="scrape")
         submitted = st.button("Confirm")
         if site and submitted:
-            with st.spinner("Loading model..."):
-                _scrape_handler(site, scrape)
+            _scrape_handler(site, scrape)
+        _crawl_job_panel()
+        metrics.render_debug_panel()
 
 
 def _ask_site(chain, query):
@@ -41,19 +86,13 @@ def _ask_site(chain, query):
 def main():
     sidebar()
     st.title("💬 Talk With Your Website")
-    if "messages" not in st.session_state:
-        st.session_state["messages"] = [
-            {
-                "role": "Site_Assistant",
-                "content": "How can I help you?",
-                "sources": "code",
-            }
-        ]
-    for msg in st.session_state.messages:
-        st.chat_message(msg["role"]).write(msg["content"])
+    memory = conversation.session_memory(
+        "site_qa_memory", "How can I help you?", role="Site_Assistant"
+    )
+    conversation.render_history(memory)
 
     if query := st.chat_input():
-        st.session_state.messages.append({"role": "user", "content": query})
+        memory.add("user", query)
         st.chat_message("user").write(query)
 
         if not st.session_state["site_chain"]:
@@ -62,7 +101,7 @@ def main():
 
         model_response = _ask_site(chain=st.session_state["site_chain"], query=query)
 
-        st.session_state.messages.append(model_response)
+        memory.add(model_response["role"], model_response["content"])
         st.chat_message("assistant").write(f"{model_response['content']}")
 
         st.info(f"This answer was taken from: {model_response['sources']}", icon="ℹ️")
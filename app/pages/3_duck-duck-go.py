@@ -1,4 +1,4 @@
-from models import duck_go
+from app.models import conversation, duck_go, metrics
 import streamlit as st
 
 
@@ -13,6 +13,7 @@ def sidebar():
                 st.session_state["translate_chain"] = duck_go.load_translate_chain()
                 st.session_state["url"] = url
                 st.session_state["site_language"] = duck_go.get_languages(url=url)
+        metrics.render_debug_panel()
 
 
 def _ask_duck_go(url, query, chat_model):
@@ -34,23 +35,17 @@ def update_tranlated_prompt(site_lang):
 def main():
     sidebar()
     st.title("💬 Talk with Your Website")
-    if "messages" not in st.session_state:
-        st.session_state["messages"] = [
-            {
-                "role": "Site_Assistant",
-                "content": "How can I help you?",
-                "sources": "code",
-            }
-        ]
-    for msg in st.session_state.messages:
-        st.chat_message(msg["role"]).write(msg["content"])
+    memory = conversation.session_memory(
+        "duck_go_memory", "How can I help you?", role="Site_Assistant"
+    )
+    conversation.render_history(memory)
 
     if query := st.chat_input():
         if "user_language" not in st.session_state:
             user_language = duck_go.get_languages(query=query)
             st.session_state["user_language"] = user_language
 
-        st.session_state.messages.append({"role": "user", "content": query})
+        memory.add("user", query)
         st.chat_message("user").write(query)
 
         if st.session_state["user_language"] != st.session_state["site_language"]:
@@ -66,7 +61,7 @@ def main():
                 query=query,
                 chat_model=st.session_state["chat_model"],
             )
-            st.session_state.messages.append(model_response)
+            memory.add(model_response["role"], model_response["content"])
             st.chat_message("assistant").write(f"{model_response['content']}")
 
 
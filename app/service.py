@@ -0,0 +1,76 @@
+from typing import List
+
+from fastapi import FastAPI, File, Form, HTTPException, UploadFile
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from app.models import metrics
+from app.models.qa_service import NotFoundError, QAService
+
+
+class AskRequest(BaseModel):
+    question: str
+    model: str = "mdeberta"
+    site_id: str = ""
+    namespace: str = ""
+
+
+class CrawlRequest(BaseModel):
+    site: str
+    entire_site: bool = False
+
+
+service = QAService()
+app = FastAPI(title="OpenAI-mDeBERTa-ask")
+
+
+@app.on_event("startup")
+def warm_up():
+    service.warm_up()
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok"}
+
+
+@app.get("/stats")
+def stats():
+    return service.stats()
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def prometheus_metrics():
+    return metrics.to_prometheus()
+
+
+# the endpoints are plain functions, FastAPI runs them in its thread pool, so the
+# blocking model calls of concurrent requests do not block the event loop
+@app.post("/ask")
+def ask(request: AskRequest):
+    try:
+        return service.ask(
+            request.question, request.model, request.site_id, request.namespace
+        )
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=str(error))
+    except NotFoundError as error:
+        raise HTTPException(status_code=404, detail=str(error))
+
+
+@app.post("/ingest")
+def ingest(
+    files: List[UploadFile] = File(...),
+    embeddings: List[str] = Form(["huggingf"]),
+    namespace: str = Form(""),
+):
+    uploaded = [(file.filename, file.file.read()) for file in files]
+    try:
+        return service.ingest(uploaded, embeddings, namespace)
+    except ValueError as error:
+        raise HTTPException(status_code=422, detail=str(error))
+
+
+@app.post("/crawl")
+def crawl(request: CrawlRequest):
+    return service.crawl(request.site, request.entire_site)
@@ -0,0 +1,354 @@
+"""
+Answer quality against latency for the QA parameters.
+
+Reads a QA dataset in JSONL, one {"question", "answers", "sources"} object per line
+("sources" is optional, the file names that hold the answer), indexes a corpus with
+every chunking and index type of the sweep and runs each configuration in a thread
+pool. Every configuration reports exact match and F1 of the answers, recall@k of
+the retrieval, latency and throughput, and the Pareto front of F1 against p50
+latency is printed at the end. Latencies are measured while `--workers`
+configurations run at the same time; use `--workers 1` to time them in isolation.
+
+The ChatGPT configurations call OpenAI unless `--stub-llm` is given, which sends the
+chat and embedding calls to a local stub server. Run with:
+
+    python -m benchmarks.evaluate --k 4 --k 8 --chunk-size 256 --chunk-size 400
+"""
+import contextlib
+import itertools
+import json
+import math
+import os
+import re
+import string
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import typer
+
+from benchmarks import fixtures
+from benchmarks.run import _commit, _percentiles
+
+
+DATASET = os.path.join(os.path.dirname(__file__), "qa_readme.jsonl")
+CORPUS = [
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), name)
+    for name in ("README.md", "LEIAME.md")
+]
+INDEX_TYPES = ("flat", "hnsw", "ivf")
+NO_ANSWER = "no answer found"
+
+ARTICLES_PATTERN = re.compile(r"\b(a|an|the)\b")
+PUNCTUATION = str.maketrans("", "", string.punctuation)
+
+app = typer.Typer(help=__doc__)
+
+
+def _normalize(text: str) -> str:
+    text = ARTICLES_PATTERN.sub(" ", text.lower().translate(PUNCTUATION))
+    return " ".join(text.split())
+
+
+def exact_match(prediction: str, answers: List[str]) -> float:
+    if not answers:
+        return float(_normalize(prediction) in ("", NO_ANSWER))
+    return max(float(_normalize(prediction) == _normalize(a)) for a in answers)
+
+
+def f1_score(prediction: str, answers: List[str]) -> float:
+    """Token F1 of the SQuAD evaluation, against the best matching answer."""
+    if not answers:
+        return exact_match(prediction, answers)
+    predicted = _normalize(prediction).split()
+    best = 0.0
+    for answer in answers:
+        expected = _normalize(answer).split()
+        common = sum((Counter(predicted) & Counter(expected)).values())
+        if common:
+            precision, recall = common / len(predicted), common / len(expected)
+            best = max(best, 2 * precision * recall / (precision + recall))
+    return best
+
+
+def _is_relevant(doc, record: dict) -> bool:
+    if record.get("sources"):
+        return os.path.basename(doc.metadata.get("source", "")) in record["sources"]
+    content = _normalize(doc.page_content)
+    return any(_normalize(answer) in content for answer in record["answers"])
+
+
+def _load_dataset(path: str, limit: int) -> List[dict]:
+    with open(path, encoding="utf-8") as file:
+        records = [json.loads(line) for line in file if line.strip()]
+    return records[:limit] if limit else records
+
+
+def _load_corpus(paths: List[str]):
+    from langchain.docstore.document import Document
+
+    files = list()
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name)
+                for name in sorted(os.listdir(path))
+                if name.endswith((".txt", ".md"))
+            )
+        else:
+            files.append(path)
+    documents = list()
+    for path in files:
+        with open(path, encoding="utf-8") as file:
+            documents.append(
+                Document(page_content=file.read(), metadata={"source": path})
+            )
+    return documents
+
+
+def _build_index(chunks, vectors, embeddings, index_type: str):
+    import faiss
+    import numpy as np
+    from langchain.docstore.in_memory import InMemoryDocstore
+    from langchain.vectorstores import FAISS
+
+    vectors = np.asarray(vectors, dtype="float32")
+    dim = vectors.shape[1]
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, 32)
+    elif index_type == "ivf":
+        n_lists = max(1, int(math.sqrt(len(vectors))))
+        index = faiss.IndexIVFFlat(faiss.IndexFlatL2(dim), dim, n_lists)
+        index.train(vectors)
+        index.nprobe = max(1, n_lists // 8)
+    else:
+        index = faiss.IndexFlatL2(dim)
+    index.add(vectors)
+    ids = [str(position) for position in range(len(chunks))]
+    docstore = InMemoryDocstore(dict(zip(ids, chunks)))
+    return FAISS(embeddings.embed_query, index, docstore, dict(enumerate(ids)))
+
+
+class _Indexes:
+    """The indexes of the sweep, each chunking embedded only once."""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.build_seconds: Dict[str, float] = dict()
+        self._chunks = dict()
+        self._indexes = dict()
+
+    def build(self, model: str, chunk_size: int, overlap: int, index_type: str):
+        from app.models import utils
+        from app.models.chunking import get_chunker
+        from app.models.encoding_cache import passage_cache
+
+        key = (model, chunk_size, overlap, index_type)
+        if key in self._indexes:
+            return self._indexes[key]
+        embedding_name = "openai" if model == "chatgpt" else "huggingf"
+        _, embeddings = utils.setup_for_embeddings(
+            embedding_name, return_embeddings=True
+        )
+        chunking = (embedding_name, chunk_size, overlap)
+        start = time.perf_counter()
+        if chunking not in self._chunks:
+            tokenizer = "tiktoken" if model == "chatgpt" else utils.READER_MODEL
+            chunker = get_chunker(tokenizer, chunk_size, overlap)
+            encodings = dict()
+            chunks = chunker.split_documents(self.documents, encodings=encodings)
+            if model != "chatgpt":
+                passage_cache.update(encodings)
+            vectors = embeddings.embed_documents([c.page_content for c in chunks])
+            self._chunks[chunking] = (chunks, vectors)
+        chunks, vectors = self._chunks[chunking]
+        index = _build_index(chunks, vectors, embeddings, index_type)
+        self.build_seconds["/".join(map(str, key))] = time.perf_counter() - start
+        self._indexes[key] = index
+        return index
+
+
+def _configurations(
+    models: List[str],
+    ks: List[int],
+    min_scores: List[float],
+    chunk_sizes: List[int],
+    overlaps: List[int],
+    openai_ks: List[int],
+    index_types: List[str],
+    readings: List[str],
+) -> List[dict]:
+    configurations = list()
+    for model, chunk_size, overlap, index_type in itertools.product(
+        models, chunk_sizes, overlaps, index_types
+    ):
+        if overlap >= chunk_size:
+            continue
+        common = {
+            "model": model,
+            "chunk_size": chunk_size,
+            "chunk_overlap": overlap,
+            "index_type": index_type,
+        }
+        if model == "mdeberta":
+            for k, min_score, reading in itertools.product(ks, min_scores, readings):
+                configurations.append(
+                    {**common, "k": k, "min_score": min_score, "reading": reading}
+                )
+        else:
+            for k in openai_ks:
+                configurations.append({**common, "openai_k": k})
+    return configurations
+
+
+def _evaluate(configuration: dict, index, records: List[dict], reader) -> dict:
+    from app.models import openai_model
+
+    if configuration["model"] == "mdeberta":
+        k = configuration["k"]
+    else:
+        k = 2 * configuration["openai_k"]
+        chain = openai_model.create_chain(index, k=configuration["openai_k"])
+
+    em, f1, hits, samples, passages = list(), list(), list(), list(), list()
+    for record in records:
+        question = record["question"]
+        start = time.perf_counter()
+        if configuration["model"] == "mdeberta":
+            docs_and_scores = index.similarity_search_with_score(question, k=k)
+            answers, _, read = reader.read(
+                question,
+                docs_and_scores,
+                min_score=configuration["min_score"],
+                adaptive=configuration["reading"] == "adaptive",
+            )
+            # the answer string users get from `DeBerta.run`
+            prediction = ", ".join(answers) if answers else NO_ANSWER
+            samples.append(time.perf_counter() - start)
+            docs = [doc for doc, _ in docs_and_scores]
+            passages.append(read)
+        else:
+            prediction, _ = openai_model.run(chain, question)
+            samples.append(time.perf_counter() - start)
+            # only to measure the recall, not part of the answer latency
+            docs = index.similarity_search(question, k=k)
+        em.append(exact_match(prediction, record["answers"]))
+        f1.append(f1_score(prediction, record["answers"]))
+        hits.append(float(any(_is_relevant(doc, record) for doc in docs)))
+    result = {
+        **configuration,
+        "questions": len(records),
+        "exact_match": sum(em) / len(em),
+        "f1": sum(f1) / len(f1),
+        "recall_at_k": sum(hits) / len(hits),
+        **_percentiles(samples),
+        "questions_per_s": len(records) / sum(samples),
+    }
+    if passages:
+        result["passages_per_question"] = sum(passages) / len(passages)
+    return result
+
+
+def pareto_front(results: List[dict]) -> List[dict]:
+    """The configurations that no other one beats on both F1 and p50 latency."""
+    front = list()
+    for result in results:
+        dominated = any(
+            other["f1"] >= result["f1"]
+            and other["p50_ms"] <= result["p50_ms"]
+            and (other["f1"] > result["f1"] or other["p50_ms"] < result["p50_ms"])
+            for other in results
+        )
+        if not dominated:
+            front.append(result)
+    return sorted(front, key=lambda result: result["p50_ms"])
+
+
+def _label(result: dict) -> str:
+    keys = ("model", "chunk_size", "chunk_overlap", "index_type", "k", "min_score")
+    keys += ("reading", "openai_k")
+    return " ".join(f"{key}={result[key]}" for key in keys if key in result)
+
+
+@app.command()
+def evaluate(
+    dataset: str = typer.Option(DATASET, help="QA dataset in JSONL."),
+    corpus: List[str] = typer.Option(CORPUS, help="Files or folders to index."),
+    model: List[str] = typer.Option(["mdeberta"], help="mdeberta and/or chatgpt."),
+    k: List[int] = typer.Option([8], help="Documents read by mDeBERTa."),
+    min_score: List[float] = typer.Option([2.9], help="mDeBERTa minimum score."),
+    chunk_size: List[int] = typer.Option([400], help="Chunk size in tokens."),
+    chunk_overlap: List[int] = typer.Option([32], help="Chunk overlap in tokens."),
+    openai_k: List[int] = typer.Option([6], help="K of the ChatGPT chain."),
+    index_type: List[str] = typer.Option(["flat"], help=f"One of {INDEX_TYPES}."),
+    reading: List[str] = typer.Option(["full"], help="mDeBERTa full or adaptive."),
+    workers: int = typer.Option(min(4, os.cpu_count() or 1)),
+    limit: int = typer.Option(0, help="Evaluate only the first questions."),
+    stub_llm: bool = typer.Option(False, help="Use a local OpenAI stub server."),
+    output: str = typer.Option("", help="Write the JSON report to this file."),
+):
+    """Sweep the QA parameters and report quality, latency and the Pareto front."""
+    unknown = set(index_type) - set(INDEX_TYPES)
+    if unknown:
+        raise typer.BadParameter(f"Unknown index types {sorted(unknown)}")
+    records = _load_dataset(dataset, limit)
+    configurations = _configurations(
+        model, k, min_score, chunk_size, chunk_overlap, openai_k, index_type, reading
+    )
+    with contextlib.ExitStack() as stack:
+        if stub_llm:
+            server = stack.enter_context(fixtures.openai_server())
+            os.environ["OPENAI_API_BASE"] = server.url
+            os.environ.setdefault("OPENAI_API_KEY", "stub")
+            stack.callback(os.environ.pop, "OPENAI_API_BASE", None)
+        indexes = _Indexes(_load_corpus(corpus))
+        typer.echo(f"building {len(configurations)} configurations...", err=True)
+        built = [
+            indexes.build(
+                c["model"], c["chunk_size"], c["chunk_overlap"], c["index_type"]
+            )
+            for c in configurations
+        ]
+        reader = None
+        if "mdeberta" in model:
+            from app.models import mdeberta
+
+            reader = mdeberta.DeBerta()
+            reader.enable_batching()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(
+                executor.map(
+                    lambda job: _evaluate(job[0], job[1], records, reader),
+                    zip(configurations, built),
+                )
+            )
+
+    front = pareto_front(results)
+    report = {
+        "commit": _commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "dataset": dataset,
+        "questions": len(records),
+        "workers": workers,
+        "index_build_s": indexes.build_seconds,
+        "results": results,
+        "pareto": front,
+    }
+    if output:
+        with open(output, "w") as file:
+            file.write(json.dumps(report, indent=2))
+
+    typer.echo(f"{'configuration':70} {'EM':>6} {'F1':>6} {'R@k':>6} {'p50 ms':>9}")
+    for result in sorted(results, key=lambda result: -result["f1"]):
+        marker = "*" if result in front else " "
+        typer.echo(
+            f"{marker}{_label(result):69} {result['exact_match']:6.3f} "
+            f"{result['f1']:6.3f} {result['recall_at_k']:6.3f} {result['p50_ms']:9.1f}"
+        )
+    typer.echo("* on the Pareto front of F1 against p50 latency")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator, List, Tuple
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+EMBEDDING_SIZE = 768
+WORDS = (
+    "model index document question answer search vector token page site chunk "
+    "language embedding knowledge base reader score source context latency memory "
+    "dados pergunta resposta documento pesquisa modelo contexto página fonte texto"
+).split()
+
+
+def synthetic_text(n_words: int, seed: int = 0) -> str:
+    rng = random.Random(seed)
+    sentences, words = list(), 0
+    while words < n_words:
+        length = rng.randint(8, 20)
+        sentence = " ".join(rng.choice(WORDS) for _ in range(length))
+        sentences.append(sentence.capitalize() + ".")
+        words += length
+        if rng.random() < 0.1:
+            sentences.append("\n\n")
+    return " ".join(sentences)
+
+
+def synthetic_corpus(n_docs: int, n_words: int = 600) -> List[str]:
+    return [synthetic_text(n_words, seed=i) for i in range(n_docs)]
+
+
+def random_vectors(n: int, dim: int = EMBEDDING_SIZE, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((n, dim)).astype("float32")
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def hash_vector(text: str, dim: int = EMBEDDING_SIZE) -> List[float]:
+    seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+    return random_vectors(1, dim, seed)[0].tolist()
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic embeddings derived from the text hash, no model involved."""
+
+    def __init__(self, dim: int = EMBEDDING_SIZE):
+        self.dim = dim
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [hash_vector(text, self.dim) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return hash_vector(text, self.dim)
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path: str, pages: List[str], line_width: int = 90) -> None:
+    """Write a minimal PDF with one text page per item of `pages`."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", b""]
+    page_ids = list()
+    font_id = 3
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    for text in pages:
+        lines = [
+            text[start : start + line_width]
+            for start in range(0, len(text), line_width)
+        ]
+        stream = "BT /F1 9 Tf 40 800 Td 11 TL "
+        stream += " ".join(f"({_pdf_escape(line)}) '" for line in lines[:70])
+        stream += " ET"
+        content = stream.encode("latin-1", "replace")
+        objects.append(
+            b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream"
+        )
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>"
+            % (font_id, content_id)
+        )
+        page_ids.append(len(objects))
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids).encode()
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(page_ids))
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = list()
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        output += b"%010d 00000 n \n" % offset
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\n" % (len(objects) + 1)
+    output += b"startxref\n%d\n%%%%EOF\n" % xref
+    with open(path, "wb") as file:
+        file.write(bytes(output))
+
+
+class _Server:
+    def __init__(self, handler):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "_Server":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _site_handler(n_pages: int, links_per_page: int):
+    class SiteHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            try:
+                number = int(self.path.strip("/").split("/")[-1] or 0)
+            except ValueError:
+                number = 0
+            links = "".join(
+                f'<a href="/page/{(number + i) % n_pages}">page</a>'
+                for i in range(1, links_per_page + 1)
+            )
+            body = (
+                f"<html><body><h1>Page {number}</h1>"
+                f"<p>{synthetic_text(200, seed=number)}</p>{links}</body></html>"
+            ).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return SiteHandler
+
+
+def site_server(n_pages: int = 50, links_per_page: int = 5) -> _Server:
+    """Local website with `n_pages` pages linked to each other."""
+    return _Server(_site_handler(n_pages, links_per_page))
+
+
+class _OpenAIHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if self.path.endswith("/embeddings"):
+            inputs = request["input"]
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            response = {
+                "object": "list",
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": hash_vector(text)}
+                    for i, text in enumerate(inputs)
+                ],
+                "model": request.get("model", ""),
+            }
+        else:
+            response = {
+                "id": "stub",
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": "stub answer"},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0},
+            }
+        body = json.dumps(response).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def openai_server() -> _Server:
+    """Local stub of the OpenAI embeddings and chat completions endpoints."""
+    return _Server(_OpenAIHandler)
+
+
+def duckduckgo_results(n_results: int) -> str:
+    """Result string in the format returned by `DuckDuckGoSearchResults.run`."""
+    results: Iterator[Tuple[str, str, str]] = (
+        (synthetic_text(40, seed=i), f"Title {i} - Site", f"https://example.com/{i}")
+        for i in range(n_results)
+    )
+    return ", ".join(
+        f"[snippet: {snippet}, title: {title}, link: {link}]"
+        for snippet, title, link in results
+    )
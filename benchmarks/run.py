@@ -0,0 +1,266 @@
+"""
+Offline performance benchmarks.
+
+Every benchmark runs against synthetic data and local stub servers, so no network
+access (OpenAI, DuckDuckGo or the crawled sites) is needed. The mDeBERTa benchmark
+uses the model from the local Hugging Face cache and the index creation uses the
+tiktoken encoding from the tiktoken cache, each is skipped when its files are not
+there. A benchmark that fails is reported with its error and the others still run.
+Run with:
+
+    python -m benchmarks.run run --output bench.json
+    python -m benchmarks.run compare old.json new.json
+"""
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import typer
+
+from benchmarks import fixtures
+
+
+app = typer.Typer(help=__doc__)
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    return {
+        "p50_ms": 1000 * ordered[int(0.50 * (len(ordered) - 1))],
+        "p95_ms": 1000 * ordered[int(0.95 * (len(ordered) - 1))],
+        "mean_ms": 1000 * statistics.fmean(ordered),
+    }
+
+
+def _timed(function: Callable, repeat: int) -> List[float]:
+    samples = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def _max_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_pdf_to_txt(n_pages: int = 200) -> dict:
+    from app.models import utils
+
+    with tempfile.TemporaryDirectory() as folder:
+        pdf_path = os.path.join(folder, "report.pdf")
+        fixtures.write_pdf(
+            pdf_path, [fixtures.synthetic_text(500, seed=i) for i in range(n_pages)]
+        )
+        size_mb = os.path.getsize(pdf_path) / 2**20
+        tracemalloc.start()
+        start = time.perf_counter()
+        utils.pdf_to_txt(pdf_path, pdf_path)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {
+        "pages": n_pages,
+        "seconds": seconds,
+        "pages_per_s": n_pages / seconds,
+        "mb_per_s": size_mb / seconds,
+        "peak_python_mb": peak / 2**20,
+    }
+
+
+def bench_create_index(n_docs: int = 40) -> dict:
+    import tiktoken
+
+    from app.models import create_knowledge_base, utils
+
+    try:
+        # the chunker and the embedding batches count tokens with it
+        tiktoken.get_encoding("cl100k_base")
+    except Exception as error:
+        return {"skipped": f"tiktoken encoding not in the local cache: {error}"}
+
+    with tempfile.TemporaryDirectory() as folder, fixtures.openai_server() as server:
+        for i, text in enumerate(fixtures.synthetic_corpus(n_docs)):
+            with open(os.path.join(folder, f"doc_{i}.txt"), "w") as file:
+                file.write(text)
+        index_path = os.path.join(folder, "index_openai")
+        original = (create_knowledge_base.DATA_PATH, utils.OPENAI_INDEX_PATH)
+        create_knowledge_base.DATA_PATH = folder
+        utils.OPENAI_INDEX_PATH = index_path
+        os.environ["OPENAI_API_BASE"] = server.url
+        os.environ.setdefault("OPENAI_API_KEY", "stub")
+        try:
+            tracemalloc.start()
+            start = time.perf_counter()
+            create_knowledge_base.create_index("openai")
+            seconds = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            create_knowledge_base.DATA_PATH, utils.OPENAI_INDEX_PATH = original
+            del os.environ["OPENAI_API_BASE"]
+    return {
+        "documents": n_docs,
+        "seconds": seconds,
+        "docs_per_s": n_docs / seconds,
+        "peak_python_mb": peak / 2**20,
+        "max_rss_mb": _max_rss_mb(),
+    }
+
+
+def bench_faiss_search(
+    sizes: Tuple[int, ...] = (1_000, 10_000, 50_000), k: int = 8, queries: int = 200
+) -> dict:
+    from langchain.vectorstores import FAISS
+
+    results = dict()
+    query_vectors = fixtures.random_vectors(queries, seed=1).tolist()
+    for size in sizes:
+        vectors = fixtures.random_vectors(size)
+        texts = [f"chunk {i}" for i in range(size)]
+        index = FAISS.from_embeddings(
+            list(zip(texts, vectors.tolist())), fixtures.HashEmbeddings()
+        )
+        queue = iter(query_vectors * 2)
+        samples = _timed(
+            lambda: index.similarity_search_with_score_by_vector(next(queue), k=k),
+            queries,
+        )
+        results[str(size)] = _percentiles(samples)
+    return results
+
+
+def bench_deberta(n_questions: int = 30) -> dict:
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")
+    os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+    from langchain.vectorstores import FAISS
+
+    from app.models import mdeberta
+
+    try:
+        model = mdeberta.DeBerta()
+    except OSError as error:
+        return {"skipped": f"model not in the local cache: {error}"}
+
+    corpus = fixtures.synthetic_corpus(200, n_words=150)
+    index = FAISS.from_texts(
+        corpus,
+        fixtures.HashEmbeddings(),
+        metadatas=[{"source": f"doc_{i}.txt"} for i in range(len(corpus))],
+    )
+    questions = [
+        f"What is the {word} of the model?" for word in fixtures.WORDS[:n_questions]
+    ]
+    queue = iter(questions)
+    samples = _timed(lambda: model.run(next(queue), index), len(questions))
+    return {
+        **_percentiles(samples),
+        "docs_per_s": model.k * len(samples) / sum(samples),
+    }
+
+
+def bench_crawler(n_pages: int = 100) -> dict:
+    from app.models import ask_site
+
+    with fixtures.site_server(n_pages=n_pages) as server:
+        ask_site.urls.clear()
+        start = time.perf_counter()
+        urls = ask_site.get_urls(server.url + "/page/0")
+        seconds = time.perf_counter() - start
+        crawled = len(urls)
+        ask_site.urls.clear()
+    return {"pages": crawled, "seconds": seconds, "pages_per_s": crawled / seconds}
+
+
+def bench_duckduckgo_parsing(n_results: int = 1_000) -> dict:
+    from app.models import duck_go
+
+    results = fixtures.duckduckgo_results(n_results)
+    samples = _timed(lambda: duck_go._split_results(results), 20)
+    return {"results": n_results, **_percentiles(samples)}
+
+
+BENCHMARKS = {
+    "pdf_to_txt": bench_pdf_to_txt,
+    "create_index": bench_create_index,
+    "faiss_search": bench_faiss_search,
+    "deberta_run": bench_deberta,
+    "crawler": bench_crawler,
+    "duckduckgo_parsing": bench_duckduckgo_parsing,
+}
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@app.command()
+def run(
+    only: List[str] = typer.Option([], help=f"Benchmarks to run: {list(BENCHMARKS)}"),
+    output: str = typer.Option("", help="Write the JSON report to this file."),
+):
+    """Run the benchmarks and print the JSON report."""
+    results = dict()
+    for name, benchmark in BENCHMARKS.items():
+        if only and name not in only:
+            continue
+        typer.echo(f"running {name}...", err=True)
+        try:
+            results[name] = benchmark()
+        except Exception as error:
+            typer.echo(f"{name} failed: {error!r}", err=True)
+            results[name] = {"error": repr(error)}
+
+    report = {
+        "commit": _commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, "w") as file:
+            file.write(text)
+    typer.echo(text)
+
+
+def _flatten(results: dict, prefix: str = "") -> Dict[str, float]:
+    flat = dict()
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)):
+            flat[f"{prefix}{key}"] = value
+    return flat
+
+
+@app.command()
+def compare(baseline: str, candidate: str):
+    """Print the relative change of every metric between two reports."""
+    with open(baseline) as file:
+        old = _flatten(json.load(file)["results"])
+    with open(candidate) as file:
+        new = _flatten(json.load(file)["results"])
+    for metric in sorted(old.keys() & new.keys()):
+        change = (new[metric] - old[metric]) / old[metric] if old[metric] else 0.0
+        typer.echo(f"{metric:45} {old[metric]:12.3f} {new[metric]:12.3f} {change:+.1%}")
+
+
+if __name__ == "__main__":
+    app()
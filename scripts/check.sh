@@ -9,4 +9,5 @@ set -xo pipefail
 
 $RUN isort --check --diff $SOURCE_FILES
 $RUN black --check --diff $SOURCE_FILES
-$RUN flake8 $SOURCE_FILES
\ No newline at end of file
+$RUN flake8 $SOURCE_FILES
+$RUN pytest -q
@@ -0,0 +1,20 @@
+import pytest
+
+
+class WordEncoding:
+    """Offline stand-in for a tiktoken encoding, one token per word."""
+
+    def encode(self, text):
+        return text.split()
+
+    def decode(self, tokens):
+        return " ".join(tokens)
+
+
+@pytest.fixture
+def word_tokens(monkeypatch):
+    """Count tokens as words, the tiktoken files are downloaded on first use."""
+    pytest.importorskip("tiktoken")
+    from app.models import context_budget
+
+    monkeypatch.setattr(context_budget._Encoder, "get", lambda model: WordEncoding())
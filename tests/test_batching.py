@@ -0,0 +1,80 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from app.models.batching import MicroBatcher
+
+
+def test_concurrent_callers_get_their_own_results():
+    batches = list()
+
+    def double(items):
+        batches.append(len(items))
+        time.sleep(0.01)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(double, max_batch_size=8, max_wait_ms=50)
+    try:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {
+                caller: executor.submit(
+                    batcher.submit, [caller * 10 + i for i in range(3)]
+                )
+                for caller in range(8)
+            }
+            results = {
+                caller: future.result(timeout=5) for caller, future in futures.items()
+            }
+        stats = batcher.stats()
+    finally:
+        batcher.close()
+
+    assert results == {c: [(c * 10 + i) * 2 for i in range(3)] for c in range(8)}
+    assert max(batches) > 1 and max(batches) <= 8
+    assert stats["items"] == 24 and stats["batches"] == len(batches)
+    assert sum(stats["batch_size_histogram"].values()) == len(batches)
+    assert stats["queue_depth"] == 0
+
+
+def test_errors_reach_every_caller_of_the_batch():
+    def broken(items):
+        raise ValueError("broken")
+
+    def short(items):
+        return items[:-1]
+
+    for process_fn, error in ((broken, ValueError), (short, RuntimeError)):
+        batcher = MicroBatcher(process_fn)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(batcher.submit, [1, 2])
+            with pytest.raises(error):
+                future.result(timeout=5)
+        batcher.close()
+
+
+def test_close_fails_the_queued_items():
+    gate = threading.Event()
+
+    def wait(items):
+        gate.wait()
+        return items
+
+    batcher = MicroBatcher(wait, max_batch_size=1)
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        running = executor.submit(batcher.submit, ["running"])
+        time.sleep(0.1)
+        queued = executor.submit(batcher.submit, ["queued"])
+        time.sleep(0.1)
+        assert batcher.stats()["queue_depth"] == 1
+        closing = executor.submit(batcher.close)
+        time.sleep(0.1)
+        gate.set()
+        closing.result(timeout=5)
+
+        assert running.result(timeout=5) == ["running"]
+        with pytest.raises(RuntimeError):
+            queued.result(timeout=5)
+    with pytest.raises(RuntimeError):
+        batcher.submit(["late"])
@@ -0,0 +1,131 @@
+import re
+
+import pytest
+
+pytest.importorskip("langchain")
+
+from langchain.docstore.document import Document  # noqa
+
+from app.models.chunking import TiktokenAdapter, TokenChunker, chunk_id  # noqa
+from benchmarks.fixtures import synthetic_text  # noqa
+
+
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+
+class WordTokenizer:
+    """Words and punctuation as tokens, the ids are the token positions."""
+
+    def encode(self, text):
+        offsets = [match.span() for match in TOKEN_PATTERN.finditer(text)]
+        return list(range(len(offsets))), offsets
+
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
+
+
+class ByteEncoding:
+    """A tiktoken-like encoding whose tokens are `size` bytes of UTF-8."""
+
+    def __init__(self, size):
+        self.size = size
+        self.vocabulary = dict()
+
+    def encode(self, text, disallowed_special=()):
+        data = text.encode("utf-8")
+        pieces = [data[i : i + self.size] for i in range(0, len(data), self.size)]
+        return [
+            self.vocabulary.setdefault(piece, len(self.vocabulary)) for piece in pieces
+        ]
+
+    def decode_single_token_bytes(self, token):
+        return {value: key for key, value in self.vocabulary.items()}[token]
+
+
+@pytest.fixture
+def text():
+    return synthetic_text(3000, seed=1)
+
+
+def test_chunks_fit_the_target_and_round_trip(text):
+    chunker = TokenChunker(WordTokenizer(), target_tokens=50, overlap_tokens=10)
+
+    chunks = chunker.split_text(text)
+
+    assert len(chunks) > 10
+    for chunk_text, start, end, ids, offsets in chunks:
+        assert 0 < len(ids) <= 50
+        assert chunk_text == text[start:end]
+        # the token offsets are relative to the chunk text
+        tokens = [chunk_text[begin:stop] for begin, stop in offsets]
+        assert tokens == TOKEN_PATTERN.findall(chunk_text)
+    assert chunks[0][1] == 0 and chunks[-1][2] == len(text.rstrip())
+
+
+def test_chunks_overlap_and_prefer_sentence_ends(text):
+    chunker = TokenChunker(WordTokenizer(), target_tokens=200, overlap_tokens=20)
+
+    chunks = chunker.split_text(text)
+
+    assert len(chunks) > 10
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk[3][:20] == previous[3][-20:]
+        assert chunk[1] < previous[2]
+    # the synthetic sentences are shorter than the last quarter of a chunk
+    assert all(chunk_text.endswith(".") for chunk_text, *_ in chunks[:-1])
+
+
+def test_split_documents_metadata_and_encodings(text):
+    chunker = TokenChunker(WordTokenizer(), target_tokens=50, overlap_tokens=10)
+    document = Document(page_content=text, metadata={"source": "a.txt"})
+    encodings = dict()
+
+    chunks = chunker.split_documents([document], encodings=encodings)
+
+    for chunk in chunks:
+        metadata = chunk.metadata
+        assert (
+            text[metadata["start_index"] : metadata["end_index"]] == chunk.page_content
+        )
+        assert metadata["source"] == "a.txt"
+        assert metadata["chunk_id"] == chunk_id(chunk.page_content)
+        # encoded on the chunk text alone
+        ids, _ = encodings[metadata["chunk_id"]]
+        assert ids == list(range(metadata["n_tokens"]))
+
+
+def test_overlap_must_be_smaller_than_the_target():
+    with pytest.raises(ValueError):
+        TokenChunker(WordTokenizer(), target_tokens=10, overlap_tokens=10)
+
+
+def test_tiktoken_offsets_are_characters_with_multibyte_text():
+    text = "ação em 日本語, ok"
+    # one token per character, with the bytes of each character
+    encoding = ByteEncoding(size=1)
+    adapter = TiktokenAdapter(encoding)
+    encoding.encode = lambda text, disallowed_special=(): [
+        encoding.vocabulary.setdefault(char.encode("utf-8"), len(encoding.vocabulary))
+        for char in text
+    ]
+
+    _, offsets = adapter.encode(text)
+
+    assert offsets == [(i, i + 1) for i in range(len(text))]
+
+
+@pytest.mark.parametrize("size", [1, 2, 5])
+def test_tiktoken_offsets_of_tokens_splitting_characters(size):
+    text = "ação em 日本語, ok"
+    adapter = TiktokenAdapter(ByteEncoding(size))
+
+    ids, offsets = adapter.encode(text)
+
+    assert len(ids) == len(offsets)
+    assert offsets[0][0] == 0 and offsets[-1][1] == len(text)
+    assert all(start <= end <= len(text) for start, end in offsets)
+    starts = [start for start, _ in offsets]
+    assert starts == sorted(starts)
+    chunker = TokenChunker(adapter, target_tokens=4, overlap_tokens=1)
+    for chunk_text, start, end, *_ in chunker.split_text(text):
+        assert chunk_text == text[start:end]
@@ -0,0 +1,68 @@
+import pytest
+
+pytest.importorskip("langchain")
+
+from langchain.docstore.document import Document  # noqa
+
+from app.models.context_budget import BudgetRetriever, pack_documents  # noqa
+
+
+class Store:
+    def __init__(self, docs_and_scores):
+        self.docs_and_scores = docs_and_scores
+
+    def similarity_search_with_score(self, query, k=4):
+        return self.docs_and_scores[:k]
+
+
+def _doc(text, source="a.txt"):
+    return Document(page_content=text, metadata={"source": source})
+
+
+def _words(prefix, n):
+    return " ".join(f"{prefix}{i}" for i in range(n))
+
+
+def test_packs_the_closest_chunks_within_the_budget(word_tokens):
+    docs_and_scores = [
+        (_doc(_words("far", 10)), 0.9),
+        (_doc(_words("near", 10)), 0.1),
+        (_doc(_words("mid", 10)), 0.5),
+    ]
+
+    packed, used = pack_documents(docs_and_scores, max_tokens=15)
+
+    assert [doc.page_content for doc in packed] == [
+        _words("near", 10),
+        _words("mid", 5),
+    ]
+    assert used == 15
+    assert packed[0].metadata == {"source": "a.txt", "score": 0.1}
+
+
+def test_drops_duplicates_and_the_splitter_overlap(word_tokens):
+    first = _words("w", 60)
+    neighbour = _words("w", 100)[len(_words("w", 40)) + 1 :] + " " + _words("x", 20)
+    docs_and_scores = [
+        (_doc(first), 0.1),
+        (_doc(first + " extra"), 0.2),
+        (_doc(neighbour), 0.3),
+    ]
+
+    packed, _ = pack_documents(docs_and_scores, max_tokens=1000)
+
+    assert len(packed) == 2
+    # the 20 words shared with the first chunk are removed from its neighbour
+    assert packed[1].page_content.split()[0] == "w60"
+
+
+def test_retriever_counts_the_query_and_the_prompt(word_tokens):
+    retriever = BudgetRetriever(
+        vectorstore=Store([(_doc(_words("w", 50)), 0.1)]),
+        max_tokens=20,
+        prompt_template="answer the question",
+    )
+
+    docs = retriever.get_relevant_documents("two words")
+
+    assert len(docs[0].page_content.split()) == 20 - 3 - 2
@@ -0,0 +1,80 @@
+from app.models.conversation import MESSAGE_OVERHEAD_TOKENS, ConversationMemory
+
+
+class Summarizer:
+    def __init__(self):
+        self.calls = list()
+
+    def __call__(self, summary, messages):
+        self.calls.append([message["content"] for message in messages])
+        return " ".join([summary] + self.calls[-1]).strip()
+
+
+def _memory(n, max_stored=200):
+    memory = ConversationMemory(max_stored=max_stored)
+    for i in range(n):
+        memory.add("user" if i % 2 == 0 else "mDeBERTa", f"message {i}")
+    return memory
+
+
+def test_keeps_at_most_max_stored_messages():
+    memory = _memory(8, max_stored=5)
+
+    assert [m.content for m in memory.messages] == [f"message {i}" for i in range(3, 8)]
+    assert [m.content for m in memory.window(2)] == ["message 6", "message 7"]
+    assert memory.hidden(2) == 6
+
+
+def test_history_fits_the_token_budget(word_tokens):
+    memory = _memory(10)
+    # each message takes 2 words plus the overhead of the chat format
+    budget = 3 * (2 + MESSAGE_OVERHEAD_TOKENS)
+
+    messages = memory.prompt_messages(system="be brief", max_tokens=budget)
+
+    assert messages[0] == {"role": "system", "content": "be brief"}
+    assert [m["content"] for m in messages[1:]] == [
+        "message 7",
+        "message 8",
+        "message 9",
+    ]
+    # roles unknown to the chat API are sent as the assistant
+    assert messages[1]["role"] == "assistant"
+
+
+def test_older_messages_are_folded_into_the_summary(word_tokens):
+    memory = _memory(10)
+    summarize = Summarizer()
+
+    messages = memory.prompt_messages(max_tokens=40, summarize=summarize)
+
+    assert summarize.calls and summarize.calls[0][0] == "message 0"
+    assert messages[0]["role"] == "system"
+    assert "message 0" in messages[0]["content"]
+    assert messages[-1]["content"] == "message 9"
+
+
+def test_dropped_messages_are_summarized_before_they_are_lost(word_tokens):
+    memory = _memory(6, max_stored=4)
+    summarize = Summarizer()
+
+    memory.prompt_messages(max_tokens=1000, summarize=summarize)
+
+    assert summarize.calls == [["message 0", "message 1"]]
+    assert "message 1" in memory.summary
+    memory.prompt_messages(max_tokens=1000, summarize=summarize)
+    assert len(summarize.calls) == 1
+
+
+def test_failed_summary_keeps_the_dropped_messages(word_tokens):
+    memory = _memory(6, max_stored=4)
+
+    def fail(summary, messages):
+        raise RuntimeError("offline")
+
+    messages = memory.prompt_messages(max_tokens=1000, summarize=fail)
+    summarize = Summarizer()
+    memory.prompt_messages(max_tokens=1000, summarize=summarize)
+
+    assert len(messages) == 4 and memory.summary.startswith("message 0")
+    assert summarize.calls[0] == ["message 0", "message 1"]
@@ -0,0 +1,78 @@
+import random
+
+import pytest
+
+pytest.importorskip("langchain")
+
+from langchain.docstore.document import Document  # noqa
+
+from app.models.dedup import canonicalize_url, deduplicate_documents  # noqa
+
+
+def _words(seed, n=300):
+    rng = random.Random(seed)
+    return [f"word{rng.randrange(5000)}" for _ in range(n)]
+
+
+def _page(url, words):
+    return Document(page_content=" ".join(words), metadata={"source": url})
+
+
+def test_canonical_url_ignores_what_does_not_change_the_page():
+    assert (
+        canonicalize_url(
+            "HTTPS://Example.com:443/docs/index.html?utm_source=x&b=2&a=1#s"
+        )
+        == "https://example.com/docs?a=1&b=2"
+    )
+    assert canonicalize_url("http://example.com:8080/a/") == "http://example.com:8080/a"
+
+
+def test_near_duplicate_pages_are_dropped():
+    words = _words(0)
+    edited = list(words)
+    # another date and a few changed words in a long page
+    for position in (10, 80, 150, 220, 290):
+        edited[position] = "changed"
+    documents = [
+        _page("https://example.com/a", words),
+        _page("https://example.com/b", edited),
+        _page("https://example.com/c", _words(1)),
+    ]
+
+    kept, stats = deduplicate_documents(documents)
+
+    assert [doc.metadata["source"] for doc in kept] == [
+        "https://example.com/a",
+        "https://example.com/c",
+    ]
+    assert stats["near_duplicates"] == 1 and stats["kept"] == 2
+
+
+def test_pages_sharing_half_their_text_are_kept():
+    words, other = _words(0), _words(1)
+    documents = [
+        _page("https://example.com/a", words),
+        _page("https://example.com/b", words[:150] + other[150:]),
+    ]
+
+    kept, _ = deduplicate_documents(documents)
+
+    assert len(kept) == 2
+
+
+def test_exact_and_canonical_duplicates():
+    words = _words(0)
+    documents = [
+        _page("https://example.com/a", words),
+        _page("https://example.com/a/?utm_medium=mail", _words(1)),
+        _page("https://example.com/print", [w.upper() + "!" for w in words]),
+        _page("https://example.com/old", _words(2)),
+    ]
+
+    kept, stats = deduplicate_documents(
+        documents, {"https://example.com/old": "https://example.com/a"}
+    )
+
+    assert kept == documents[:1]
+    assert stats["canonical_duplicates"] == 2 and stats["exact_duplicates"] == 1
@@ -0,0 +1,106 @@
+import os
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("langchain")
+
+from app.models.embedding_client import BatchedOpenAIEmbeddings, _batch_key  # noqa
+from benchmarks.fixtures import hash_vector, openai_server  # noqa
+
+
+TEXTS = [f"document number {i} about the knowledge base" for i in range(10)]
+
+
+def _client(server, tmp_path, **kwargs):
+    return BatchedOpenAIEmbeddings(
+        api_key="test",
+        api_base=server.url,
+        max_batch_tokens=20,
+        progress_path=str(tmp_path / "progress"),
+        **kwargs,
+    )
+
+
+def test_embeds_in_order_across_batches(word_tokens, tmp_path):
+    reports = list()
+    with openai_server() as server:
+        client = _client(
+            server, tmp_path, progress_callback=lambda *r: reports.append(r)
+        )
+        embeddings = client.embed_documents(TEXTS)
+        query = client.embed_query("a question")
+
+    np.testing.assert_allclose(embeddings, [hash_vector(text) for text in TEXTS])
+    np.testing.assert_allclose(query, hash_vector("a question"))
+    assert len(client._make_batches(TEXTS)) > 1
+    assert reports[-1][0] == reports[-1][1]
+    # the checkpoint of a finished run is removed
+    assert os.listdir(tmp_path / "progress") == []
+
+
+def test_resumes_from_saved_batches(word_tokens, tmp_path):
+    with openai_server() as server:
+        client = _client(server, tmp_path)
+        batches = client._make_batches(TEXTS)
+        keys = [_batch_key(batch) for batch in batches]
+        run_path = client._run_path(keys)
+        saved = [[1.0, 0.0]] * len(batches[0])
+        client._save_progress(run_path, keys[0], saved)
+        # another run over other texts does not see the checkpoint
+        assert client._load_progress(client._run_path(keys[1:])) == dict()
+
+        embeddings = client.embed_documents(TEXTS)
+
+    assert embeddings[: len(batches[0])] == saved
+    np.testing.assert_allclose(
+        embeddings[len(batches[0]) :],
+        [hash_vector(text) for text in TEXTS[len(batches[0]) :]],
+        rtol=1e-6,
+    )
+    assert not os.path.exists(run_path)
+
+
+def test_cancelling_stops_the_remaining_requests(word_tokens, tmp_path):
+    texts = [f"short text {i}" for i in range(40)]
+    started, finished = list(), list()
+
+    class Cancelled(Exception):
+        pass
+
+    def cancel(done, total):
+        if done >= 2:
+            raise Cancelled()
+
+    with openai_server() as server:
+        client = _client(
+            server,
+            tmp_path,
+            max_batch_size=1,
+            max_concurrency=1,
+            progress_callback=cancel,
+        )
+        request = client._request
+
+        def counted(batch):
+            started.append(batch)
+            try:
+                return request(batch)
+            finally:
+                finished.append(batch)
+
+        client._request = counted
+        with pytest.raises(Cancelled):
+            client.embed_documents(texts)
+        # the request already running when the run was cancelled still ends
+        deadline = time.monotonic() + 5
+        while len(finished) < len(started) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    assert len(started) < len(texts) / 2
+    assert len(finished) == len(started)
+    # the finished batches are kept for the next run
+    run_path = client._run_path([_batch_key([text]) for text in texts])
+    assert len(os.listdir(run_path)) >= 2
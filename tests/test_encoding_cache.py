@@ -0,0 +1,30 @@
+import numpy as np
+
+from app.models.encoding_cache import ENTRY_OVERHEAD, EncodingCache
+
+
+def _encoding(n):
+    return list(range(n)), [(i, i + 1) for i in range(n)]
+
+
+def test_evicts_least_recently_used_by_bytes():
+    entry = 100 * 4 * 3 + ENTRY_OVERHEAD
+    cache = EncodingCache(max_bytes=2 * entry)
+    cache.put("a", _encoding(100))
+    cache.put("b", _encoding(100))
+    assert cache.get("a") is not None
+    cache.put("c", _encoding(100))
+
+    assert cache.get("b") is None
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["bytes"] == 2 * entry
+
+
+def test_stores_int32_arrays():
+    cache = EncodingCache()
+    ids, offsets = cache.get_or_compute("a", lambda: _encoding(3))
+
+    assert ids.dtype == np.int32 and offsets.shape == (3, 2)
+    assert ids[:2].tolist() == [0, 1]
+    assert tuple(offsets[2]) == (2, 3)
+    assert cache.get_or_compute("a", lambda: _encoding(5))[0].size == 3
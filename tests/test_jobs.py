@@ -0,0 +1,108 @@
+import os
+import time
+
+import pytest
+
+from app.models import jobs
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = jobs.JobQueue(
+        db_path=str(tmp_path / "jobs.sqlite3"), jobs_path=str(tmp_path / "jobs")
+    )
+    queue.register("echo", lambda job: {"files": sorted(os.listdir(job.files_path))})
+    yield queue
+    queue.close()
+
+
+def _stall(queue, job_id):
+    # the worker of the job stopped sending heartbeats
+    queue._update(job_id, heartbeat_at=time.time() - jobs.STALE_AFTER - 1)
+
+
+def test_runs_a_job_and_removes_its_files(queue):
+    job_id = queue.submit("echo", {}, owner="me", files=[("a.txt", b"text")])
+    assert queue.get(job_id)["status"] == jobs.QUEUED
+
+    queue._run(queue._claim())
+
+    job = queue.get(job_id)
+    assert job["status"] == jobs.DONE
+    assert job["result"] == {"files": ["a.txt"]}
+    assert not os.path.exists(os.path.join(queue.jobs_path, job_id))
+    assert [job["id"] for job in queue.list_jobs("me")] == [job_id]
+    assert queue._claim() is None
+
+
+def test_workers_run_the_queued_jobs(queue):
+    queue.start()
+    job_id = queue.submit("echo", {})
+    deadline = time.time() + 5
+    while queue.get(job_id)["status"] != jobs.DONE and time.time() < deadline:
+        time.sleep(0.05)
+    assert queue.get(job_id)["status"] == jobs.DONE
+
+
+def test_unknown_kind_is_rejected(queue):
+    with pytest.raises(ValueError):
+        queue.submit("unknown", {})
+
+
+def test_failed_handler_marks_the_job_failed(queue):
+    def fail(job):
+        raise RuntimeError("broken")
+
+    queue.register("fail", fail)
+    job_id = queue.submit("fail", {})
+    queue._run(queue._claim())
+
+    job = queue.get(job_id)
+    assert job["status"] == jobs.FAILED and job["error"] == "broken"
+
+
+def test_cancel_a_queued_job(queue):
+    job_id = queue.submit("echo", {}, files=[("a.txt", b"text")])
+    queue.cancel(job_id)
+
+    assert queue.get(job_id)["status"] == jobs.CANCELLED
+    assert not os.path.exists(os.path.join(queue.jobs_path, job_id))
+    assert queue._claim() is None
+
+
+def test_cancel_a_running_job_at_its_next_check(queue):
+    def slow(job):
+        queue.cancel(job.id)
+        job.progress(0.5, "half way")
+        return {}
+
+    queue.register("slow", slow)
+    job_id = queue.submit("slow", {})
+    queue._run(queue._claim())
+
+    assert queue.get(job_id)["status"] == jobs.CANCELLED
+
+
+def test_stale_job_is_resumed_with_its_state(queue):
+    job_id = queue.submit("echo", {})
+    job = jobs.Job(queue, queue._claim())
+    job.state["step"] = 1
+    job.save_state()
+    _stall(queue, job_id)
+
+    row = queue._claim()
+
+    assert row["id"] == job_id and queue.get(job_id)["attempts"] == 2
+    assert jobs.Job(queue, row).state == {"step": 1}
+
+
+def test_stale_job_is_given_up_after_max_attempts(queue):
+    job_id = queue.submit("echo", {}, files=[("a.txt", b"text")])
+    for _ in range(jobs.MAX_ATTEMPTS):
+        assert queue._claim()["id"] == job_id
+        _stall(queue, job_id)
+
+    assert queue._claim() is None
+    job = queue.get(job_id)
+    assert job["status"] == jobs.FAILED and job["error"] == "The worker stopped"
+    assert not os.path.exists(os.path.join(queue.jobs_path, job_id))
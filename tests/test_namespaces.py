@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+
+import pytest
+
+from app.models import namespaces
+
+
+@pytest.fixture
+def tenants(monkeypatch, tmp_path):
+    monkeypatch.setattr(namespaces, "TENANTS_PATH", str(tmp_path))
+    return tmp_path
+
+
+def _age(namespace, seconds):
+    used_at = time.time() - seconds
+    namespaces.touch(namespace)
+    os.utime(
+        os.path.join(namespaces.namespace_path(namespace), namespaces.LAST_USED_FILE),
+        (used_at, used_at),
+    )
+
+
+def test_cleanup_removes_only_expired_namespaces(tenants):
+    _age("old", 100)
+    _age("recent", 1)
+    (tenants / "not a namespace").mkdir()
+    os.utime(tenants / "not a namespace", (0, 0))
+
+    assert namespaces.cleanup_expired(ttl=50) == ["old"]
+    assert sorted(os.listdir(tenants)) == ["not a namespace", "recent"]
+
+
+def test_cleanup_checks_the_age_again_under_the_lock(tenants):
+    _age("busy", 100)
+    removed = list()
+    with namespaces.namespace_lock("busy"):
+        cleanup = threading.Thread(
+            target=lambda: removed.extend(namespaces.cleanup_expired(ttl=50))
+        )
+        cleanup.start()
+        time.sleep(0.1)
+        # used while the cleanup waits for the lock
+        namespaces.touch("busy")
+    cleanup.join()
+
+    assert removed == []
+    assert os.path.exists(namespaces.namespace_path("busy"))
+
+
+def test_background_cleanup_does_not_block_the_caller(tenants):
+    _age("old", 100)
+    held, release = threading.Event(), threading.Event()
+
+    def ingest():
+        with namespaces.namespace_lock("old"):
+            held.set()
+            release.wait(5)
+
+    writer = threading.Thread(target=ingest)
+    writer.start()
+    held.wait(5)
+    start = time.monotonic()
+    cleanup = namespaces.start_cleanup(ttl=50)
+
+    assert time.monotonic() - start < 1
+    assert namespaces.start_cleanup(ttl=50) is None
+    release.set()
+    writer.join()
+    cleanup.join(5)
+    assert not os.path.exists(namespaces.namespace_path("old"))
+
+
+def test_lock_is_reentrant_and_exclusive(tenants):
+    events = list()
+
+    def write():
+        with namespaces.namespace_lock("a"):
+            events.append("other")
+
+    with namespaces.namespace_lock("a"):
+        with namespaces.namespace_lock("a"):
+            other = threading.Thread(target=write)
+            other.start()
+            time.sleep(0.1)
+            events.append("owner")
+    other.join()
+
+    assert events == ["owner", "other"]
+
+
+def test_upload_folders_are_private_and_removed(tenants):
+    with namespaces.upload_folder("a") as first:
+        with namespaces.upload_folder("a") as second:
+            assert first != second
+            open(os.path.join(first, "file.txt"), "w").close()
+    assert not os.path.exists(first) and not os.path.exists(second)
+
+
+def test_invalid_namespace_is_rejected(tenants):
+    with pytest.raises(ValueError):
+        namespaces.namespace_path("../escape")
+
+
+def test_namespaced_index_merges_the_overlay_and_marks_it_used(tenants):
+    pytest.importorskip("faiss")
+    from langchain.vectorstores import FAISS
+
+    from benchmarks.fixtures import HashEmbeddings
+
+    embeddings = HashEmbeddings()
+    base = FAISS.from_texts(["shared one", "shared two"], embeddings)
+    overlay = FAISS.from_texts(["private file"], embeddings)
+    index = namespaces.NamespacedIndex(base, [overlay, None], embeddings, "a")
+
+    results = index.similarity_search_with_score("private file", k=2)
+
+    assert [doc.page_content for doc, _ in results][0] == "private file"
+    assert len(results) == 2
+    assert os.path.exists(
+        os.path.join(namespaces.namespace_path("a"), namespaces.LAST_USED_FILE)
+    )
@@ -0,0 +1,70 @@
+import os
+
+import pytest
+
+pytest.importorskip("faiss")
+pytest.importorskip("langchain")
+
+from langchain.docstore.document import Document  # noqa
+from langchain.vectorstores import FAISS  # noqa
+
+from app.models import sharded_index  # noqa
+from benchmarks.fixtures import HashEmbeddings  # noqa
+
+
+def _documents(start, stop):
+    return [
+        Document(page_content=f"chunk number {i}", metadata={"id": i})
+        for i in range(start, stop)
+    ]
+
+
+def _ids(index_path, embeddings):
+    index = sharded_index.load_sharded_index(index_path, embeddings)
+    return sorted(
+        doc.metadata["id"]
+        for shard in index.shards
+        for doc in shard.docstore._dict.values()
+    )
+
+
+def test_add_documents_fills_the_active_shard_first(tmp_path):
+    index_path, embeddings = str(tmp_path), HashEmbeddings()
+    sharded_index.migrate(index_path, embeddings, max_vectors=10)
+    sharded_index.add_documents(index_path, _documents(0, 4), embeddings)
+    manifest = sharded_index.add_documents(index_path, _documents(4, 25), embeddings)
+
+    assert [shard["vectors"] for shard in manifest["shards"]] == [10, 10, 5]
+    assert sorted(os.listdir(index_path)) == sorted(
+        [shard["path"] for shard in manifest["shards"]]
+        + [sharded_index.MANIFEST_FILE, sharded_index.LOCK_FILE]
+    )
+    index = sharded_index.load_sharded_index(index_path, embeddings)
+    doc, distance = index.similarity_search_with_score("chunk number 17", k=1)[0]
+    assert doc.metadata["id"] == 17 and distance == pytest.approx(0, abs=1e-5)
+
+
+def test_migrate_keeps_the_vectors_of_a_single_index(tmp_path):
+    index_path, embeddings = str(tmp_path), HashEmbeddings()
+    FAISS.from_documents(_documents(0, 7), embeddings).save_local(index_path)
+
+    manifest = sharded_index.migrate(index_path, embeddings, max_vectors=3)
+
+    assert [shard["vectors"] for shard in manifest["shards"]] == [3, 3, 1]
+    assert not os.path.exists(os.path.join(index_path, "index.faiss"))
+    assert _ids(index_path, embeddings) == list(range(7))
+
+
+def test_compact_merges_the_sealed_shards(tmp_path):
+    index_path, embeddings = str(tmp_path), HashEmbeddings()
+    sharded_index.migrate(index_path, embeddings, max_vectors=3)
+    sharded_index.add_documents(index_path, _documents(0, 13), embeddings)
+
+    removed = sharded_index.compact(index_path, embeddings, max_vectors=10)
+
+    manifest = sharded_index.load_manifest(index_path)
+    # the active shard is left alone, the 4 sealed ones of 3 vectors fit in 9 + 3
+    assert [shard["vectors"] for shard in manifest["shards"]] == [9, 3, 1]
+    assert removed == 2
+    assert _ids(index_path, embeddings) == list(range(13))
+    assert sharded_index.compact(index_path, embeddings, max_vectors=10) == 0
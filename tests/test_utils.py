@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from app.models import utils
+
+
+def _version(tmp_path, name):
+    path = tmp_path / f"index.{name}"
+    path.mkdir()
+    (path / "index.faiss").write_text(name)
+    return str(path)
+
+
+def test_replaced_folders_are_kept_for_the_grace_period(tmp_path, monkeypatch):
+    target = str(tmp_path / "index")
+    first, second, third = (_version(tmp_path, name) for name in ("1", "2", "3"))
+    utils.replace_directory(first, target)
+    utils.replace_directory(second, target)
+
+    # a reader that resolved the link before the swap can still load the old one
+    assert open(os.path.join(target, "index.faiss")).read() == "2"
+    assert os.path.exists(os.path.join(first, "index.faiss"))
+
+    monkeypatch.setattr(utils, "REPLACED_GRACE", 0)
+    staging = _version(tmp_path, "4")
+    utils.replace_directory(third, target)
+
+    assert not os.path.exists(first) and not os.path.exists(second)
+    assert os.path.exists(staging)
+    assert open(os.path.join(target, "index.faiss")).read() == "3"
+
+
+PAGES = [f"Page {number} says{' word' * number} here." for number in range(5)]
+
+
+@pytest.mark.parametrize("parallel", [False, True])
+def test_pdf_to_txt_keeps_the_page_offsets(tmp_path, monkeypatch, parallel):
+    from langchain.docstore.document import Document
+
+    from app.models import create_knowledge_base
+    from benchmarks.fixtures import write_pdf
+
+    if parallel:
+        # a process pool of spawned workers, each opening the file
+        monkeypatch.setattr(utils, "PARALLEL_MIN_PAGES", 2)
+        monkeypatch.setattr(utils, "PDF_WORKERS", 2)
+    pdf_path = str(tmp_path / "doc.pdf")
+    write_pdf(pdf_path, PAGES)
+
+    utils.pdf_to_txt(pdf_path, pdf_path)
+
+    txt_path = str(tmp_path / "doc.txt")
+    text = open(txt_path, encoding="utf-8").read()
+    page_starts = utils.load_page_offsets(txt_path)
+    assert len(page_starts) == len(PAGES)
+    for start, page in zip(page_starts, PAGES):
+        assert text[start:].startswith(page)
+
+    chunks = [
+        Document(page_content="", metadata={"source": txt_path, "start_index": start})
+        for start in (0, page_starts[3] - 1, page_starts[3], len(text) - 1)
+    ]
+    pages = [
+        c.metadata["page"] for c in create_knowledge_base._add_page_numbers(chunks)
+    ]
+    assert pages == [1, 3, 4, 5]